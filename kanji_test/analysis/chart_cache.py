@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+#  chart_cache.py
+#  kanji_test
+#
+#  Created by agent on 2026-10-17.
+#
+
+"""
+An on-disk cache of computed analysis charts, keyed by chart name, so that
+the staff dashboards need not recompute them from the usage logs on every
+request. Entries are shared between processes. Stale entries are still
+served; the refresh_charts command rebuilds them in the background.
+"""
+
+import os
+import time
+import glob
+import tempfile
+import cPickle as pickle
+from os import path
+
+from django.conf import settings
+
+from kanji_test.util import charts
+
+class CachedChart(object):
+    "A computed chart, along with its url and the time it was built."
+    def __init__(self, name, chart, url, built_time):
+        self.name = name
+        self.chart = chart
+        self.url = url
+        self.built_time = built_time
+
+    def age(self):
+        return time.time() - self.built_time
+
+    def is_stale(self, max_age=None):
+        """
+        Whether this chart is older than max_age seconds
+        (ANALYSIS_CACHE_MAX_AGE by default).
+        """
+        if max_age is None:
+            max_age = settings.ANALYSIS_CACHE_MAX_AGE
+        return self.age() > max_age
+
+def get(name, build_func):
+    """
+    Fetches the named chart, building it with build_func(name) and storing
+    it only if there is no cached copy. A stale copy is returned as is,
+    and left for refresh_charts to rebuild.
+    """
+    cached = load(name)
+    if cached is None:
+        cached = store(name, build_func(name))
+
+    return cached
+
+def load(name):
+    "Loads the cached copy of the named chart, or None if there is none."
+    try:
+        istream = open(_get_filename(name), 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            return pickle.load(istream)
+        except (EOFError, pickle.UnpicklingError):
+            # Left over from an incompatible version; rebuild it.
+            return None
+    finally:
+        istream.close()
+
+def store(name, chart):
+    """
+    Stores the chart under the given name. The file is replaced atomically,
+    so readers never see a partly written chart.
+    """
+    try:
+        url = chart.get_url()
+    except charts.UrlTooLongError:
+        url = None
+    cached = CachedChart(name, chart, url, time.time())
+
+    cache_dir = settings.ANALYSIS_CACHE_DIR
+    if not path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another process got there first.
+            pass
+
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    ostream = os.fdopen(fd, 'wb')
+    try:
+        pickle.dump(cached, ostream, pickle.HIGHEST_PROTOCOL)
+    finally:
+        ostream.close()
+    os.rename(tmp_filename, _get_filename(name))
+
+    return cached
+
+def invalidate(name=None):
+    "Removes the named chart from the cache, or every chart if no name."
+    if name is None:
+        filenames = glob.glob(path.join(settings.ANALYSIS_CACHE_DIR,
+                '*.pickle'))
+    else:
+        filenames = [_get_filename(name)]
+
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def _get_filename(name):
+    return path.join(settings.ANALYSIS_CACHE_DIR, '%s.pickle' % name)
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
@@ -19,6 +19,7 @@ from django.conf import settings
 import consoleLog
 
 from kanji_test.drill import models
+from kanji_test.analysis import chart_cache
 from kanji_test.user_profile.models import UserProfile
 from kanji_test.user_model.models import Syllabus
 
@@ -36,6 +37,9 @@ def clean_all():
     
     clean_languages()
     clean_manual()
+
+    # Charts computed from the old logs are now out of date.
+    chart_cache.invalidate()
     
     _log.finish()
 
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+#  refresh_charts.py
+#  kanji_test
+#
+#  Created by agent on 2026-10-17.
+#
+
+"""
+A command to precompute the analysis charts, building them in parallel and
+storing them in the chart cache. Charts which are missing or older than
+ANALYSIS_CACHE_MAX_AGE are rebuilt. Suitable for running from cron.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+import consoleLog
+
+from kanji_test.analysis import chart_cache
+from kanji_test.analysis import stats
+from kanji_test.analysis import views
+from kanji_test.util import pipeline
+
+_log = consoleLog.default
+
+class Command(NoArgsCommand):
+    help = "Precomputes the analysis charts."
+    requires_model_validation = True
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', dest='workers',
+            type='int', default=None,
+            help='The number of charts to build at once [one per core].'),
+        make_option('--clear', action='store_true', dest='clear',
+            default=False,
+            help='Remove all cached charts, so that every one is rebuilt.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['clear']:
+            chart_cache.invalidate()
+
+        names = sorted(set(views.get_graph_key(name) for name in \
+                views.name_to_desc))
+        names = [n for n in names if _needs_refresh(n)]
+        stages = [pipeline.Stage(name, _refresh_chart, args=(name,)) \
+                for name in names]
+        _log.start('Refreshing analysis charts', nSteps=len(stages))
+        start_time = time.time()
+        try:
+            pipeline.run_stages(stages,
+                    max_workers=options['workers'], log=_log)
+        except pipeline.BuildError, e:
+            raise CommandError(str(e))
+        _log.finish('%.1fs in total' % (time.time() - start_time))
+
+def _needs_refresh(name):
+    cached = chart_cache.load(name)
+    return cached is None or cached.is_stale()
+
+def _refresh_chart(name):
+    # Don't reuse counts memoised before this chart's worker was started.
+    stats.clear_memo()
+    chart_cache.store(name, views._build_graph(name))
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
@@ -9,17 +9,21 @@
 
 """
 This model provides a variety of analyses of usage data, many of which involve
-low-level SQL queries in order to calculate them efficiently.
+low-level SQL queries in order to calculate them efficiently. Analyses of
+responses read from the denormalised drill_responsefact table rather than
+joining the response log to its questions and options.
 """
 
 import sys
+import time
+import threading
 from itertools import groupby
 from datetime import timedelta, datetime
 from simplestats import sequences
 
 from django.db import connection
+from django.core.signals import request_finished
 from django.conf import settings
-from django.contrib.auth.models import User
 from simplestats import mean, basic_stats
 from cjktools import scripts
 
@@ -158,19 +162,11 @@ def get_mean_score_nth_test():
     """
     cursor = connection.cursor()
     cursor.execute("""
-        SELECT ur.user_id, AVG(ur.is_correct)
-        FROM drill_testset_responses AS tsr
-        INNER JOIN (
-            SELECT r.user_id, r.id AS response_id, o.is_correct
-            FROM drill_response AS r
-            INNER JOIN drill_multiplechoiceresponse AS mcr
-            ON r.id = mcr.response_ptr_id
-            INNER JOIN drill_multiplechoiceoption AS o
-            ON o.id = mcr.option_id
-        ) AS ur
-        ON tsr.multiplechoiceresponse_id = ur.response_id
-        GROUP BY tsr.testset_id
-        ORDER BY ur.user_id
+        SELECT user_id, AVG(is_correct)
+        FROM drill_responsefact
+        WHERE test_set_id IS NOT NULL
+        GROUP BY test_set_id
+        ORDER BY user_id, test_set_id
     """)
     ignore_users = _get_user_ignore_set()
     data = []
@@ -375,15 +371,15 @@ def get_mean_score_by_n_tests():
     """)
     user_data = cursor.fetchall()
     
+    aggregates = get_user_aggregates()
     data = []
     for user_id, n_tests in user_data:
-        user_responses = drill_models.Response.objects.filter(user__id=user_id)
-        n_responses = user_responses.count()
-        n_correct = user_responses.filter(
-                multiplechoiceresponse__option__is_correct=True).count()
+        aggregate = aggregates.get(user_id)
+        if aggregate is None or aggregate.n_responses == 0:
+            continue
         data.append((
             n_tests,
-            n_correct / float(n_responses)
+            aggregate.get_score(),
         ))
     return data
 
@@ -445,8 +441,8 @@ def get_language_data(name):
     else:
         assert name == 'combined'
 
-    valid_users = set(u.id for u in User.objects.all() if u.testset_set.exclude(
-            end_time=None).count() > 0)
+    valid_users = set(user_id for (user_id, aggregate) in \
+            get_user_aggregates().iteritems() if aggregate.n_tests > 0)
         
     profiles = UserProfile.objects.filter(user__id__in=valid_users).values(
             *fields_needed)
@@ -473,16 +469,16 @@ def get_user_scores(syllabus_tag):
     Returns the overall user scores for each user on this syllabus.
     """
     syllabus = Syllabus.objects.get(tag=syllabus_tag)
+    user_ids = UserProfile.objects.filter(syllabus=syllabus).values_list(
+            'user_id', flat=True)
+    aggregates = get_user_aggregates()
     data = []
-    for user in User.objects.filter(userprofile__syllabus=syllabus):
-        if user.response_set.count() == 0:
+    for user_id in sorted(user_ids):
+        aggregate = aggregates.get(user_id)
+        if aggregate is None or aggregate.n_responses == 0:
             continue
         
-        user_responses = user.response_set
-        n_correct = user_responses.filter(
-                multiplechoiceresponse__option__is_correct=True).count()
-        n_responses = user_responses.count()
-        data.append(n_correct / float(n_responses))
+        data.append(aggregate.get_score())
     return data
 
 def get_test_size_stats():
@@ -566,17 +562,10 @@ def get_pivots_by_errors(n, syllabus_id, pivot_type):
     syllabus_query = _get_syllabus_query(syllabus_id, pivot_type)
     cursor = connection.cursor()        
     cursor.execute("""
-        SELECT q.pivot_id, COUNT(*) AS n_errors
-        FROM (
-            SELECT mco.question_id
-            FROM drill_multiplechoiceresponse AS mcr
-            INNER JOIN drill_multiplechoiceoption AS mco
-            ON mcr.option_id = mco.id
-            WHERE NOT mco.is_correct
-        ) AS qr
-        INNER JOIN drill_question AS q
-        ON qr.question_id = q.id
-        WHERE pivot_type = "%(pivot_type)s"
+        SELECT pivot_id, COUNT(*) AS n_errors
+        FROM drill_responsefact
+        WHERE NOT is_correct
+            AND pivot_type = "%(pivot_type)s"
             AND pivot_id IN (%(syllabus_query)s)
         GROUP BY pivot_id
         ORDER BY n_errors DESC
@@ -651,22 +640,10 @@ def get_mean_time_used():
 def get_mean_error_by_plugin():
     cursor = connection.cursor()
     cursor.execute("""
-        SELECT plugin.name, 1 - plugin_score.score
-        FROM (
-            SELECT
-                question.question_plugin_id,
-                chosen_option.is_correct as score
-            FROM (
-                SELECT mco.question_id, mco.is_correct
-                FROM drill_multiplechoiceresponse AS mcr
-                INNER JOIN drill_multiplechoiceoption AS mco
-                ON mcr.option_id = mco.id
-            ) as chosen_option
-            INNER JOIN drill_question AS question
-            ON chosen_option.question_id = question.id
-        ) AS plugin_score
+        SELECT plugin.name, 1 - fact.is_correct
+        FROM drill_responsefact AS fact
         INNER JOIN drill_questionplugin AS plugin
-        ON plugin_score.question_plugin_id = plugin.id
+        ON fact.question_plugin_id = plugin.id
         ORDER BY plugin.name ASC
     """)
     return [(l, float(v)) for (l, v) in cursor.fetchall()]
@@ -682,29 +659,12 @@ def get_power_binned_error_by_plugin(n=5):
     assert len(power_user_ids) == n
     
     cursor.execute("""
-        SELECT plugin_score.user_id, plugin_score.timestamp,
-                plugin.name, 1 - plugin_score.score
-        FROM (
-            SELECT
-                question.question_plugin_id,
-                chosen_option.is_correct as score,
-                response.user_id,
-                response.timestamp
-            FROM (
-                SELECT mcr.response_ptr_id, mco.question_id, mco.is_correct
-                FROM drill_multiplechoiceresponse AS mcr
-                INNER JOIN drill_multiplechoiceoption AS mco
-                ON mcr.option_id = mco.id
-            ) as chosen_option
-            INNER JOIN drill_question AS question
-            ON chosen_option.question_id = question.id
-            INNER JOIN drill_response AS response
-            ON chosen_option.response_ptr_id = response.id
-            WHERE response.user_id IN (%s)
-        ) AS plugin_score
+        SELECT fact.user_id, fact.timestamp, plugin.name, 1 - fact.is_correct
+        FROM drill_responsefact AS fact
         INNER JOIN drill_questionplugin AS plugin
-        ON plugin_score.question_plugin_id = plugin.id
-        ORDER BY plugin_score.user_id ASC, plugin_score.timestamp ASC
+        ON fact.question_plugin_id = plugin.id
+        WHERE fact.user_id IN (%s)
+        ORDER BY fact.user_id ASC, fact.timestamp ASC
     """ % ', '.join(str(uid) for uid in power_user_ids))
 
     early = []
@@ -739,20 +699,10 @@ def get_power_binned_error_by_plugin(n=5):
 def get_accuracy_by_pivot_type():
     cursor = connection.cursor()
     cursor.execute("""
-        SELECT
-            question.pivot,
-            SUM(chosen_option.is_correct) as n_correct,
-            COUNT(*) as n_responses
-        FROM (
-            SELECT mco.question_id, mco.is_correct
-            FROM drill_multiplechoiceresponse AS mcr
-            INNER JOIN drill_multiplechoiceoption AS mco
-            ON mcr.option_id = mco.id
-        ) as chosen_option
-        INNER JOIN drill_question AS question
-        ON chosen_option.question_id = question.id
-        WHERE question.pivot_type = "w"
-        GROUP BY question.pivot
+        SELECT pivot, SUM(is_correct) as n_correct, COUNT(*) as n_responses
+        FROM drill_responsefact
+        WHERE pivot_type = "w"
+        GROUP BY pivot
     """)
     raw_data = cursor.fetchall()
     counts = {'Hiragana': FreqDist(), 'Katakana': FreqDist(), 'Kanji':
@@ -785,12 +735,12 @@ def get_accuracy_by_pivot_type():
     return data
 
 def get_rater_stats(rater):
-    responses = drill_models.MultipleChoiceOption.objects.filter(
-            multiplechoiceresponse__user=rater).values('is_correct')
+    responses = drill_models.ResponseFact.objects.filter(user=rater
+            ).values('is_correct')
     mean_accuracy = mean((r['is_correct'] and 1 or 0) for r in responses)
     
     return {
-        'n_responses': drill_models.Response.objects.filter(
+        'n_responses': drill_models.ResponseFact.objects.filter(
                 user=rater).count(),
         'n_tests': drill_models.TestSet.objects.filter(
                 user=rater).count(),
@@ -805,20 +755,12 @@ def get_pivot_response_stats(pivot_id, pivot_type):
     cursor = connection.cursor()
     
     cursor.execute("""
-        SELECT plugin_option.plugin_id, plugin_option.value
-        FROM drill_multiplechoiceresponse AS mcr
-        INNER JOIN (
-            SELECT pivot_qn.plugin_id, mco.id AS option_id, mco.value
-            FROM (
-                SELECT id, question_plugin_id AS plugin_id
-                FROM drill_question
-                WHERE pivot_type = "%(pivot_type)s"
-                    AND pivot_id = %(pivot_id)d
-            ) AS pivot_qn
-            INNER JOIN drill_multiplechoiceoption AS mco
-            ON mco.question_id = pivot_qn.id
-        ) AS plugin_option
-        ON plugin_option.option_id = mcr.option_id
+        SELECT fact.question_plugin_id, mco.value
+        FROM drill_responsefact AS fact
+        INNER JOIN drill_multiplechoiceoption AS mco
+        ON mco.id = fact.option_id
+        WHERE fact.pivot_type = "%(pivot_type)s"
+            AND fact.pivot_id = %(pivot_id)d
     """ % {'pivot_type': pivot_type, 'pivot_id': pivot_id})
     rows = cursor.fetchall()
     dist_map = {}
@@ -850,24 +792,13 @@ def get_global_rater_stats():
     id_to_username = dict(cursor.fetchall())
     
     cursor.execute("""
-        SELECT q_time.user_id, q.pivot, q.pivot_type, q_time.is_correct
-        FROM (
-            SELECT mco.question_id, mco.is_correct, ot.user_id, ot.timestamp
-            FROM (
-                SELECT mcr.option_id, dr.user_id, dr.timestamp
-                FROM drill_response AS dr
-                INNER JOIN drill_multiplechoiceresponse AS mcr
-                ON mcr.response_ptr_id = dr.id
-            ) AS ot
-            INNER JOIN drill_multiplechoiceoption AS mco
-            ON mco.id = ot.option_id
-        ) AS q_time
-        INNER JOIN drill_question AS q
-        ON q.id = q_time.question_id
-        ORDER BY user_id ASC, q_time.timestamp ASC
+        SELECT user_id, pivot, pivot_type, is_correct
+        FROM drill_responsefact
+        ORDER BY user_id ASC, timestamp ASC
     """)
     results = []
     ignore_users = _get_user_ignore_set()
+    aggregates = get_user_aggregates()
     
     for user_id, rows in groupby(cursor.fetchall(), lambda r: r[0]):
         if user_id in ignore_users:
@@ -879,8 +810,7 @@ def get_global_rater_stats():
             'username':     id_to_username[user_id]
         }
         user_data['n_responses'] = len(rows)
-        user_data['n_tests'] = drill_models.TestSet.objects.filter(
-                user__id=user_id).exclude(end_time=None).count()
+        user_data['n_tests'] = aggregates[user_id].n_tests
         user_data['mean_accuracy'] = mean(r[2] for r in rows)
         user_data['n_errors'] = _seq_len(r for r in rows if r[2])
 
@@ -949,10 +879,74 @@ def get_state_machine():
         state_transitions.add_counts(user_data['state_machine'])
     return state_transitions
 
+class UserAggregate(object):
+    "Response and test counts for a single user."
+    def __init__(self, n_responses=0, n_correct=0, n_tests=0):
+        self.n_responses = n_responses
+        self.n_correct = n_correct
+        self.n_tests = n_tests
+
+    def get_score(self):
+        return self.n_correct / float(self.n_responses)
+
+def get_user_aggregates():
+    """
+    Returns a dictionary mapping each user id to a UserAggregate, where
+    n_tests counts only finished tests. All users are counted in one pass,
+    and the result is shared by every analysis run during the same request,
+    or for up to MEMO_MAX_AGE seconds outside of one.
+    """
+    aggregates, fetched_time = getattr(_request_memo, 'user_aggregates',
+            (None, None))
+    if aggregates is None or time.time() - fetched_time > MEMO_MAX_AGE:
+        aggregates = _fetch_user_aggregates()
+        _request_memo.user_aggregates = (aggregates, time.time())
+    return aggregates
+
+def clear_memo():
+    "Forgets any results shared between analyses in this thread."
+    _request_memo.__dict__.clear()
+
 #----------------------------------------------------------------------------#
 # HELPERS
 #----------------------------------------------------------------------------#
 
+# The longest time in seconds a memoised result is reused for.
+MEMO_MAX_AGE = 60
+
+_request_memo = threading.local()
+
+def _clear_request_memo(sender, **kwargs):
+    clear_memo()
+
+request_finished.connect(_clear_request_memo)
+
+def _fetch_user_aggregates():
+    aggregates = {}
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT user_id, COUNT(*), SUM(is_correct)
+        FROM drill_responsefact
+        GROUP BY user_id
+    """)
+    for user_id, n_responses, n_correct in cursor.fetchall():
+        aggregates[user_id] = UserAggregate(n_responses=n_responses,
+                n_correct=int(n_correct))
+
+    cursor.execute("""
+        SELECT user_id, COUNT(*)
+        FROM drill_testset
+        WHERE end_time IS NOT NULL
+        GROUP BY user_id
+    """)
+    for user_id, n_tests in cursor.fetchall():
+        aggregate = aggregates.get(user_id)
+        if aggregate is None:
+            aggregate = aggregates[user_id] = UserAggregate()
+        aggregate.n_tests = n_tests
+
+    return aggregates
+
 def _get_user_ignore_set():
     return set(p.user_id for p in 
             UserProfile.objects.filter(first_language__contains='Japanese'))
@@ -993,13 +987,11 @@ def _seq_len(seq):
     return i
 
 def _get_n_errors(pivot_id):
-    return drill_models.Response.objects.filter(
-            question__pivot_id=pivot_id).filter(
-                multiplechoiceresponse__option__is_correct=False
-            ).count()
+    return drill_models.ResponseFact.objects.filter(pivot_id=pivot_id,
+            is_correct=False).count()
 
 def _get_n_responses(pivot_id):
-    return drill_models.Response.objects.filter(question__pivot_id=pivot_id
+    return drill_models.ResponseFact.objects.filter(pivot_id=pivot_id
             ).count()
 
 def _get_syllabus_query(syllabus_id, pivot_type):
@@ -1080,21 +1072,10 @@ def _get_test_scores():
     """
     cursor = connection.cursor()
     cursor.execute("""
-        SELECT testset_id, score
-        FROM (
-            SELECT test_option.testset_id, AVG(mco.is_correct) AS score, 
-                    COUNT(*) as n_responses
-            FROM (
-                SELECT tsr.testset_id, mcr.option_id
-                FROM drill_testset_responses AS tsr
-                INNER JOIN drill_multiplechoiceresponse AS mcr
-                ON tsr.multiplechoiceresponse_id = mcr.response_ptr_id
-            ) AS test_option
-            INNER JOIN drill_multiplechoiceoption AS mco
-            ON test_option.option_id = mco.id
-            GROUP BY test_option.testset_id
-        ) AS results
-        WHERE n_responses > 0
+        SELECT test_set_id, AVG(is_correct) AS score
+        FROM drill_responsefact
+        WHERE test_set_id IS NOT NULL
+        GROUP BY test_set_id
     """)
     return [(i, float(s)) for (i, s) in cursor.fetchall()]
 
@@ -21,6 +21,7 @@ from django.conf import settings
 from simplestats import basic_stats, mean
 
 from kanji_test.analysis.decorators import staff_only
+from kanji_test.analysis import chart_cache
 from kanji_test.drill import models
 from kanji_test.util import charts
 from kanji_test.tutor import study_list
@@ -62,9 +63,8 @@ def basic(request):
     context['tests_per_user'] = num_tests / float(num_users)
     context['responses_per_test'] = num_responses / float(num_tests)
     
-    all_responses = models.MultipleChoiceResponse.objects
-    context['mean_score'] = (all_responses.filter(option__is_correct=True
-            ).count() / float(all_responses.count()))
+    context['mean_score'] = (models.ResponseFact.objects.filter(
+            is_correct=True).count() / float(num_responses))
 
     test_stats = stats.get_test_size_stats()
     pretty_results = [(k, 100*t, 100*c) for (k, t, c) in test_stats]
@@ -79,7 +79,8 @@ def basic(request):
 @staff_only
 def data(request, name=None, format=None):
     "Fetches data set as either a chart or as a CSV file."
-    chart = _build_graph(name)
+    cached = _get_graph(name)
+    chart = cached.chart
     if name.count('_') > 2:
         raise Http404
 
@@ -88,7 +89,7 @@ def data(request, name=None, format=None):
             mimetype = 'text/html'
         else:
             mimetype = 'application/json'
-        return HttpResponse(simplejson.dumps(chart.get_url()),
+        return HttpResponse(simplejson.dumps(cached.url or chart.get_url()),
                 mimetype=mimetype)
 
     elif format == 'csv':
@@ -110,8 +111,7 @@ def chart_dashboard(request, name=None):
         context['name'] = name
         context['desc'] = name_to_desc[name]
 
-        chart = _build_graph(name)
-        context['chart'] = chart
+        context['chart'] = _get_graph(name).chart
 
     return render_to_response("analysis/charts.html", context,
             RequestContext(request))
@@ -305,6 +305,20 @@ available_charts = (
 name_to_desc = dict(reduce(operator.add, (c.charts for c in \
         available_charts)))
 
+def _get_graph(name):
+    """
+    Fetches the named graph from the chart cache, building it only if it
+    has never been built.
+    """
+    return chart_cache.get(get_graph_key(name), _build_graph)
+
+def get_graph_key(name):
+    """
+    The name of the graph which _build_graph() actually builds for this
+    name, ignoring any data set suffix.
+    """
+    return '_'.join(name.split('_')[:2])
+
 def _build_graph(name):
     "Builds a graph using the given name."
     first_part, rest = name.split('_', 1)
@@ -16,6 +16,12 @@ from django.conf import settings
 from kanji_test import util as _requires_util
 from kanji_test import user_model as _requires_user_model
 
+build_depends_on = ['kanji_test.user_model']
+
+def build():
+    "Builds the distractor pools of every drill plugin."
+    build_distractor_pools()
+
 def load_plugins(plugin_set=settings.DRILL_PLUGINS):
     """
     Returns a list of plugin instances from the set given, defaulting to
@@ -33,3 +39,38 @@ def load_plugins(plugin_set=settings.DRILL_PLUGINS):
         plugins.append(plugin_class())
     
     return plugins
+
+def build_distractor_pools(plugins=None, force=False):
+    """
+    Precomputes ranked distractor pools for every syllabus, for each
+    plugin which provides them. Must run after the syllabi and their prior
+    distributions have been built.
+    """
+    import sys
+    import consoleLog
+    from checksum.models import Checksum
+    from kanji_test.drill import models, support
+    from kanji_test.user_model import models as usermodel_models
+    from kanji_test.user_model import add_syllabus, bundle
+
+    _log = consoleLog.default
+    plugins = plugins or load_plugins()
+    _log.start('Building distractor pools', nSteps=len(plugins))
+    dependencies = [models, support] + list(set(
+            sys.modules[p.__module__] for p in plugins))
+    parent_tags = [add_syllabus.syllabus_checksum_tag(name) for name in
+            bundle.list_names()]
+    if not force and not Checksum.needs_update('distractor_pools',
+            dependencies, parent_tags):
+        _log.finish('Already up-to-date')
+        return
+
+    for plugin in plugins:
+        n_pools = 0
+        for syllabus in usermodel_models.Syllabus.objects.all():
+            n_pools += models.DistractorOption.store(syllabus,
+                    plugin.get_question_plugin(),
+                    plugin.build_pools(syllabus))
+        _log.log('%s (%d pools)' % (plugin.verbose_name, n_pools))
+    Checksum.store('distractor_pools', dependencies)
+    _log.finish()
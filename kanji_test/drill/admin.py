@@ -50,3 +50,11 @@ class TestSetAdmin(admin.ModelAdmin):
 
 admin.site.register(models.TestSet, TestSetAdmin)
 
+
+class DistractorOptionAdmin(admin.ModelAdmin):
+    list_display = ('pivot', 'pivot_type', 'value', 'weight',
+            'question_plugin', 'syllabus')
+    list_filter = ('pivot_type', 'question_plugin', 'syllabus')
+    search_fields = ('pivot',)
+
+admin.site.register(models.DistractorOption, DistractorOptionAdmin)
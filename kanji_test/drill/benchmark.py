@@ -3,44 +3,187 @@
 #
 #  benchmark.py
 #  kanji_test
-# 
+#
 #  Created by Lars Yencken on 23-11-2008.
 #  Copyright 2008 Lars Yencken. All rights reserved.
 #
 
 """
+Benchmarks question generation, response submission and error model updates
+against the configured database, broken down by question plugin, pivot type
+and syllabus. Each operation records its latency and the SQL it issued, and
+the summary can be written as JSON so that runs can be diffed.
 """
 
 import os, sys, optparse
 import time
+import math
+import random
 import cProfile
 
-from cjktools.common import sopen
+import numpy
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.utils import simplejson
 
-from kanji_test.user_profile.models import UserProfile
 from kanji_test.user_model.models import Syllabus, ErrorDist
-from kanji_test.drill.models import TestSet
+from kanji_test.drill import load_plugins
+from kanji_test.drill.models import TestSet, MultipleChoiceResponse
+from kanji_test.drill.plugin_api import UnsupportedItem
+
+# The dimensions which each sample is summarised over.
+GROUPINGS = (
+        ('operation',),
+        ('operation', 'plugin'),
+        ('operation', 'pivot_type'),
+        ('operation', 'syllabus'),
+        ('operation', 'plugin', 'pivot_type', 'syllabus'),
+    )
+
+def benchmark(n_items, n_sets=0, syllabus_tags=None, plugin_set=None):
+    """
+    Generates questions for n_items random items per syllabus with every
+    plugin, answers each one, and optionally generates n_sets whole test
+    sets per syllabus. Returns the list of samples taken.
+    """
+    # Log queries so that we can count them per operation.
+    settings.DEBUG = True
+    # Measure queueing and applying updates as separate operations.
+    settings.DEFERRED_UPDATES = True
+
+    plugins = load_plugins(plugin_set or settings.DRILL_PLUGINS)
+
+    syllabi = Syllabus.objects.order_by('tag')
+    if syllabus_tags:
+        syllabi = syllabi.filter(tag__in=syllabus_tags)
+
+    samples = []
+    for syllabus in syllabi:
+        print 'Syllabus %s' % syllabus.tag
+        test_user = _new_test_user(syllabus)
+        try:
+            for item in syllabus.get_random_items(n_items):
+                for plugin in plugins:
+                    _benchmark_question(plugin, item, test_user, syllabus,
+                            samples)
+
+            for i in xrange(n_sets):
+                test_set, sample = _measure(TestSet.from_user, test_user)
+                sample.update(operation='test_set', syllabus=syllabus.tag)
+                samples.append(sample)
+        finally:
+            test_user.delete()
+
+    return samples
+
+def summarise(samples):
+    """
+    Summarises the samples over each grouping, giving latency percentiles
+    in milliseconds and query counts for every group.
+    """
+    summary = {}
+    for grouping in GROUPINGS:
+        groups = {}
+        for sample in samples:
+            if all(sample.get(k) is not None for k in grouping):
+                key = tuple(sample[k] for k in grouping)
+                groups.setdefault(key, []).append(sample)
+
+        rows = []
+        for key in sorted(groups):
+            group = groups[key]
+            times = sorted(1000 * s['seconds'] for s in group)
+            n_queries = [s['n_queries'] for s in group]
+            row = dict(zip(grouping, key))
+            row.update(
+                    count=len(group),
+                    p50_ms=_percentile(times, 50),
+                    p95_ms=_percentile(times, 95),
+                    p99_ms=_percentile(times, 99),
+                    mean_ms=sum(times) / len(times),
+                    mean_queries=float(sum(n_queries)) / len(group),
+                    max_queries=max(n_queries),
+                    mean_inserts=float(sum(s['n_inserts'] for s in group))
+                            / len(group),
+                )
+            rows.append(row)
+
+        summary['by_' + '_'.join(grouping)] = rows
+
+    return summary
+
+def print_summary(summary):
+    for row in summary['by_operation_plugin'] + \
+            summary['by_operation_pivot_type'] + \
+            summary['by_operation_syllabus']:
+        label = ' '.join(unicode(row[k]) for k in ('operation', 'plugin',
+                'pivot_type', 'syllabus') if k in row)
+        print (u'%-40s n=%-5d p50=%7.1fms p95=%7.1fms p99=%7.1fms '
+                u'queries=%5.1f' % (label, row['count'], row['p50_ms'],
+                row['p95_ms'], row['p99_ms'], row['mean_queries'])
+            ).encode('utf8')
+
+#----------------------------------------------------------------------------#
+
+def _benchmark_question(plugin, item, user, syllabus, samples):
+    "Generates, answers and updates from one question."
+    if plugin.requires_kanji and not item.has_kanji():
+        return
 
-def benchmark(n_sets, n_questions):
-    test_user = _new_test_user()
+    plugin_name = plugin.get_name()
+    try:
+        question, sample = _measure(plugin.get_question, item, user)
+    except UnsupportedItem:
+        return
+
+    sample.update(operation='question', plugin=plugin_name,
+            pivot_type=question.pivot_type, syllabus=syllabus.tag)
+    samples.append(sample)
+
+    response = MultipleChoiceResponse(question=question, user=user,
+            option=random.choice(list(question.options.all())))
+    _none, sample = _measure(response.save)
+    sample.update(operation='respond', plugin=plugin_name,
+            pivot_type=question.pivot_type, syllabus=syllabus.tag)
+    samples.append(sample)
+
+    question_plugin = question.question_plugin
+    if question_plugin.is_adaptive:
+        _none, sample = _measure(question_plugin.update, response)
+        sample.update(operation='update', plugin=plugin_name,
+                pivot_type=question.pivot_type, syllabus=syllabus.tag)
+        samples.append(sample)
+        response.pendingupdate_set.all().delete()
+
+def _measure(func, *args):
+    "Calls the function, returning its result and a timing sample."
+    reset_queries()
     start_time = time.time()
-    for i in xrange(n_sets):
-        print 'Test set %d' % i
-        test_set = TestSet.from_user(test_user, n_questions)
-    end_time = time.time()
-    test_user.delete()
-    time_taken = end_time - start_time
-    print 'Total time: %.2f' % time_taken
-    print 'Per test set: %.2f' % (time_taken / n_sets)
-    print 'Per question: %.2f' % (time_taken / (n_sets * n_questions))
-
-def _new_test_user():
-    User.objects.filter(username='test_user').delete()
-    test_user = User(username='test_user')
+    result = func(*args)
+    time_taken = time.time() - start_time
+    queries = connection.queries
+    return result, {
+            'seconds': time_taken,
+            'n_queries': len(queries),
+            'n_inserts': _count_inserts(queries),
+        }
+
+def _percentile(sorted_values, p):
+    "Nearest-rank percentile of an already sorted list."
+    i = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(i, 0)]
+
+def _count_inserts(queries):
+    return len([q for q in queries if
+            q['sql'].lstrip().upper().startswith('INSERT')])
+
+def _new_test_user(syllabus):
+    username = 'benchmark_%d' % syllabus.id
+    User.objects.filter(username=username).delete()
+    test_user = User(username=username)
     test_user.save()
-    test_user.userprofile_set.create(syllabus=Syllabus.objects.all(
-            ).order_by('?')[0])
+    test_user.userprofile_set.create(syllabus=syllabus)
     ErrorDist.init_from_priors(test_user)
 
     return test_user
@@ -49,19 +192,32 @@ def _new_test_user():
 
 def _create_option_parser():
     usage = \
-"""%prog [options] 
+"""%prog [options]
 
-Benchmarks test-set creation."""
+Benchmarks question generation and error model updates, per question plugin,
+pivot type and syllabus."""
 
     parser = optparse.OptionParser(usage)
 
+    parser.add_option('-i', '--items', action='store', dest='n_items',
+            type='int', help='The number of items per syllabus [50]',
+            default=50)
+
     parser.add_option('-n', '--nsets', action='store', dest='n_sets',
-            type='int', help='The number of test sets to generate [10]',
-            default=10)
-    
-    parser.add_option('-q', '--questions', action='store', dest='n_questions',
-            type='int', help='The number of questions to generate [10]',
-            default=10)
+            type='int', help='The number of test sets per syllabus [0]',
+            default=0)
+
+    parser.add_option('-s', '--syllabus', action='append', dest='syllabi',
+            help='Only benchmark the given syllabus (repeatable).')
+
+    parser.add_option('-p', '--plugin', action='append', dest='plugins',
+            help='Only benchmark the given plugin path (repeatable).')
+
+    parser.add_option('--seed', action='store', dest='seed', type='int',
+            help='Seed the random number generators, for repeatable runs.')
+
+    parser.add_option('-j', '--json', action='store', dest='json_file',
+            help='Write the samples and their summary to the given file.')
 
     parser.add_option('-o', '--output', action='store', dest='filename',
             help='Store profiling information to the given file.')
@@ -76,12 +232,38 @@ def main(argv):
         parser.print_help()
         sys.exit(1)
 
+    if options.seed is not None:
+        random.seed(options.seed)
+        # ArrayProbDist samples with numpy's generator.
+        numpy.random.seed(options.seed)
+
+    bench_args = (options.n_items, options.n_sets, options.syllabi,
+            options.plugins)
     if options.filename:
-        User.objects.filter(username='test_user').delete()
-        cProfile.runctx('benchmark(options.n_sets, options.n_questions)',
+        result = {}
+        cProfile.runctx('result["samples"] = benchmark(*bench_args)',
                 globals(), locals(), options.filename)
+        samples = result['samples']
     else:
-        benchmark(options.n_sets, options.n_questions)
+        samples = benchmark(*bench_args)
+
+    summary = summarise(samples)
+    print_summary(summary)
+
+    if options.json_file:
+        ostream = open(options.json_file, 'w')
+        simplejson.dump({
+                'database': connection.vendor,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'options': {
+                    'n_items': options.n_items,
+                    'n_sets': options.n_sets,
+                    'seed': options.seed,
+                },
+                'summary': summary,
+                'samples': samples,
+            }, ostream, indent=2, sort_keys=True)
+        ostream.close()
     return
 
 #----------------------------------------------------------------------------#
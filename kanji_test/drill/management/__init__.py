@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# 
+#  __init__.py
+#  kanji_test
+#  
+#  Created by agent on 2026-10-17.
+# 
+
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# 
+#  apply_updates.py
+#  kanji_test
+#  
+#  Created by agent on 2026-10-17.
+# 
+
+"""
+A command to apply queued error model updates.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.conf import settings
+
+from kanji_test.drill.models import PendingUpdate
+
+class Command(NoArgsCommand):
+    help = "Applies queued error model updates from user responses."
+    requires_model_validation = True
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=settings.UPDATE_BATCH_SIZE,
+            help='The number of updates to apply at once.'),
+        make_option('--watch', action='store_true', dest='watch',
+            default=False,
+            help='Keep running, polling the queue for new updates.'),
+        make_option('--interval', action='store', dest='interval',
+            type='float', default=1.0,
+            help='Seconds to wait between polls when watching.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        while True:
+            n_applied = PendingUpdate.apply_batch(batch_size)
+            if n_applied:
+                continue
+
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.drill.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        "Adds a queue of pending error model updates."
+        # Mock Models
+        MultipleChoiceResponse = db.mock_model(model_name='MultipleChoiceResponse', db_table='drill_multiplechoiceresponse', db_tablespace='', pk_field_name='response_ptr', pk_field_type=models.OneToOneField, pk_field_args=[Response], pk_field_kwargs={})
+        
+        # Model 'PendingUpdate'
+        db.create_table('drill_pendingupdate', (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            ('response', models.ForeignKey(MultipleChoiceResponse, unique=True)),
+            ('timestamp', models.DateTimeField(auto_now_add=True)),
+        ))
+    
+    def backwards(self, orm):
+        db.delete_table('drill_pendingupdate')
+    
+    complete_apps = ['drill']
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.drill.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        "Adds weighted distractor pools for non-adaptive plugins."
+        # Mock Models
+        Syllabus = db.mock_model(model_name='Syllabus', db_table='user_model_syllabus', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        QuestionPlugin = db.mock_model(model_name='QuestionPlugin', db_table='drill_questionplugin', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        
+        # Model 'DistractorOption'
+        db.create_table('drill_distractoroption', (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            ('syllabus', models.ForeignKey(Syllabus)),
+            ('question_plugin', models.ForeignKey(QuestionPlugin)),
+            ('pivot', models.CharField(max_length=60)),
+            ('pivot_type', models.CharField(max_length=1)),
+            ('value', models.CharField(max_length=200)),
+            ('annotation', models.CharField(max_length=100, null=True, blank=True)),
+            ('weight', models.FloatField()),
+        ))
+        db.create_index('drill_distractoroption', ['syllabus_id','question_plugin_id','pivot_type','pivot'], db_tablespace='')
+        
+    def backwards(self, orm):
+        db.delete_table('drill_distractoroption')
+    
+    complete_apps = ['drill']
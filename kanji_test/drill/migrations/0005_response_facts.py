@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.drill.models import *
+
+class Migration:
+
+    def forwards(self, orm):
+        "Adds a denormalised fact table of responses, filled from the log."
+        # Mock Models
+        MultipleChoiceResponse = db.mock_model(model_name='MultipleChoiceResponse', db_table='drill_multiplechoiceresponse', db_tablespace='', pk_field_name='response_ptr', pk_field_type=models.OneToOneField, pk_field_args=[], pk_field_kwargs={})
+        User = db.mock_model(model_name='User', db_table='auth_user', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        TestSet = db.mock_model(model_name='TestSet', db_table='drill_testset', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        Question = db.mock_model(model_name='Question', db_table='drill_question', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        QuestionPlugin = db.mock_model(model_name='QuestionPlugin', db_table='drill_questionplugin', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        MultipleChoiceOption = db.mock_model(model_name='MultipleChoiceOption', db_table='drill_multiplechoiceoption', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+
+        # Model 'ResponseFact'
+        db.create_table('drill_responsefact', (
+            ('response', models.OneToOneField(MultipleChoiceResponse, primary_key=True)),
+            ('user', models.ForeignKey(User)),
+            ('test_set', models.ForeignKey(TestSet, null=True, blank=True)),
+            ('question', models.ForeignKey(Question)),
+            ('question_plugin', models.ForeignKey(QuestionPlugin)),
+            ('pivot', models.CharField(max_length=30)),
+            ('pivot_id', models.IntegerField(db_index=True)),
+            ('pivot_type', models.CharField(max_length=1)),
+            ('option', models.ForeignKey(MultipleChoiceOption)),
+            ('is_correct', models.BooleanField()),
+            ('timestamp', models.DateTimeField(db_index=True)),
+        ))
+        db.create_index('drill_responsefact', ['user_id','timestamp'], db_tablespace='')
+        db.create_index('drill_responsefact', ['pivot_type','pivot_id'], db_tablespace='')
+
+        # Fill it from the existing response log.
+        db.execute("""
+            INSERT INTO drill_responsefact (response_id, user_id,
+                test_set_id, question_id, question_plugin_id, pivot, pivot_id,
+                pivot_type, option_id, is_correct, timestamp)
+            SELECT r.id, r.user_id, tsr.testset_id, q.id,
+                q.question_plugin_id, q.pivot, q.pivot_id, q.pivot_type, o.id,
+                o.is_correct, r.timestamp
+            FROM drill_response AS r
+            INNER JOIN drill_multiplechoiceresponse AS mcr
+            ON mcr.response_ptr_id = r.id
+            INNER JOIN drill_multiplechoiceoption AS o
+            ON o.id = mcr.option_id
+            INNER JOIN drill_question AS q
+            ON q.id = r.question_id
+            LEFT JOIN (
+                SELECT multiplechoiceresponse_id, MIN(testset_id) AS testset_id
+                FROM drill_testset_responses
+                GROUP BY multiplechoiceresponse_id
+            ) AS tsr
+            ON tsr.multiplechoiceresponse_id = r.id
+        """)
+
+    def backwards(self, orm):
+        db.delete_table('drill_responsefact')
+
+    complete_apps = ['drill']
@@ -7,10 +7,12 @@
 #  Copyright 2008 Lars Yencken. All rights reserved.
 # 
 
+import sys
 import random
 import traceback
 
-from django.db import models
+from django.db import models, connection, transaction, DatabaseError
+from simplestats.sequences import groups_of_n
 from django.core.mail import send_mail
 from django.contrib.auth import models as auth_models
 from django.conf import settings
@@ -22,6 +24,78 @@ from kanji_test.util import html
 from kanji_test.user_model import models as usermodel_models
 from kanji_test.user_model import plugin_api
 
+def _insert_rows(cursor, table_name, field_names, rows, with_ids=False):
+    """
+    Inserts the given rows into the table with a single multi-row INSERT.
+    With with_ids, returns the ids assigned to them in row order.
+    """
+    if not rows:
+        return []
+    quote_name = connection.ops.quote_name
+    row_sql = '(%s)' % ', '.join(['%s'] * len(field_names))
+    cursor.execute('INSERT INTO %s (%s) VALUES %s' % (
+                quote_name(table_name),
+                ', '.join(map(quote_name, field_names)),
+                ', '.join([row_sql] * len(rows)),
+            ),
+            [value for row in rows for value in row],
+        )
+    ids = None
+    if with_ids:
+        try:
+            ids = _get_inserted_ids(cursor, table_name, field_names, rows)
+        except:
+            transaction.rollback_unless_managed()
+            raise
+    transaction.commit_unless_managed()
+    return ids
+
+def _get_inserted_ids(cursor, table_name, field_names, rows):
+    """
+    Finds the ids of rows just inserted by a multi-row INSERT. A statement's
+    ids are expected in row order, auto_increment_increment apart on MySQL,
+    but are read back and checked against the rows. If any differ, a
+    DatabaseError is raised rather than risk pointing at the wrong rows.
+    """
+    last_id = connection.ops.last_insert_id(cursor, table_name, 'id')
+    if connection.vendor == 'mysql':
+        # MySQL reports the id of the first row in the statement.
+        cursor.execute('SELECT @@auto_increment_increment')
+        step = int(cursor.fetchone()[0])
+        first_id = last_id
+    else:
+        step = 1
+        first_id = last_id - len(rows) + 1
+    ids = range(first_id, first_id + step * len(rows), step)
+
+    quote_name = connection.ops.quote_name
+    stored_rows = {}
+    for id_group in groups_of_n(500, ids):
+        cursor.execute('SELECT %s FROM %s WHERE %s IN (%s)' % (
+                    ', '.join(map(quote_name, ['id'] + field_names)),
+                    quote_name(table_name),
+                    quote_name('id'),
+                    ', '.join(['%s'] * len(id_group)),
+                ),
+                id_group,
+            )
+        for row in cursor.fetchall():
+            stored_rows[row[0]] = map(_as_stored, row[1:])
+
+    for row_id, row in zip(ids, rows):
+        if stored_rows.get(row_id) != map(_as_stored, row):
+            raise DatabaseError('rows inserted into %s were not given the '
+                    'expected ids' % table_name)
+    return ids
+
+def _as_stored(value):
+    "Normalises a column value so that it compares equal once read back."
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        return value.decode('utf8')
+    return value
+
 class QuestionPlugin(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField()
@@ -36,27 +110,75 @@ class QuestionPlugin(models.Model):
         Update our error model given this response. May fail silently
         and attempt to notify admins of an error.
         """
-        if not self.is_adaptive:
+        self.update_many([response])
+
+    def update_many(self, responses):
+        """
+        Update our error model given this sequence of responses, in order.
+        Each user's responses are applied in a transaction of their own. If
+        they fail, it is rolled back and only that user's responses are
+        retried, each on its own, so that one bad response cannot block the
+        rest.
+        """
+        if not self.is_adaptive or not responses:
             return
-        plugin_map = plugin_api.load_plugins()
+        plugin_obj = plugin_api.load_plugins()[self.uses_dist]
+
+        user_responses = {}
+        for response in responses:
+            user_responses.setdefault(response.user_id, []).append(response)
+
+        for user_response_list in user_responses.itervalues():
+            if self._update_user(plugin_obj, user_response_list,
+                    report=(len(user_response_list) == 1)):
+                continue
+
+            for response in user_response_list:
+                self._update_user(plugin_obj, [response])
+        return
+
+    @transaction.commit_manually
+    def _update_user(self, plugin_obj, responses, report=True):
+        """
+        Applies responses from a single user and removes them from the update
+        queue in one transaction, rolling it back if any response fails.
+        With report set, a failure is reported and the responses are dropped
+        from the queue. Returns True on success.
+        """
+        response_ids = [r.id for r in responses]
         try:
-            plugin_map[self.uses_dist].update(response)
+            plugin_obj.update_many(responses)
+            PendingUpdate.objects.filter(response__in=response_ids).delete()
         except:
-            if settings.DEPLOYED:
-                error_message = "In updating %s:\n\n%s" % (
-                        self.uses_dist,
-                        traceback.format_exc(),
-                    )
-                send_mail(
-                        'Error at kanjitester.gakusha.info',
-                        error_message,
-                        settings.DEFAULT_FROM_EMAIL,
-                        [settings.DEFAULT_FROM_EMAIL],
-                        fail_silently=not settings.DEBUG,
-                    )
-            else:
-                raise
-        return
+            exc_info = sys.exc_info()
+            transaction.rollback()
+            usermodel_models.ErrorDist.invalidate_user(responses[0].user_id)
+            if report:
+                PendingUpdate.objects.filter(response__in=response_ids
+                        ).delete()
+                transaction.commit()
+                self._report_error(exc_info)
+            return False
+
+        transaction.commit()
+        return True
+
+    def _report_error(self, exc_info):
+        "Mails the given exception to the admins, or re-raises it."
+        if not settings.DEPLOYED:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        error_message = "In updating %s:\n\n%s" % (
+                self.uses_dist,
+                ''.join(traceback.format_exception(*exc_info)),
+            )
+        send_mail(
+                'Error at kanjitester.gakusha.info',
+                error_message,
+                settings.DEFAULT_FROM_EMAIL,
+                [settings.DEFAULT_FROM_EMAIL],
+                fail_silently=not settings.DEBUG,
+            )
 
 PIVOT_TYPES = (
         ('k', 'kanji'),
@@ -162,14 +284,61 @@ class MultipleChoiceQuestion(Question):
         if len(set(distractor_values + [answer])) < len(distractor_values) + 1:
             raise ValueError('all option values must be unique')
 
-        for i, option_value in enumerate(distractor_values):
-            self.options.create(
+        self.pending_options = [MultipleChoiceOption(
                     value=option_value,
                     is_correct=False,
                     annotation=annotation_map.get(option_value),
-                )
-        self.options.create(value=answer, is_correct=True,
-                annotation=annotation_map.get(answer))
+                ) for option_value in distractor_values]
+        self.pending_options.append(MultipleChoiceOption(value=answer,
+                is_correct=True, annotation=annotation_map.get(answer)))
+
+        if self.id is not None:
+            # Already stored, so store the options immediately.
+            self._save_pending_options()
+
+    def save(self, *args, **kwargs):
+        "Saves this question, and any options which are yet to be stored."
+        super(MultipleChoiceQuestion, self).save(*args, **kwargs)
+        self._save_pending_options()
+
+    def _save_pending_options(self):
+        pending_options = getattr(self, 'pending_options', None)
+        if pending_options:
+            for option in pending_options:
+                option.question_id = self.id
+            MultipleChoiceOption.save_many(pending_options)
+            self.pending_options = []
+
+    @classmethod
+    def save_many(cls, questions):
+        """
+        Stores a batch of unsaved questions and their pending options, using
+        one multi-row INSERT per table rather than one per object.
+        """
+        cursor = connection.cursor()
+        question_ids = _insert_rows(cursor, Question._meta.db_table,
+                ['pivot', 'pivot_id', 'pivot_type', 'question_type',
+                'question_plugin_id', 'annotation'],
+                [(q.pivot, q.pivot_id, q.pivot_type, q.question_type,
+                q.question_plugin_id, q.annotation) for q in questions],
+                with_ids=True,
+            )
+        for question, question_id in zip(questions, question_ids):
+            question.id = question.question_ptr_id = question_id
+
+        _insert_rows(cursor, cls._meta.db_table,
+                ['question_ptr_id', 'stimulus'],
+                [(q.id, q.stimulus) for q in questions],
+            )
+
+        options = []
+        for question in questions:
+            for option in getattr(question, 'pending_options', []):
+                option.question_id = question.id
+                options.append(option)
+            question.pending_options = []
+        MultipleChoiceOption.save_many(options)
+        return
 
 class MultipleChoiceOption(models.Model):
     """A single option in a multiple choice question."""
@@ -188,6 +357,95 @@ class MultipleChoiceOption(models.Model):
                 (self.is_correct and 'correct' or 'incorrect'),
             )
 
+    @classmethod
+    def save_many(cls, options):
+        "Stores a batch of unsaved options with a single multi-row INSERT."
+        option_ids = _insert_rows(connection.cursor(), cls._meta.db_table,
+                ['question_id', 'value', 'is_correct', 'annotation'],
+                [(o.question_id, o.value, o.is_correct, o.annotation)
+                for o in options],
+                with_ids=True,
+            )
+        for option, option_id in zip(options, option_ids):
+            option.id = option_id
+        return
+
+class DistractorOption(models.Model):
+    """
+    A precomputed distractor for questions about a single pivot. The options
+    stored for a pivot form its pool, which non-adaptive plugins draw from
+    instead of sampling distractors each time.
+    """
+    syllabus = models.ForeignKey(usermodel_models.Syllabus)
+    question_plugin = models.ForeignKey(QuestionPlugin)
+    pivot = models.CharField(max_length=60)
+    pivot_type = models.CharField(max_length=1, choices=PIVOT_TYPES)
+    value = models.CharField(max_length=200)
+    annotation = models.CharField(max_length=100, null=True, blank=True)
+    weight = models.FloatField(
+        help_text="The relative chance of drawing this option from the pool.")
+
+    def __unicode__(self):
+        return u'%s for %s %s' % (self.value, self.get_pivot_type_display(),
+                self.pivot)
+
+    @classmethod
+    def get_pool(cls, syllabus_id, question_plugin, pivot, pivot_type):
+        "Returns the (value, annotation, weight) triples in a pivot's pool."
+        return list(cls.objects.filter(syllabus__id=syllabus_id,
+                question_plugin=question_plugin, pivot_type=pivot_type,
+                pivot=pivot).values_list('value', 'annotation', 'weight'))
+
+    @classmethod
+    def store(cls, syllabus, question_plugin, pools):
+        """
+        Replaces the stored pools for this syllabus and plugin, given a
+        sequence of (pivot, pivot_type, options) tuples, where options are
+        (value, annotation, weight) triples. Repeated pivots and values, and
+        any too long to store, are skipped. Returns the number of pools
+        stored.
+        """
+        cls.objects.filter(syllabus=syllabus,
+                question_plugin=question_plugin).delete()
+        stored = set()
+        max_length = dict((f, cls._meta.get_field(f).max_length) for f in
+                ('pivot', 'value', 'annotation'))
+
+        def iter_rows():
+            for pivot, pivot_type, options in pools:
+                if (pivot, pivot_type) in stored or \
+                        len(pivot) > max_length['pivot']:
+                    continue
+
+                values = set()
+                for value, annotation, weight in options:
+                    if value in values or \
+                            len(value) > max_length['value'] or \
+                            len(annotation or u'') > max_length['annotation']:
+                        continue
+                    values.add(value)
+                    yield (syllabus.id, question_plugin.id, pivot,
+                            pivot_type, value, annotation, weight)
+
+                if values:
+                    stored.add((pivot, pivot_type))
+
+        quote_name = connection.ops.quote_name
+        cursor = connection.cursor()
+        for row_set in groups_of_n(settings.N_ROWS_PER_INSERT, iter_rows()):
+            cursor.executemany(
+                    """
+                    INSERT INTO %s (%s)
+                    VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s)
+                    """ % (quote_name(cls._meta.db_table), ', '.join(map(
+                        quote_name, ['syllabus_id', 'question_plugin_id',
+                        'pivot', 'pivot_type', 'value', 'annotation',
+                        'weight']))),
+                    row_set
+                )
+        transaction.commit_unless_managed()
+        return len(stored)
+
 class Response(models.Model):
     """A generic response to the user."""
     question = models.ForeignKey(Question)
@@ -217,10 +475,71 @@ class MultipleChoiceResponse(Response):
     def save(self, *args, **kwargs):
         """
         Save this response, and update the error model which generated it as
-        a side-effect.
+        a side-effect. With DEFERRED_UPDATES, the update is instead queued
+        for the apply_updates command.
         """
+        created = self.id is None
         super(MultipleChoiceResponse, self).save(*args, **kwargs)
-        self.question.question_plugin.update(self)
+        ResponseFact.record(self, created=created)
+        question_plugin = self.question.question_plugin
+        if not question_plugin.is_adaptive:
+            return
+
+        if not created:
+            # Each response updates the error model only once.
+            return
+
+        if settings.DEFERRED_UPDATES:
+            PendingUpdate.objects.create(response=self)
+        else:
+            question_plugin.update(self)
+
+class PendingUpdate(models.Model):
+    """
+    A response whose error model update is queued, waiting to be applied by
+    the apply_updates management command.
+    """
+    response = models.ForeignKey(MultipleChoiceResponse, unique=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u'update for response %d' % self.response_id
+
+    @staticmethod
+    @transaction.commit_manually
+    def apply_batch(batch_size=settings.UPDATE_BATCH_SIZE):
+        """
+        Applies the oldest queued updates, coalescing updates from the same
+        plugin, and removes them from the queue. Each user's updates are
+        committed separately. Returns the number of updates applied.
+        """
+        try:
+            pending = list(PendingUpdate.objects.select_related(
+                    'response__question__question_plugin',
+                    'response__option', 'response__user')[:batch_size])
+
+            plugin_responses = {}
+            for pending_update in pending:
+                response = pending_update.response
+                question_plugin = response.question.question_plugin
+                plugin_responses.setdefault(question_plugin, []).append(
+                        response)
+
+            for question_plugin, responses in plugin_responses.iteritems():
+                question_plugin.update_many(responses)
+
+            # Drop anything left over, e.g. from a plugin no longer adaptive.
+            PendingUpdate.objects.filter(
+                    id__in=[p.id for p in pending]).delete()
+        except:
+            transaction.rollback()
+            raise
+
+        transaction.commit()
+        return len(pending)
 
 class TestSet(models.Model):
     user = models.ForeignKey(auth_models.User)
@@ -281,9 +600,6 @@ class TestSet(models.Model):
         the appropriate syllabus.
         """
         set_type, plugin_set = TestSet._get_plugin_set(user)
-        test_set = TestSet(user=user, random_seed=random.randrange(0, 2**30),
-                set_type=set_type)
-        test_set.save()
 
         from kanji_test.drill import load_plugins
         from kanji_test.drill.plugin_api import UnsupportedItem
@@ -299,14 +615,31 @@ class TestSet(models.Model):
                 i = random.randrange(len(available_plugins))
                 chosen_plugin = available_plugins[i]
                 try:
-                    question = chosen_plugin.get_question(item, user)
+                    question = chosen_plugin.get_unsaved_question(item, user)
                     questions.append(question)
                 except UnsupportedItem:
                     # Oh well, try again with another plugin
                     del available_plugins[i]
 
-        test_set.questions = questions
+        test_set = TestSet(user=user, random_seed=random.randrange(0, 2**30),
+                set_type=set_type)
+        TestSet._save_with_questions(test_set, questions)
         return test_set
+
+    @staticmethod
+    @transaction.commit_on_success
+    def _save_with_questions(test_set, questions):
+        "Stores a new test set and its questions in a single transaction."
+        test_set.save()
+        MultipleChoiceQuestion.save_many(questions)
+        questions_field = TestSet._meta.get_field('questions')
+        _insert_rows(connection.cursor(),
+                questions_field.rel.through._meta.db_table,
+                [questions_field.m2m_column_name(),
+                questions_field.m2m_reverse_name()],
+                [(test_set.id, q.id) for q in questions],
+            )
+        return
     
     def __len__(self):
         return self.questions.count()
@@ -332,3 +665,108 @@ class TestSet(models.Model):
 
         return set_type, plugin_set
 
+class ResponseFact(models.Model):
+    """
+    A denormalised copy of each multiple choice response, with everything
+    about its question and chosen option that analyses need. It is kept up
+    to date as responses are saved and added to test sets, so that usage
+    statistics can be read from this one table.
+    """
+    response = models.OneToOneField(MultipleChoiceResponse, primary_key=True,
+            related_name='fact')
+    user = models.ForeignKey(auth_models.User)
+    test_set = models.ForeignKey(TestSet, null=True, blank=True,
+            on_delete=models.SET_NULL)
+    question = models.ForeignKey(Question)
+    question_plugin = models.ForeignKey(QuestionPlugin)
+    pivot = models.CharField(max_length=30)
+    pivot_id = models.IntegerField(db_index=True)
+    pivot_type = models.CharField(max_length=1, choices=PIVOT_TYPES)
+    option = models.ForeignKey(MultipleChoiceOption)
+    is_correct = models.BooleanField()
+    timestamp = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return u'%s: %s (%s)' % (self.user_id, self.pivot,
+                self.is_correct and 'correct' or 'incorrect')
+
+    @classmethod
+    def record(cls, response, created=True):
+        "Stores or refreshes the fact for the given response."
+        if not created:
+            cls.objects.filter(response=response.id).update(
+                    option=response.option_id,
+                    is_correct=response.option.is_correct,
+                    timestamp=response.timestamp)
+            return
+
+        question = response.question
+        cls(
+                response_id=response.id,
+                user_id=response.user_id,
+                question_id=question.id,
+                question_plugin_id=question.question_plugin_id,
+                pivot=question.pivot,
+                pivot_id=question.pivot_id,
+                pivot_type=question.pivot_type,
+                option_id=response.option_id,
+                is_correct=response.option.is_correct,
+                timestamp=response.timestamp,
+            ).save(force_insert=True)
+
+def _update_fact_test_sets(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    """
+    Keeps the test set of each response fact in step with TestSet.responses.
+    A response in several test sets is filed under the earliest of them.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        # The instance is a response, and pk_set holds test set ids.
+        response_ids = [instance.id]
+    elif action == 'post_clear':
+        response_ids = ResponseFact.objects.filter(test_set=instance.id
+                ).values_list('response', flat=True)
+    else:
+        response_ids = pk_set
+
+    _refresh_fact_test_sets(list(response_ids))
+
+def _refresh_fact_test_sets(response_ids):
+    "Files each response's fact under the lowest test set it belongs to."
+    if not response_ids:
+        return
+
+    responses_field = TestSet._meta.get_field('responses')
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT %(response_col)s, MIN(%(test_set_col)s)
+        FROM %(table)s
+        WHERE %(response_col)s IN (%(response_ids)s)
+        GROUP BY %(response_col)s
+    """ % {
+            'table': connection.ops.quote_name(
+                    responses_field.rel.through._meta.db_table),
+            'response_col': connection.ops.quote_name(
+                    responses_field.m2m_reverse_name()),
+            'test_set_col': connection.ops.quote_name(
+                    responses_field.m2m_column_name()),
+            'response_ids': ', '.join(str(int(i)) for i in response_ids),
+        })
+
+    responses_by_set = {}
+    for response_id, test_set_id in cursor.fetchall():
+        responses_by_set.setdefault(test_set_id, []).append(response_id)
+    responses_by_set[None] = set(response_ids).difference(
+            *responses_by_set.values())
+
+    for test_set_id, set_response_ids in responses_by_set.iteritems():
+        if set_response_ids:
+            ResponseFact.objects.filter(response__in=set_response_ids
+                    ).update(test_set=test_set_id)
+
+models.signals.m2m_changed.connect(_update_fact_test_sets,
+        sender=TestSet.responses.through)
+
@@ -13,7 +13,7 @@ from cjktools.exceptions import NotYetImplementedError
 from cjktools import scripts
 from django.core.exceptions import ObjectDoesNotExist
 
-from kanji_test.drill import models
+from kanji_test.drill import models, support
 from kanji_test.user_model import models as usermodel_models
 
 class UnsupportedItem(Exception): pass
@@ -77,7 +77,16 @@ class QuestionFactoryI(object):
         return
 
     def get_question(self, syllabus_item, user):
-        "Fetches a question based on the given syllabus item."
+        "Fetches and stores a question based on the given syllabus item."
+        question = self.get_unsaved_question(syllabus_item, user)
+        question.save()
+        return question
+
+    def get_unsaved_question(self, syllabus_item, user):
+        """
+        Builds a question based on the given syllabus item, without storing
+        it or its options, so that it can be stored as part of a batch.
+        """
         if isinstance(syllabus_item, usermodel_models.PartialLexeme):
             return self.get_word_question(syllabus_item, user)
 
@@ -88,19 +97,46 @@ class QuestionFactoryI(object):
             raise ValueError('bad syllabus item %s' % syllabus_item)
 
     def get_word_question(self, partial_lexeme, user):
-        """Constructs and returns a new question based on the given word."""
+        """
+        Constructs and returns a new unsaved question based on the given word.
+        """
         raise NotYetImplementedError
 
     def get_kanji_question(self, partial_kanji, user):
-        """Constructs and returns a new question based on the given kanji."""
+        """
+        Constructs and returns a new unsaved question based on the given
+        kanji.
+        """
         raise NotYetImplementedError
 
 class MultipleChoiceFactoryI(QuestionFactoryI):
     """An abstract factory for multiple choice questions."""
     @classmethod
     def build_question(cls, **kwargs):
+        "Builds a new unsaved question from this plugin."
         kwargs.setdefault('question_type', cls.question_type)
         kwargs.setdefault('question_plugin', cls.get_question_plugin())
-        question = models.MultipleChoiceQuestion(**kwargs)
-        question.save()
-        return question
+        return models.MultipleChoiceQuestion(**kwargs)
+
+    def build_pools(self, syllabus):
+        """
+        Yields (pivot, pivot_type, options) for pivots in the syllabus, where
+        options is a list of (value, annotation, weight) distractors, drawn
+        in proportion to their weights. Only plugins whose distractors
+        depend solely on the syllabus item should provide pools; by default
+        there are none.
+        """
+        return []
+
+    def get_pool_options(self, user, pivot, pivot_type, exclude_set=None):
+        """
+        Draws distractors for the pivot from its precomputed pool, returning
+        (distractors, annotation_map), or None if there is no usable pool.
+        """
+        pool_options = models.DistractorOption.get_pool(
+                user.get_profile().syllabus_id, self.get_question_plugin(),
+                pivot, pivot_type)
+        if not pool_options:
+            return None
+
+        return support.sample_pool_options(pool_options, exclude_set)
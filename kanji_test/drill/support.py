@@ -11,7 +11,13 @@
 Supporting methods for drill plugins.
 """
 
+import random
+import itertools
+
+from cjktools import scripts
+
 from kanji_test import settings
+from kanji_test.util.probability import LazySeqDist, ArrayProbDist
 
 def build_kanji_options(kanji, error_dist, exclude_set=None, adaptive=True):
     exclude_set = set(exclude_set or [])
@@ -59,4 +65,104 @@ def build_word_options(segments, error_dist, exclude_set=None, adaptive=True):
 
     return distractors, annotation_map
 
+def build_kanji_pool(kanji, prior_dist, exclude_set=None, adaptive=True):
+    """
+    Returns the pool of (value, annotation, weight) distractors for the
+    kanji, which is every symbol of its prior distribution. Drawing from the
+    pool matches build_kanji_options(): options are weighted by their prior
+    probability if adaptive, and uniformly otherwise.
+    """
+    exclude_set = exclude_set or set()
+    pool = []
+    for symbol, pdf in prior_dist.get_dist(kanji).iteritems():
+        if symbol not in exclude_set:
+            if not adaptive:
+                pdf = 1.0
+            pool.append((symbol, symbol, pdf))
+    return pool
+
+def build_word_pool(segments, prior_dist, exclude_set=None, adaptive=True,
+        n=settings.DISTRACTOR_POOL_SIZE):
+    """
+    Samples a pool of up to n (value, annotation, weight) distractors for
+    the segmented word, drawing them as build_word_options() would: kanji
+    segments are varied according to the prior if adaptive, and uniformly
+    otherwise, and all other segments are kept fixed. The sampling already
+    follows the distribution, so options are weighted equally in the pool.
+    """
+    exclude_set = set(exclude_set or [])
+    seg_dists = []
+    kanji_script = scripts.Script.Kanji
+    for segment in segments:
+        if scripts.script_type(segment) == kanji_script:
+            seg_dist = prior_dist.get_dist(segment)
+            if not seg_dist:
+                # No known errors for this kanji
+                return []
+            seg_dists.append(seg_dist)
+        else:
+            seg_dists.append(segment)
+
+    if adaptive:
+        dist = LazySeqDist(*seg_dists)
+        try:
+            results = dist.sample_n(n, exclude_set)
+        except ValueError:
+            # Fewer than n are available, so take them all.
+            results = dist.top_n(n, exclude_set)
+    else:
+        results = _sample_seqs_uniform(seg_dists, n, exclude_set)
+
+    return [(u''.join(result), u'|'.join(result), 1.0) for result in results]
+
+def _sample_seqs_uniform(seg_dists, n, exclude_set):
+    """
+    Samples up to n distinct sequences which are not excluded, choosing
+    each varying segment uniformly.
+    """
+    seg_choices = []
+    n_seqs = 1
+    for seg_dist in seg_dists:
+        if isinstance(seg_dist, basestring):
+            seg_choices.append([seg_dist])
+        else:
+            seg_choices.append(seg_dist.keys())
+            n_seqs *= len(seg_choices[-1])
+
+    if n_seqs <= n + len(exclude_set):
+        # Few enough to enumerate, which also ensures we terminate.
+        results = [r for r in itertools.product(*seg_choices)
+                if u''.join(r) not in exclude_set]
+        return random.sample(results, min(n, len(results)))
+
+    results = []
+    exclude_set = set(exclude_set)
+    while len(results) < n:
+        result = tuple(random.choice(choices) for choices in seg_choices)
+        flat_result = u''.join(result)
+        if flat_result not in exclude_set:
+            exclude_set.add(flat_result)
+            results.append(result)
+    return results
+
+def sample_pool_options(pool_options, exclude_set=None):
+    """
+    Draws N_DISTRACTORS options without replacement from a precomputed pool
+    of (value, annotation, weight) triples, in proportion to their weights.
+    Returns (distractors, annotation_map), or None if the pool has too few
+    options which are not excluded.
+    """
+    exclude_set = exclude_set or set()
+    available = [(v, a, w) for (v, a, w) in pool_options
+            if v not in exclude_set]
+    if len(available) < settings.N_DISTRACTORS:
+        return None
+
+    dist = ArrayProbDist([v for (v, a, w) in available],
+            [w for (v, a, w) in available])
+    distractors = dist.sample_n(settings.N_DISTRACTORS)
+    annotations = dict((v, a) for (v, a, w) in available)
+    annotation_map = dict((v, annotations[v]) for v in distractors)
+    return distractors, annotation_map
+
 # vim: ts=4 sw=4 sts=4 et tw=78:
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+#  tests.py
+#  kanji_test
+#
+#  Created by agent on 2026-10-17.
+#
+
+from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.contrib.auth import models as auth_models
+
+from kanji_test.drill import models, support
+from kanji_test.user_model import plugin_api
+from kanji_test.user_model import models as usermodel_models
+from kanji_test.util import probability
+from kanji_test.util.probability import ProbDist
+from kanji_test.analysis import stats
+
+class RecordingPlugin(object):
+    """
+    A stand-in error model which records the responses it is given. Like
+    the real plugins, it applies a user's responses all at once or not at
+    all.
+    """
+    dist_name = 'recording'
+
+    def __init__(self):
+        self.calls = []
+        self.applied = []
+        self.bad_ids = set()
+
+    def update(self, response):
+        self.update_many([response])
+
+    def update_many(self, responses):
+        response_ids = [r.id for r in responses]
+        self.calls.append(response_ids)
+        if self.bad_ids.intersection(response_ids):
+            raise plugin_api.UpdateError('bad response')
+        self.applied.extend(response_ids)
+
+class DrillTestMixin(object):
+    "Sets up an adaptive plugin whose updates are recorded."
+    def setUp(self):
+        self.plugin_obj = RecordingPlugin()
+        self._old_plugins = plugin_api._cached_plugins
+        plugin_api._cached_plugins = dict(plugin_api.load_plugins())
+        plugin_api._cached_plugins[RecordingPlugin.dist_name] = \
+                self.plugin_obj
+        self._old_settings = (settings.DEFERRED_UPDATES, settings.DEPLOYED)
+
+        self.question_plugin = models.QuestionPlugin.objects.create(
+                name='recording', description='Records updates.',
+                uses_dist=RecordingPlugin.dist_name, is_adaptive=True)
+        self.static_plugin = models.QuestionPlugin.objects.create(
+                name='static', description='Never updates.',
+                uses_dist=RecordingPlugin.dist_name, is_adaptive=False)
+        self.users = [auth_models.User.objects.create(username=name)
+                for name in ('alice', 'bob')]
+
+    def tearDown(self):
+        plugin_api._cached_plugins = self._old_plugins
+        settings.DEFERRED_UPDATES, settings.DEPLOYED = self._old_settings
+
+    def _respond(self, user, question_plugin=None, is_correct=True):
+        question = models.MultipleChoiceQuestion(pivot=u'犬', pivot_id=1,
+                pivot_type='k', question_type='pr',
+                question_plugin=question_plugin or self.question_plugin,
+                stimulus=u'犬')
+        question.add_options([u'ねこ'], u'いぬ')
+        question.save()
+        return models.MultipleChoiceResponse.objects.create(
+                question=question, user=user,
+                option=question.options.get(is_correct=is_correct))
+
+class DrillTestCase(DrillTestMixin, TestCase):
+    pass
+
+class UpdateTest(DrillTestCase):
+    def test_deferred(self):
+        settings.DEFERRED_UPDATES = True
+        response = self._respond(self.users[0])
+        self._respond(self.users[0], question_plugin=self.static_plugin)
+        self.assertEqual(self.plugin_obj.calls, [])
+        self.assertEqual(
+                [p.response_id for p in models.PendingUpdate.objects.all()],
+                [response.id])
+
+    def test_synchronous(self):
+        settings.DEFERRED_UPDATES = False
+        response = self._respond(self.users[0])
+        self._respond(self.users[0], question_plugin=self.static_plugin)
+        self.assertEqual(self.plugin_obj.applied, [response.id])
+        self.assertEqual(models.PendingUpdate.objects.count(), 0)
+
+    def test_resave(self):
+        settings.DEFERRED_UPDATES = True
+        response = self._respond(self.users[0])
+        response.save()
+        self.assertEqual(models.PendingUpdate.objects.count(), 1)
+
+        settings.DEFERRED_UPDATES = False
+        response = self._respond(self.users[1])
+        response.save()
+        self.assertEqual(self.plugin_obj.applied, [response.id])
+
+    def test_apply_batch_coalesces_by_user(self):
+        settings.DEFERRED_UPDATES = True
+        alice, bob = self.users
+        responses = [self._respond(user) for user in (alice, bob, alice)]
+
+        self.assertEqual(models.PendingUpdate.apply_batch(2), 2)
+        self.assertEqual(sorted(self.plugin_obj.calls),
+                [[responses[0].id], [responses[1].id]])
+        self.assertEqual(models.PendingUpdate.objects.count(), 1)
+
+        self.assertEqual(models.PendingUpdate.apply_batch(), 1)
+        self.assertEqual(models.PendingUpdate.apply_batch(), 0)
+        self.assertEqual(sorted(self.plugin_obj.applied),
+                sorted(r.id for r in responses))
+
+    def test_apply_batch_retries_failed_user(self):
+        settings.DEFERRED_UPDATES = True
+        settings.DEPLOYED = True
+        alice, bob = self.users
+        alice_responses = [self._respond(alice) for i in xrange(3)]
+        bob_response = self._respond(bob)
+        bad_response = alice_responses[1]
+        self.plugin_obj.bad_ids.add(bad_response.id)
+
+        self.assertEqual(models.PendingUpdate.apply_batch(), 4)
+
+        # Bob's update was applied once, and not retried.
+        self.assertEqual(self.plugin_obj.calls.count([bob_response.id]), 1)
+        # Each of Alice's good responses was applied exactly once.
+        self.assertEqual(sorted(self.plugin_obj.applied),
+                sorted(r.id for r in alice_responses + [bob_response]
+                    if r != bad_response))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(models.PendingUpdate.objects.count(), 0)
+
+    def test_apply_updates_command(self):
+        settings.DEFERRED_UPDATES = True
+        responses = [self._respond(user) for user in self.users]
+        call_command('apply_updates', batch_size=1)
+        self.assertEqual(sorted(self.plugin_obj.applied),
+                sorted(r.id for r in responses))
+        self.assertEqual(models.PendingUpdate.objects.count(), 0)
+
+class SegmentedPlugin(plugin_api.SegmentedSeqPlugin):
+    dist_name = 'segmented'
+
+class SegmentedUpdateTest(DrillTestMixin, TransactionTestCase):
+    "Applies real error model updates, which must be rolled back on failure."
+    def setUp(self):
+        DrillTestMixin.setUp(self)
+        self.plugin_obj = SegmentedPlugin()
+        plugin_api._cached_plugins[SegmentedPlugin.dist_name] = \
+                self.plugin_obj
+        self.question_plugin.uses_dist = SegmentedPlugin.dist_name
+        self.question_plugin.save()
+        settings.DEFERRED_UPDATES = True
+        self._old_save_dist_to = probability._save_dist_to
+
+        for user in self.users:
+            usermodel_models.ErrorDist.invalidate_user(user.id)
+            error_dist = usermodel_models.ErrorDist.objects.create(user=user,
+                    tag=SegmentedPlugin.dist_name)
+            error_dist.set_dists({
+                    u'日': ProbDist({u'に': 0.6, u'ひ': 0.3, u'か': 0.1}),
+                    u'本': ProbDist({u'ほん': 0.8, u'もと': 0.2}),
+                })
+
+    def tearDown(self):
+        probability._save_dist_to = self._old_save_dist_to
+        DrillTestMixin.tearDown(self)
+
+    def _respond(self, user, answer):
+        annotations = {u'にほん': u'に|ほん', u'ひもと': u'ひ|もと',
+                u'かほん': u'か|ほん'}
+        question = models.MultipleChoiceQuestion(pivot=u'日本', pivot_id=1,
+                pivot_type='w', question_type='pr',
+                question_plugin=self.question_plugin, stimulus=u'日本',
+                annotation=u'日|本')
+        question.add_options([u'ひもと', u'かほん'], u'にほん', annotations)
+        question.save()
+        return models.MultipleChoiceResponse.objects.create(
+                question=question, user=user,
+                option=question.options.get(value=answer))
+
+    def _get_densities(self, user):
+        return dict(((r['condition'], r['symbol']), r['pdf']) for r in
+                usermodel_models.ErrorPdf.objects.filter(dist__user=user,
+                    dist__tag=SegmentedPlugin.dist_name).values('condition',
+                    'symbol', 'pdf'))
+
+    def test_failed_write_rolls_back(self):
+        alice, bob = self.users
+        for answer in (u'ひもと', u'かほん'):
+            self._respond(bob, answer)
+        self.assertEqual(models.PendingUpdate.apply_batch(), 2)
+        expected = self._get_densities(bob)
+        self.assertNotEqual(expected, self._get_densities(alice))
+
+        # Fail on the second distribution written, after the first is saved.
+        calls = []
+        def failing_save_dist_to(dist, manager, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 2:
+                raise IOError('write failed')
+            self._old_save_dist_to(dist, manager, **kwargs)
+        probability._save_dist_to = failing_save_dist_to
+
+        for answer in (u'ひもと', u'かほん'):
+            self._respond(alice, answer)
+        self.assertEqual(models.PendingUpdate.apply_batch(), 2)
+
+        # The partial write was undone, and each response applied once.
+        self.assertEqual(len(calls), 6)
+        densities = self._get_densities(alice)
+        self.assertEqual(sorted(densities), sorted(expected))
+        for key, pdf in expected.iteritems():
+            self.assertAlmostEqual(densities[key], pdf)
+        self.assertEqual(models.PendingUpdate.objects.count(), 0)
+
+class FixedPrior(object):
+    "A stand-in prior distribution with fixed conditional distributions."
+    def __init__(self, dists):
+        self.dists = dists
+
+    def get_dist(self, condition):
+        return ProbDist(self.dists.get(condition, {}))
+
+class PoolTest(DrillTestCase):
+    def setUp(self):
+        DrillTestCase.setUp(self)
+        self.prior = FixedPrior({
+                u'日': {u'ひ': 0.6, u'にち': 0.3, u'か': 0.1, u'じつ': 0.0},
+                u'本': {u'ほん': 0.9, u'もと': 0.1},
+            })
+
+    def test_kanji_pool_weights(self):
+        uniform = support.build_kanji_pool(u'日', self.prior,
+                exclude_set=set([u'ひ']), adaptive=False)
+        self.assertEqual(sorted(v for (v, a, w) in uniform),
+                sorted([u'にち', u'か', u'じつ']))
+        self.assertEqual(set(w for (v, a, w) in uniform), set([1.0]))
+
+        weighted = dict((v, w) for (v, a, w) in
+                support.build_kanji_pool(u'日', self.prior))
+        self.assertAlmostEqual(weighted[u'にち'], 0.3)
+        self.assertAlmostEqual(weighted[u'じつ'], 0.0)
+
+    def test_word_pool(self):
+        for adaptive in (True, False):
+            pool = support.build_word_pool([u'日', u'本'], self.prior,
+                    exclude_set=set([u'にほん']), adaptive=adaptive)
+            values = [v for (v, a, w) in pool]
+            # Only seven of the eight combinations are left.
+            self.assertEqual(len(values), 7)
+            self.assertEqual(len(set(values)), 7)
+            self.assert_(u'にほん' not in values)
+            for value, annotation, weight in pool:
+                self.assertEqual(u''.join(annotation.split(u'|')), value)
+
+    def test_sample_pool_options(self):
+        pool = [(u'a', u'x', 1.0), (u'b', None, 1.0), (u'c', None, 0.0),
+                (u'd', None, 1.0), (u'e', None, 1.0), (u'f', None, 1.0),
+                (u'g', None, 1.0)]
+        for i in xrange(20):
+            distractors, annotation_map = support.sample_pool_options(pool,
+                    exclude_set=set([u'g']))
+            self.assertEqual(sorted(distractors), [u'a', u'b', u'd', u'e',
+                    u'f'])
+            self.assertEqual(annotation_map[u'a'], u'x')
+        self.assertEqual(support.sample_pool_options(pool,
+                exclude_set=set([u'a', u'b', u'c'])), None)
+
+    def test_store(self):
+        syllabus = usermodel_models.Syllabus.objects.create(tag='pools')
+        n_pools = models.DistractorOption.store(syllabus,
+                self.static_plugin, [
+                    (u'犬', 'k', [(u'a\tb', u'a|b', 0.5), (u'c\nd', None,
+                            0.5), (u'e' * 201, None, 1.0)]),
+                    (u'犬', 'k', [(u'f', None, 1.0)]),
+                    (u'猫' * 61, 'w', [(u'g', None, 1.0)]),
+                    (u'猫', 'w', []),
+                ])
+        self.assertEqual(n_pools, 1)
+        self.assertEqual(sorted(models.DistractorOption.get_pool(
+                    syllabus.id, self.static_plugin, u'犬', 'k')),
+                [(u'a\tb', u'a|b', 0.5), (u'c\nd', None, 0.5)])
+
+        # Storing again replaces the old pools.
+        models.DistractorOption.store(syllabus, self.static_plugin,
+                [(u'猫', 'w', [(u'g', None, 1.0)])])
+        self.assertEqual(models.DistractorOption.get_pool(syllabus.id,
+                self.static_plugin, u'犬', 'k'), [])
+
+class ResponseFactTest(DrillTestCase):
+    def _respond(self, user, is_correct=True):
+        return DrillTestCase._respond(self, user,
+                question_plugin=self.static_plugin, is_correct=is_correct)
+
+    def _get_test_set(self, user):
+        return models.TestSet.objects.create(user=user, random_seed=1,
+                set_type='c')
+
+    def _get_fact_test_set_id(self, response):
+        return models.ResponseFact.objects.get(response=response.id
+                ).test_set_id
+
+    def test_record(self):
+        response = self._respond(self.users[0], is_correct=False)
+        fact = models.ResponseFact.objects.get(response=response.id)
+        self.assertEqual(fact.user_id, self.users[0].id)
+        self.assertEqual(fact.question_id, response.question_id)
+        self.assertEqual(fact.question_plugin_id, self.static_plugin.id)
+        self.assertEqual((fact.pivot, fact.pivot_id, fact.pivot_type),
+                (u'犬', 1, 'k'))
+        self.assertEqual(fact.option_id, response.option_id)
+        self.assertEqual(fact.is_correct, False)
+        self.assertEqual(fact.test_set, None)
+
+        response.option = response.question.options.get(is_correct=True)
+        response.save()
+        fact = models.ResponseFact.objects.get(response=response.id)
+        self.assertEqual(fact.option_id, response.option_id)
+        self.assertEqual(fact.is_correct, True)
+        self.assertEqual(models.ResponseFact.objects.count(), 1)
+
+    def test_test_set_changes(self):
+        user = self.users[0]
+        test_set = self._get_test_set(user)
+        responses = [self._respond(user) for i in xrange(3)]
+
+        test_set.responses.add(*responses)
+        for response in responses:
+            self.assertEqual(self._get_fact_test_set_id(response),
+                    test_set.id)
+
+        test_set.responses.remove(responses[0])
+        self.assertEqual(self._get_fact_test_set_id(responses[0]), None)
+        self.assertEqual(self._get_fact_test_set_id(responses[1]),
+                test_set.id)
+
+        test_set.responses.clear()
+        for response in responses:
+            self.assertEqual(self._get_fact_test_set_id(response), None)
+
+    def test_several_test_sets(self):
+        # Like the migration's backfill, a response in several test sets is
+        # filed under the earliest of them, whatever order they were added.
+        user = self.users[0]
+        first_set, second_set = [self._get_test_set(user) for i in (1, 2)]
+        response = self._respond(user)
+
+        second_set.responses.add(response)
+        self.assertEqual(self._get_fact_test_set_id(response), second_set.id)
+        first_set.responses.add(response)
+        self.assertEqual(self._get_fact_test_set_id(response), first_set.id)
+        second_set.responses.add(response)
+        self.assertEqual(self._get_fact_test_set_id(response), first_set.id)
+        self.assertEqual(self._get_fact_test_set_id(response),
+                self._get_backfill_test_set_id(response))
+
+        first_set.responses.remove(response)
+        self.assertEqual(self._get_fact_test_set_id(response), second_set.id)
+        response.testset_set.add(first_set)
+        self.assertEqual(self._get_fact_test_set_id(response), first_set.id)
+        first_set.responses.clear()
+        self.assertEqual(self._get_fact_test_set_id(response), second_set.id)
+        response.testset_set.clear()
+        self.assertEqual(self._get_fact_test_set_id(response), None)
+        self.assertEqual(self._get_backfill_test_set_id(response), None)
+
+    def test_test_scores_match_join(self):
+        alice, bob = self.users
+        for user, answers in ((alice, [True, False, False]),
+                (alice, [True, True]), (bob, [False])):
+            test_set = self._get_test_set(user)
+            test_set.responses.add(*[self._respond(user, is_correct=a)
+                    for a in answers])
+        self._respond(bob)
+
+        # The join the score query used before the fact table.
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT test_option.testset_id, AVG(mco.is_correct) AS score
+            FROM (
+                SELECT tsr.testset_id, mcr.option_id
+                FROM drill_testset_responses AS tsr
+                INNER JOIN drill_multiplechoiceresponse AS mcr
+                ON tsr.multiplechoiceresponse_id = mcr.response_ptr_id
+            ) AS test_option
+            INNER JOIN drill_multiplechoiceoption AS mco
+            ON test_option.option_id = mco.id
+            GROUP BY test_option.testset_id
+        """)
+        expected = sorted((i, float(s)) for (i, s) in cursor.fetchall())
+        self.assertEqual(len(expected), 3)
+        results = sorted(stats._get_test_scores())
+        self.assertEqual([i for (i, s) in results],
+                [i for (i, s) in expected])
+        for (_i, score), (_j, expected_score) in zip(results, expected):
+            self.assertAlmostEqual(score, expected_score)
+
+    def _get_backfill_test_set_id(self, response):
+        "Fetches the test set the migration's backfill would choose."
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT MIN(testset_id)
+            FROM drill_testset_responses
+            WHERE multiplechoiceresponse_id = %s
+        """, [response.id])
+        return cursor.fetchone()[0]
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
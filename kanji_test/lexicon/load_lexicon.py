@@ -12,7 +12,6 @@ from os import path
 from xml.etree import cElementTree as ElementTree
 
 from django.db import connection
-from simplestats.sequences import groups_of_n_iter
 from cjktools.common import sopen
 from cjktools import scripts
 import consoleLog
@@ -38,18 +37,11 @@ def load_lexicon(filename=_jmdict_path):
     log.log('Loading probability distributions')
     models.initialise()
     
-    log.start('Loading JMdict', nSteps=2)
+    log.log('Clearing the lexicon')
     _clear_lexicon()
-    log.log('Reading from %s' % path.basename(filename))
-    iStream = sopen(filename, 'r', 'byte')
-    data = iStream.read()
-    iStream.close()
-    log.log('Parsing XML tree')
-    tree = ElementTree.fromstring(data)
-    del data
-    log.finish()
-    
-    _store_lexemes(tree.getchildren())
+
+    log.log('Streaming from %s' % path.basename(filename))
+    _store_lexemes(_iter_lexeme_nodes(filename))
 
     log.log('Storing checksum')
     Checksum.store(_checksum_tag, _dependencies + [filename])
@@ -76,6 +68,22 @@ def _clear_lexicon():
 
 #----------------------------------------------------------------------------#
 
+def _iter_lexeme_nodes(filename):
+    """
+    Parses JMdict incrementally, yielding each entry node in turn and then
+    discarding it, so that memory use doesn't grow with the file.
+    """
+    i_stream = sopen(filename, 'r', 'byte')
+    context = iter(ElementTree.iterparse(i_stream, events=('start', 'end')))
+    _event, root = context.next()
+    for event, node in context:
+        if event == 'end' and node.tag == 'entry':
+            yield node
+            root.clear()
+    i_stream.close()
+
+#----------------------------------------------------------------------------#
+
 def _populate_stacks(lexeme_node, lexeme_id, lexeme_surface_stack,
         lexeme_sense_stack, lexeme_reading_stack):
     surface_set = set(n.find('keb').text.upper() for n in \
@@ -118,7 +126,11 @@ def _populate_stacks(lexeme_node, lexeme_id, lexeme_surface_stack,
 #----------------------------------------------------------------------------#
 
 def _store_lexemes(lexeme_nodes):
-    log.start('Storing lexemes', nSteps=6)
+    """
+    Stores the lexemes as they arrive, writing the insert stacks out in
+    batches of N_ROWS_PER_INSERT so that they never grow beyond that.
+    """
+    log.start('Storing lexemes', nSteps=2)
     cursor = connection.cursor()
 
     log.log('Clearing tables')
@@ -129,48 +141,62 @@ def _store_lexemes(lexeme_nodes):
     cursor.execute('COMMIT')
 
     next_lexeme_id = 1
+    lexeme_stack = []
     lexeme_surface_stack = []
     lexeme_sense_stack = []
     lexeme_reading_stack = []
+    stacks = (lexeme_stack, lexeme_surface_stack, lexeme_reading_stack,
+            lexeme_sense_stack)
 
-    log.log('Building insert stacks')
+    max_rows = settings.N_ROWS_PER_INSERT
     for lexeme_node in lexeme_nodes:
+        lexeme_stack.append(next_lexeme_id)
         _populate_stacks(lexeme_node, next_lexeme_id, lexeme_surface_stack,
                 lexeme_sense_stack, lexeme_reading_stack)
         next_lexeme_id += 1
 
-    max_rows = settings.N_ROWS_PER_INSERT
+        if max(len(stack) for stack in stacks) >= max_rows:
+            _flush_stacks(cursor, *stacks)
 
-    log.log('Storing to lexicon_lexeme')
-    for lexeme_rows in groups_of_n_iter(max_rows, xrange(1, next_lexeme_id)):
+    _flush_stacks(cursor, *stacks)
+    connection._commit()
+    log.log('Stored %d lexemes' % (next_lexeme_id - 1))
+    log.finish()
+    return
+
+def _flush_stacks(cursor, lexeme_stack, lexeme_surface_stack,
+        lexeme_reading_stack, lexeme_sense_stack):
+    """
+    Writes out and empties the insert stacks, lexemes first so that every
+    other row's lexeme exists.
+    """
+    if lexeme_stack:
         cursor.executemany('INSERT INTO lexicon_lexeme (id) VALUES (%s)',
-                lexeme_rows)
+                lexeme_stack)
 
-    log.log('Storing to lexicon_lexemesurface')
-    for lexeme_surface_rows in groups_of_n_iter(max_rows, lexeme_surface_stack):
+    if lexeme_surface_stack:
         cursor.executemany( """
                 INSERT INTO lexicon_lexemesurface (lexeme_id, surface,
                     has_kanji, in_lexicon)
                 VALUES (%s, %s, %s, %s)
-            """, lexeme_surface_rows)
+            """, lexeme_surface_stack)
 
-    log.log('Storing to lexicon_lexemereading')
-    for lexeme_reading_rows in groups_of_n_iter(max_rows, lexeme_reading_stack):
+    if lexeme_reading_stack:
         cursor.executemany( """
                 INSERT INTO lexicon_lexemereading (lexeme_id, reading)
                 VALUES (%s, %s)
-            """, lexeme_reading_rows)
+            """, lexeme_reading_stack)
 
-    log.log('Storing to lexicon_lexemesense')
-    for lexeme_sense_rows in groups_of_n_iter(max_rows, lexeme_sense_stack):
+    if lexeme_sense_stack:
         cursor.executemany( """
                 INSERT INTO lexicon_lexemesense (lexeme_id, gloss,
                         is_first_sense)
                 VALUES (%s, %s, %s)
-            """, lexeme_sense_rows)
+            """, lexeme_sense_stack)
 
-    connection._commit()
-    log.finish()
+    for stack in (lexeme_stack, lexeme_surface_stack, lexeme_reading_stack,
+            lexeme_sense_stack):
+        del stack[:]
     return
 
 #----------------------------------------------------------------------------#
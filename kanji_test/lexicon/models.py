@@ -10,13 +10,15 @@
 import random
 from os import path
 
-from django.db import models
+from django.db import models, connection, transaction
 from cjktools.resources import kanjidic
 from cjktools import scripts
+from simplestats.sequences import groups_of_n
 
 from kanji_test.util import probability
 from kanji_test.util import models as prob_models
 from kanji_test import settings
+from kanji_test.settings import N_ROWS_PER_INSERT
 
 #----------------------------------------------------------------------------#
 
@@ -106,6 +108,7 @@ class KanjiProb(prob_models.Prob):
     """A frequency distribution over kanji."""
     _freq_dist_file = path.join(settings.DATA_DIR, 'corpus',
             'jp_char_corpus_counts.gz')
+    in_memory = True
 
     def _get_kanji(self):
         return Kanji.objects.get(kanji=self.symbol)
@@ -128,6 +131,7 @@ class KanjiReadingProb(prob_models.Prob):
     """A frequency distribution of kanji pronunciations."""
     _freq_dist_file = path.join(settings.DATA_DIR, 'corpus',
             'kanji_reading_counts')
+    in_memory = True
         
     class Meta(prob_models.Prob.Meta):
         verbose_name = 'probability of reading'
@@ -151,6 +155,7 @@ class KanjiReadingCondProb(prob_models.CondProb):
     """
     _freq_dist_file = path.join(settings.DATA_DIR, 'corpus',
             'kanji_reading_counts')
+    in_memory = True
     
     def _get_kanji_reading(self):
         return KanjiReading.objects.get(kanji=self.condition,
@@ -189,6 +194,7 @@ class LexemeSurfaceProb(prob_models.Prob):
     """A probability distribution over lexical surface items."""
     _freq_dist_file = path.join(settings.DATA_DIR, 'corpus',
             'jp_word_corpus_counts.gz')
+    in_memory = True
 
     class Meta(prob_models.Prob.Meta):
         verbose_name = 'probability of lexeme surface'
@@ -235,20 +241,54 @@ class Kanji(models.Model):
         return self.kanji
     
     @classmethod
+    @transaction.commit_on_success
     def initialise(cls):
+        """
+        Reloads every kanji and its readings from kanjidic, preparing the
+        rows in a single pass and inserting them in bulk. Existing kanji
+        are deleted through the ORM, so that rows which refer to them are
+        cascaded too.
+        """
         KanjiReading.objects.all().delete()
         Kanji.objects.all().delete()
+
+        quote_name = connection.ops.quote_name
+        kanji_table = quote_name(cls._meta.db_table)
+        reading_table = quote_name(KanjiReading._meta.db_table)
+        cursor = connection.cursor()
+
         kjd = kanjidic.Kanjidic.get_cached()
         max_gloss_len = [f for f in cls._meta.fields \
                 if f.name == 'gloss'][0].max_length
+        kanji_rows = []
+        reading_rows = []
         for entry in kjd.itervalues():
             truncated_gloss = ', '.join(entry.gloss)[:max_gloss_len]
-            kanji = Kanji(kanji=entry.kanji, gloss=truncated_gloss)
-            kanji.save()
+            kanji_rows.append((entry.kanji, truncated_gloss))
             for reading in cls._clean_readings(entry.on_readings):
-                kanji.reading_set.create(reading=reading, reading_type='o')
+                reading_rows.append((entry.kanji, reading, 'o'))
             for reading in cls._clean_readings(entry.kun_readings):
-                kanji.reading_set.create(reading=reading, reading_type='k')
+                reading_rows.append((entry.kanji, reading, 'k'))
+
+        for row_set in groups_of_n(N_ROWS_PER_INSERT, kanji_rows):
+            cursor.executemany(
+                    """
+                    INSERT INTO %s (%s)
+                    VALUES (%%s, %%s)
+                    """ % (kanji_table, ', '.join(map(quote_name,
+                        ['kanji', 'gloss']))),
+                    row_set
+                )
+        for row_set in groups_of_n(N_ROWS_PER_INSERT, reading_rows):
+            cursor.executemany(
+                    """
+                    INSERT INTO %s (%s)
+                    VALUES (%%s, %%s, %%s)
+                    """ % (reading_table, ', '.join(map(quote_name,
+                        ['kanji_id', 'reading', 'reading_type']))),
+                    row_set
+                )
+        cursor.close()
         return
     
     @staticmethod
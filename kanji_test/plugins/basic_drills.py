@@ -7,6 +7,8 @@
 #  Copyright 2008-06-21 Lars Yencken. All rights reserved.
 # 
 
+import random
+
 from django.core.exceptions import ObjectDoesNotExist
 
 from kanji_test.drill import plugin_api, support
@@ -47,11 +49,13 @@ class ReadingQuestionFactory(plugin_api.MultipleChoiceFactoryI):
                 r.reading for r in lexicon_models.LexemeReading.objects.filter( 
                         lexeme__surface_set__surface=surface)
             ])
-        error_dist = usermodel_models.ErrorDist.objects.get(user=user,
-                tag=self.uses_dist)
-        distractor_values, annotation_map = support.build_word_options(
-                segments, error_dist, adaptive=self.is_adaptive,
-                exclude_set=real_readings)
+        options = self.get_pool_options(user, surface, 'w', real_readings)
+        if options is None:
+            error_dist = usermodel_models.ErrorDist.objects.get(user=user,
+                    tag=self.uses_dist)
+            options = support.build_word_options(segments, error_dist,
+                    adaptive=self.is_adaptive, exclude_set=real_readings)
+        distractor_values, annotation_map = options
         annotation_map[answer] = u'|'.join(answer)
         question.add_options(distractor_values, answer, annotation_map)
         return question
@@ -64,16 +68,36 @@ class ReadingQuestionFactory(plugin_api.MultipleChoiceFactoryI):
         kanji = partial_kanji.kanji.kanji
         question = self.build_question(pivot=kanji, pivot_id=partial_kanji.id,
                 pivot_type='k', stimulus=kanji, annotation=kanji)
-        question.save()
-        error_dist = usermodel_models.ErrorDist.objects.get(user=user,
-                tag=self.uses_dist)
-        distractor_values, annotation_map = support.build_kanji_options(kanji,
-                error_dist, adaptive=self.is_adaptive,
-                exclude_set=real_readings)
+        options = self.get_pool_options(user, kanji, 'k', real_readings)
+        if options is None:
+            error_dist = usermodel_models.ErrorDist.objects.get(user=user,
+                    tag=self.uses_dist)
+            options = support.build_kanji_options(kanji, error_dist,
+                    adaptive=self.is_adaptive, exclude_set=real_readings)
+        distractor_values, annotation_map = options
         annotation_map[answer] = u'|'.join(answer)
         question.add_options(distractor_values, answer, annotation_map)
         return question
 
+    def build_pools(self, syllabus):
+        "See parent."
+        prior_dist = syllabus.priordist_set.get(tag=self.uses_dist)
+        for kanji_row in lexicon_models.Kanji.objects.filter(
+                partialkanji__syllabus=syllabus):
+            kanji = kanji_row.kanji
+            real_readings = set(kanji_row.reading_set.values_list('reading',
+                    flat=True))
+            yield kanji, 'k', support.build_kanji_pool(kanji, prior_dist,
+                    adaptive=self.is_adaptive, exclude_set=real_readings)
+
+        for surface in _kanji_surfaces(syllabus):
+            real_readings = set(lexicon_models.LexemeReading.objects.filter(
+                    lexeme__surface_set__surface=surface).values_list(
+                    'reading', flat=True))
+            yield surface, 'w', support.build_word_pool(list(surface),
+                    prior_dist, adaptive=self.is_adaptive,
+                    exclude_set=real_readings)
+
 #----------------------------------------------------------------------------#
 
 class SurfaceQuestionFactory(plugin_api.MultipleChoiceFactoryI):
@@ -87,9 +111,12 @@ class SurfaceQuestionFactory(plugin_api.MultipleChoiceFactoryI):
     def get_kanji_question(self, partial_kanji, user):
         kanji_row = partial_kanji.kanji
         kanji = kanji_row.kanji
-        error_dist = user.errordist_set.get(tag=self.uses_dist)
-        distractors, _annotations = support.build_kanji_options(
-                kanji, error_dist, exclude_set=set([kanji]))
+        options = self.get_pool_options(user, kanji, 'k', set([kanji]))
+        if options is None:
+            error_dist = user.errordist_set.get(tag=self.uses_dist)
+            options = support.build_kanji_options(kanji, error_dist,
+                    exclude_set=set([kanji]))
+        distractors, _annotations = options
         question = self.build_question(
                 pivot=kanji,
                 pivot_id=partial_kanji.id,
@@ -109,9 +136,12 @@ class SurfaceQuestionFactory(plugin_api.MultipleChoiceFactoryI):
         # Assume the first sense is the most frequent
         gloss = lexeme.sense_set.get(is_first_sense=True).gloss
 
-        error_dist = user.errordist_set.get(tag=self.uses_dist)
-        distractors, _annotations = support.build_word_options(
-                list(surface), error_dist, exclude_set=set([surface]))
+        options = self.get_pool_options(user, surface, 'w', set([surface]))
+        if options is None:
+            error_dist = user.errordist_set.get(tag=self.uses_dist)
+            options = support.build_word_options(list(surface), error_dist,
+                    exclude_set=set([surface]))
+        distractors, _annotations = options
         question = self.build_question(
                 pivot=surface,
                 pivot_id=partial_lexeme.id,
@@ -121,6 +151,19 @@ class SurfaceQuestionFactory(plugin_api.MultipleChoiceFactoryI):
         question.add_options(distractors, surface)
         return question
 
+    def build_pools(self, syllabus):
+        "See parent."
+        prior_dist = syllabus.priordist_set.get(tag=self.uses_dist)
+        for kanji in lexicon_models.Kanji.objects.filter(
+                partialkanji__syllabus=syllabus).values_list('kanji',
+                flat=True):
+            yield kanji, 'k', support.build_kanji_pool(kanji, prior_dist,
+                    exclude_set=set([kanji]))
+
+        for surface in _kanji_surfaces(syllabus):
+            yield surface, 'w', support.build_word_pool(list(surface),
+                    prior_dist, exclude_set=set([surface]))
+
 #----------------------------------------------------------------------------#
 
 class GlossQuestionFactory(plugin_api.MultipleChoiceFactoryI):
@@ -134,19 +177,12 @@ class GlossQuestionFactory(plugin_api.MultipleChoiceFactoryI):
     def get_kanji_question(self, partial_kanji, user):
         kanji_row = partial_kanji.kanji
         answer = kanji_row.gloss
-        syllabus = user.get_profile().syllabus
-        distractor_values = set()
-        while len(distractor_values) < settings.N_DISTRACTORS:
-            for kanji in lexicon_models.Kanji.objects.filter(
-                        partialkanji__syllabus=syllabus
-                    ).order_by('?')[:settings.N_DISTRACTORS]:
-                distractor = kanji.gloss
-                if distractor != answer:
-                    distractor_values.add(distractor)
-                    if len(distractor_values) > settings.N_DISTRACTORS:
-                        break
-
-        distractor_values = list(distractor_values)
+        options = self.get_pool_options(user, kanji_row.kanji, 'k',
+                set([answer]))
+        if options is not None:
+            distractor_values, _annotations = options
+        else:
+            distractor_values = self._sample_kanji_glosses(user, answer)
         question = self.build_question(
                 pivot=kanji_row.kanji,
                 pivot_id=partial_kanji.id,
@@ -165,10 +201,68 @@ class GlossQuestionFactory(plugin_api.MultipleChoiceFactoryI):
         word_row = partial_lexeme.lexeme
         
         answer = word_row.first_sense.gloss
+        exclude_set = set(s.gloss for s in word_row.sense_set.all())
+        options = self.get_pool_options(user, surface, 'w', exclude_set)
+        if options is not None:
+            distractor_values, _annotations = options
+        else:
+            distractor_values = self._sample_word_glosses(user, exclude_set)
+        question = self.build_question(
+                pivot=surface,
+                pivot_id=partial_lexeme.id,
+                pivot_type='w',
+                stimulus=surface,
+            )
+        question.add_options(distractor_values, answer)
+        return question
+
+    def build_pools(self, syllabus):
+        """
+        See parent. Glosses are drawn at random, so each pool is a random
+        sample of the syllabus's other glosses.
+        """
+        kanji_glosses = list(lexicon_models.Kanji.objects.filter(
+                partialkanji__syllabus=syllabus).values_list('kanji',
+                'gloss'))
+        all_glosses = list(set(g for (_k, g) in kanji_glosses))
+        for kanji, gloss in kanji_glosses:
+            yield kanji, 'k', _random_pool(all_glosses, set([gloss]))
+
+        lexeme_glosses = {}
+        for lexeme_id, gloss in lexicon_models.LexemeSense.objects.filter(
+                lexeme__partiallexeme__syllabus=syllabus).values_list(
+                'lexeme_id', 'gloss'):
+            lexeme_glosses.setdefault(lexeme_id, set()).add(gloss)
+        all_glosses = list(set().union(*lexeme_glosses.values()))
+
+        for partial_lexeme in syllabus.partiallexeme_set.all():
+            exclude_set = lexeme_glosses.get(partial_lexeme.lexeme_id, set())
+            pool = _random_pool(all_glosses, exclude_set)
+            for surface in partial_lexeme.surface_set.values_list('surface',
+                    flat=True):
+                yield surface, 'w', pool
+            for reading in partial_lexeme.reading_set.values_list('reading',
+                    flat=True):
+                yield reading, 'w', pool
+
+    def _sample_kanji_glosses(self, user, answer):
         syllabus = user.get_profile().syllabus
+        distractor_values = set()
+        while len(distractor_values) < settings.N_DISTRACTORS:
+            for kanji in lexicon_models.Kanji.objects.filter(
+                        partialkanji__syllabus=syllabus
+                    ).order_by('?')[:settings.N_DISTRACTORS]:
+                distractor = kanji.gloss
+                if distractor != answer:
+                    distractor_values.add(distractor)
+                    if len(distractor_values) > settings.N_DISTRACTORS:
+                        break
+
+        return list(distractor_values)
 
+    def _sample_word_glosses(self, user, exclude_set):
+        syllabus = user.get_profile().syllabus
         distractor_values = set()
-        exclude_set = set(s.gloss for s in word_row.sense_set.all())
         while len(distractor_values) < settings.N_DISTRACTORS:
             for sense in syllabus.sample_senses(settings.N_DISTRACTORS):
                 gloss = sense.gloss
@@ -177,13 +271,20 @@ class GlossQuestionFactory(plugin_api.MultipleChoiceFactoryI):
                     if len(distractor_values) == settings.N_DISTRACTORS:
                         break
 
-        distractor_values = list(distractor_values)
-        question = self.build_question(
-                pivot=surface,
-                pivot_id=partial_lexeme.id,
-                pivot_type='w',
-                stimulus=surface,
-            )
-        question.add_options(distractor_values, answer)
-        return question
+        return list(distractor_values)
+
+#----------------------------------------------------------------------------#
+
+def _kanji_surfaces(syllabus):
+    "Returns the distinct kanji-containing surfaces in the syllabus."
+    return lexicon_models.LexemeSurface.objects.filter(
+            partiallexeme__syllabus=syllabus, has_kanji=True).values_list(
+            'surface', flat=True).distinct()
+
+def _random_pool(values, exclude_set, n=settings.DISTRACTOR_POOL_SIZE):
+    "Returns a random pool of up to n unannotated, equally likely values."
+    values = [v for v in values if v not in exclude_set]
+    return [(v, None, 1.0) for v in
+            random.sample(values, min(n, len(values)))]
 
+# vim: ts=4 sw=4 sts=4 et tw=78:
@@ -12,18 +12,26 @@ A django app for modelling kanji reading alternations.
 """
 
 import consoleLog
-from django.db import connection
+from django.db import connection, transaction
 from django.conf import settings
+from simplestats.sequences import groups_of_n
 
 from kanji_test.user_model import plugin_api as usermodel_api
 from kanji_test.user_model import models as usermodel_models
 from kanji_test.drill import plugin_api as drill_api
 from kanji_test.drill import support
-from kanji_test.util.probability import ProbDist
+from kanji_test.util.probability import ArrayProbDist
 from kanji_test.lexicon import models as lexicon_models
 
 _log = consoleLog.default
 
+build_depends_on = ['kanji_test.lexicon']
+
+def build():
+    "Builds the reading alternation database."
+    import reading_database
+    reading_database.build()
+
 class KanjiReadingModel(usermodel_api.SegmentedSeqPlugin):
     dist_name = 'reading | kanji'
 
@@ -92,40 +100,81 @@ class KanjiReadingModel(usermodel_api.SegmentedSeqPlugin):
         problem that there may not be enough erroneous readings to meet the
         minimum number of distractors we wish to generate.
 
-        To circumvent this problem, we pad with random distractors.
+        To circumvent this problem, we pad with random distractors. Every
+        condition is padded in memory, then the whole distribution is written
+        back in bulk.
         """
-        _log.log('Padding results ', newLine=False)
-        conditions = set(o['condition'] for o in \
-                prior_dist.density.all().values('condition'))
-        for (condition,) in consoleLog.withProgress(conditions):
-            exclude_set = set(
-                    o.reading for o in \
-                    lexicon_models.KanjiReading.objects.filter(
-                        kanji__kanji=condition)
-                )
-            n_stored = prior_dist.density.filter(condition=condition).exclude(
-                    symbol__in=exclude_set).count()
-
-            sub_dist = ProbDist.from_query_set(prior_dist.density.filter(
-                    condition=condition))
-            exclude_set.update(sub_dist.keys())
+        _log.log('Padding results')
+        cond_dists = {}
+        for condition, symbol, pdf in prior_dist.density.values_list(
+                'condition', 'symbol', 'pdf'):
+            cond_dists.setdefault(condition, {})[symbol] = pdf
+
+        real_readings = self._fetch_kanji_readings(cond_dists.keys())
+        reading_dist = ArrayProbDist.from_query_set(
+                lexicon_models.KanjiReadingProb.objects.all())
+
+        for condition, sub_dist in cond_dists.iteritems():
+            exclude_set = real_readings.get(condition, set())
+            n_stored = len([s for s in sub_dist if s not in exclude_set])
             n_needed = settings.MIN_TOTAL_DISTRACTORS - n_stored
-            min_prob = min(sub_dist.itervalues()) / 2
-            while n_needed > 0:
-                for row in lexicon_models.KanjiReadingProb.sample_n(n_needed):
-                    if row.symbol not in exclude_set:
-                        sub_dist[row.symbol] = min_prob
-                        exclude_set.add(row.symbol)
-                        n_needed -= 1
 
-                    if n_needed == 0:
-                        break
+            _normalise(sub_dist)
+            if n_needed > 0:
+                exclude_set = exclude_set.union(sub_dist)
+                min_prob = min(sub_dist.itervalues()) / 2
+                for symbol in reading_dist.sample_n(n_needed,
+                        exclude_set=exclude_set):
+                    sub_dist[symbol] = min_prob
+                _normalise(sub_dist)
 
-            sub_dist.normalise()
-            sub_dist.save_to(prior_dist.density, condition=condition)
+        self._store_densities(prior_dist, cond_dists)
+        return
 
+    def _fetch_kanji_readings(self, kanji_list):
+        "Fetches the set of real readings for each kanji."
+        real_readings = {}
+        # Keep within the query parameter limits of every backend.
+        for kanji_group in groups_of_n(500, kanji_list):
+            for kanji, reading in lexicon_models.KanjiReading.objects.filter(
+                    kanji__in=kanji_group).values_list('kanji', 'reading'):
+                real_readings.setdefault(kanji, set()).add(reading)
+
+        return real_readings
+
+    @staticmethod
+    @transaction.commit_on_success
+    def _store_densities(prior_dist, cond_dists):
+        "Replaces the densities of the prior with the given distributions."
+        table_name = usermodel_models.PriorPdf._meta.db_table
+        quote_name = connection.ops.quote_name
+        fields = ', '.join(map(quote_name, ['dist_id', 'condition', 'symbol',
+                'pdf', 'cdf']))
+        rows = []
+        for condition, sub_dist in cond_dists.iteritems():
+            cdf = 0.0
+            for symbol in sorted(sub_dist):
+                pdf = sub_dist[symbol]
+                cdf += pdf
+                rows.append((prior_dist.id, condition, symbol, pdf, cdf))
+
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s' % (table_name,
+                quote_name('dist_id')), [prior_dist.id])
+        for row_set in groups_of_n(settings.N_ROWS_PER_INSERT, rows):
+            cursor.executemany("""
+                    INSERT INTO %s (%s)
+                    VALUES (%%s, %%s, %%s, %%s, %%s)
+                """ % (table_name, fields), row_set)
+        cursor.close()
+        prior_dist.invalidate()
         return
 
+def _normalise(dist):
+    total = sum(dist.itervalues())
+    for symbol in dist:
+        dist[symbol] /= total
+
 #----------------------------------------------------------------------------#
 
 class ReadingAlternationQuestions(drill_api.MultipleChoiceFactoryI):
@@ -176,7 +225,6 @@ class ReadingAlternationQuestions(drill_api.MultipleChoiceFactoryI):
         question.add_options(distractors, answer_reading,
                 annotation_map=annotation_map)
         question.annotation = u'|'.join(alignment_obj.g_segs)
-        question.save()
         return question
             
     def get_kanji_question(self, partial_kanji, user):
@@ -201,7 +249,6 @@ class ReadingAlternationQuestions(drill_api.MultipleChoiceFactoryI):
         question.add_options(distractors, answer,
                 annotation_map=annotation_map)
         question.annotation = kanji             # No segments
-        question.save()
         return question
     
 # vim: ts=4 sw=4 sts=4 et tw=78:
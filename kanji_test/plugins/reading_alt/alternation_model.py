@@ -30,13 +30,28 @@ class AlternationModelI(object):
     def log_prob(kanji, reading, alternation):
         raise AbstractMethodError
 
+    def candidates(self, kanji, reading):
+        "Returns a list of (alternate reading, log prob) pairs."
+        raise AbstractMethodError
+
+    def candidates_many(self, pairs):
+        """
+        Returns the candidate list for each (kanji, reading) pair. Models
+        should override this where results can be shared between pairs.
+        """
+        return [self.candidates(kanji, reading) for (kanji, reading) in pairs]
+
 #----------------------------------------------------------------------------#
 
 class SimpleAlternationModel(AlternationModelI):
     """
     An alternation model based on readings which are subsets of things. To
     use, subclass this model and implement the _build_pairs() method.
+    Candidates depend only on the reading, so they are memoised per reading.
     """
+    # The name of the setting giving this model's alpha.
+    alpha_setting = None
+
     #------------------------------------------------------------------------#
     # PUBLIC
     #------------------------------------------------------------------------#
@@ -57,6 +72,18 @@ class SimpleAlternationModel(AlternationModelI):
                 mapping[keyB] = [keyA]
 
         self.mapping = mapping
+        self._candidate_cache = {}
+
+    #------------------------------------------------------------------------#
+
+    @classmethod
+    def get_cached(cls):
+        "Returns a shared instance, rebuilt whenever its alpha is changed."
+        alpha = getattr(settings, cls.alpha_setting)
+        cached = cls.__dict__.get('_cached')
+        if cached is None or cached.alpha != alpha:
+            cls._cached = cached = cls()
+        return cached
 
     #------------------------------------------------------------------------#
 
@@ -88,17 +115,15 @@ class SimpleAlternationModel(AlternationModelI):
         Return a list of potential reading variant candidates for this
         model.
         """
-        variants = [reading]
-        if reading in self.mapping:
-            variants.extend(self.mapping[reading])
+        return list(self._reading_candidates(reading))
 
-        results = []
-        for readingVariant in variants:
-            results.append(
-                    (readingVariant, self.log_prob(reading, readingVariant))
-                )
+    #------------------------------------------------------------------------#
+
+    def candidates_many(self, pairs):
+        "Returns the candidate list for each (kanji, reading) pair."
+        return [list(self._reading_candidates(reading))
+                for (kanji, reading) in pairs]
 
-        return results
 
     #------------------------------------------------------------------------#
     # PRIVATE
@@ -113,6 +138,22 @@ class SimpleAlternationModel(AlternationModelI):
 
     #------------------------------------------------------------------------#
 
+    def _reading_candidates(self, reading):
+        "The memoised candidates for this reading, shared between callers."
+        results = self._candidate_cache.get(reading)
+        if results is None:
+            variants = [reading]
+            if reading in self.mapping:
+                variants.extend(self.mapping[reading])
+
+            results = [(readingVariant, self.log_prob(reading,
+                    readingVariant)) for readingVariant in variants]
+            self._candidate_cache[reading] = results
+
+        return results
+
+    #------------------------------------------------------------------------#
+
     def _num_variants(self, reading):
         """
         Returns the number of variants for this particular reading.
@@ -136,6 +177,8 @@ class VowelLengthModel(SimpleAlternationModel):
     """
     An alternation model for vowel length.
     """
+    alpha_setting = 'VOWEL_LENGTH_ALPHA'
+
     def __init__(self):
         SimpleAlternationModel.__init__(self, settings.VOWEL_LENGTH_ALPHA)
 
@@ -185,20 +228,13 @@ class VowelLengthModel(SimpleAlternationModel):
 
     #------------------------------------------------------------------------#
 
-    @classmethod
-    def get_cached(cls):
-        if not hasattr(cls, '_cached'):
-            cls._cached = cls()
-        return cls._cached
-
-    #------------------------------------------------------------------------#
-
 #----------------------------------------------------------------------------#
 
 class PalatalizationModel(SimpleAlternationModel):
     """
     A probability model of palatalization for Japanese.
     """
+    alpha_setting = 'PALATALIZATION_ALPHA'
 
     #------------------------------------------------------------------------#
 
@@ -231,12 +267,4 @@ class PalatalizationModel(SimpleAlternationModel):
 
     #------------------------------------------------------------------------#
 
-    @classmethod
-    def get_cached(cls):
-        if not hasattr(cls, '_cached'):
-            cls._cached = cls()
-        return cls._cached
-
-    #------------------------------------------------------------------------#
-
 #----------------------------------------------------------------------------#
@@ -14,6 +14,7 @@ Builds the tables of readings and reading alternations.
 
 import sys, optparse
 import math
+from array import array
 from django.db import connection
 
 from simplestats.sequences import groups_of_n
@@ -22,7 +23,6 @@ import consoleLog
 from checksum.models import Checksum
 
 from kanji_test.lexicon.models import Kanji
-from hierarchy.tree import TreeNode
 import reading_model
 import alternation_model
 
@@ -87,17 +87,19 @@ class ReadingDatabase(object):
         """
         log.start('Building alternation tree', nSteps=3)
         log.log('Adding base kanji set')
-        root_node = AltTreeNode('root', '/')
+        alt_tree = AltTree()
         for kanji in kanji_set:
-            root_node.add_child(AltTreeNode(kanji, 'k'))
+            alt_tree.add_kanji(kanji)
 
         log.log('Adding good readings')
         kjdic = kanjidic.Kanjidic()
-        for kanji_node in root_node.children.values():
-            kanji = kanji_node.label
+        for kanji_node, leaves in alt_tree.kanji_leaves:
+            kanji = alt_tree.get_label(kanji_node)
             if kanji in kjdic:
-                for reading in kjdic[kanji].all_readings:
-                    kanji_node.add_child(AltTreeNode(reading, 'b'))
+                readings = _unique(kjdic[kanji].all_readings)
+                if readings:
+                    leaves[:] = [alt_tree.add_node(kanji_node, reading, 'b')
+                            for reading in readings]
 
         log.start('Adding alternation models',
                 nSteps=len(_alternation_models))
@@ -107,15 +109,15 @@ class ReadingDatabase(object):
         for model_name, model_code, model_class in _alternation_models:
             log.log(pattern % model_name, newLine=False)
             sys.stdout.flush()
-            model_obj = model_class()
-            cls._add_alternation_model(model_obj, model_code, root_node,
+            model_obj = model_class.get_cached()
+            cls._add_alternation_model(model_obj, model_code, alt_tree,
                 first=(i==0))
             i += 1
         log.finish()
 
         log.finish()
 
-        return root_node
+        return alt_tree
 
     #------------------------------------------------------------------------#
 
@@ -128,7 +130,7 @@ class ReadingDatabase(object):
         log.start('Storing alternation tree', nSteps=2)
         # Walk the tree, numbering all nodes.
         log.log('Numbering tree nodes')
-        cls._number_tree(alt_tree)
+        alt_tree.number()
 
         # Store the tree
         log.log('Storing the tree to the database')
@@ -137,44 +139,17 @@ class ReadingDatabase(object):
 
     #------------------------------------------------------------------------#
 
-    @classmethod
-    def _number_tree(cls, root_node, i=1):
-        """
-        Numbers the entire tree, as required for the nested set abstraction.
-
-        @return: The update counter
-        """
-        root_node.left_visit = i
-        i += 1
-
-        for child in root_node.children.itervalues():
-            i = cls._number_tree(child, i)
-
-        root_node.right_visit = i
-        i += 1
-
-        return i
-
-    #------------------------------------------------------------------------#
-
     @staticmethod
-    def _store_tree(root_node):
+    def _store_tree(alt_tree):
         """
         Stores the reading alternation tree to the database.
         """
-        # Build our list of results.
-        def iter_results(tree):
-            for node in tree.walk():
-                yield (node.label, node.code, node.probability,
-                        node.left_visit, node.right_visit)
-            return
-
         # Insert them to the database.
         cursor = connection.cursor()
         cursor.execute('DELETE FROM reading_alt_kanjireading')
         cursor.execute('DELETE FROM reading_alt_readingalternation')
         max_per_run = 10000
-        all_results = iter_results(root_node)
+        all_results = alt_tree.iter_rows()
 
         for results in groups_of_n(max_per_run, all_results):
             cursor.executemany(
@@ -192,38 +167,50 @@ class ReadingDatabase(object):
     #------------------------------------------------------------------------#
 
     @staticmethod
-    def _add_alternation_model(model_obj, code, root_node, first=False):
+    def _add_alternation_model(model_obj, code, alt_tree, first=False):
         """
         Adds this alternation model to our current alternation tree. This
-        involves walking to each leaf node, then getting all candidates of
-        the model, and appending them as new nodes.
+        involves visiting each leaf node, then getting all candidates of
+        the model for each kanji's leaves at once, and appending them as new
+        nodes.
 
         @param model_obj: An alternation model.
         @type model_obj: AlternationModelI
         @param code: A character code for the given alternation.
         @type code: char
-        @param root_node: The root node of the entire tree.
-        @type root_node: TreeNode
+        @param alt_tree: The entire alternation tree.
+        @type alt_tree: AltTree
         """
-        for kanji_node in consoleLog.withProgress(root_node.children.values()):
-            kanji = kanji_node.label
-            leaves = list(kanji_node.walk_leaves())
-            for reading_node in leaves:
-                reading = reading_node.label
-                candidates = model_obj.candidates(kanji, reading)
+        for kanji_node, leaves in consoleLog.withProgress(
+                alt_tree.kanji_leaves):
+            kanji = alt_tree.get_label(kanji_node)
+            readings = [alt_tree.get_label(n) for n in leaves]
+            candidate_lists = model_obj.candidates_many(
+                    [(kanji, reading) for reading in readings])
+            new_leaves = []
+            for reading_node, reading, candidates in zip(leaves, readings,
+                    candidate_lists):
                 if not first and candidates == [(reading, 0.0)]:
                     # No changes
+                    new_leaves.append(reading_node)
                     continue
 
+                seen = set()
+                children = []
                 for alt_reading, log_prob in candidates:
                     # Only tag changes with their alternation code.
                     if alt_reading == reading:
                         node_code = ''
                     else:
                         node_code = code
-                    assert alt_reading not in reading_node.children
-                    reading_node.add_child(
-                            AltTreeNode(alt_reading, node_code, log_prob))
+                    assert alt_reading not in seen
+                    seen.add(alt_reading)
+                    children.append(alt_tree.add_node(reading_node,
+                            alt_reading, node_code, log_prob))
+
+                new_leaves.extend(children or [reading_node])
+
+            leaves[:] = new_leaves
 
         return
 
@@ -232,32 +219,31 @@ class ReadingDatabase(object):
     @staticmethod
     def _store_kanji_readings(alt_tree):
         "Stores a separate table of only leaf-node readings."
-        def iter_results(tree):
-            for kanji_node in tree.children.itervalues():
-                kanji = kanji_node.label
+        def iter_results(alt_tree):
+            path_log_probs, path_codes = alt_tree.get_path_scores()
+            for kanji_node, leaves in alt_tree.kanji_leaves:
+                kanji = alt_tree.get_label(kanji_node)
 
                 reading_map = {}
-                for leaf_node in kanji_node.walk_leaves():
-                    # Calculate the probability for this path.
-                    reading = leaf_node.label
-                    leaf_path = leaf_node.get_ancestors()[1:]
-                    pdf = math.exp(sum([n.probability for n in leaf_path]))
-                    codes = set([n.code for n in leaf_path])
+                for leaf_node in leaves:
+                    # Take the most likely path to each reading.
+                    reading = alt_tree.get_label(leaf_node)
+                    pdf = math.exp(path_log_probs[leaf_node])
                     if reading not in reading_map or \
-                            reading_map[reading]['pdf'] < pdf:
-                        reading_map[reading] = {'pdf': pdf, 'codes': codes}
+                            reading_map[reading][0] < pdf:
+                        reading_map[reading] = (pdf, leaf_node)
 
                 if not reading_map:
                     # No readings for this kanji
                     continue
 
-                total = sum(r['pdf'] for r in reading_map.itervalues())
+                total = sum(pdf for (pdf, _n) in reading_map.itervalues())
                 cdf = 0.0
-                for reading, entry in reading_map.iteritems():
-                    pdf = entry['pdf'] / total
+                for reading, (pdf, leaf_node) in reading_map.iteritems():
+                    pdf = pdf / total
                     cdf += pdf
-                    yield (kanji, reading, ''.join(sorted(entry['codes'])),
-                            pdf, cdf, leaf_path[-1].left_visit)
+                    yield (kanji, reading, path_codes[leaf_node], pdf, cdf,
+                            alt_tree.left_visit[leaf_node])
                 assert abs(cdf - 1.0) < 1e-8
             return
 
@@ -288,24 +274,144 @@ class ReadingDatabase(object):
 
 #----------------------------------------------------------------------------#
 
-class AltTreeNode(TreeNode):
-    def __init__(self, name, code, probability=0.0):
-        TreeNode.__init__(self, label=name,
-                attrib={'code': code, 'probability': probability})
-        return
-
-    def make_property(name):
-        def getter(self):
-            return self.attrib[name]
-        def setter(self, value):
-            self.attrib[name] = value
-            return
-        return property(getter, setter)
-
-    probability = make_property('probability')
-    left_visit = make_property('left_visit')
-    right_visit = make_property('right_visit')
-    code = make_property('code')
+class AltTree(object):
+    """
+    The tree of readings and reading alternations, held as parallel arrays
+    indexed by node number. Children are always added after their parents,
+    so a single forward pass visits every parent before its children.
+
+    >>> t = AltTree()
+    >>> k = t.add_kanji(u'x')
+    >>> a = t.add_node(k, u'a', 'b', -1.0)
+    >>> b = t.add_node(k, u'b', 'b')
+    >>> t.number()
+    >>> [(t.left_visit[i], t.right_visit[i]) for i in (0, k, a, b)]
+    [(1, 8), (2, 7), (3, 4), (5, 6)]
+    >>> t.get_path_scores()[1][a]
+    'bk'
+    """
+    def __init__(self):
+        self.parent = array('i')
+        self.label_id = array('i')
+        self.code_id = array('b')
+        self.log_prob = array('d')
+        self.left_visit = None
+        self.right_visit = None
+
+        # Labels and codes repeat heavily, so each is stored only once.
+        self._labels = []
+        self._label_ids = {}
+        self._codes = []
+        self._code_ids = {}
+
+        # A (kanji node, leaf nodes) pair for every kanji subtree.
+        self.kanji_leaves = []
+
+        self.add_node(-1, 'root', '/')
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent, label, code, log_prob=0.0):
+        "Adds a new node below the given parent, returning its number."
+        self.parent.append(parent)
+        self.label_id.append(_intern(label, self._labels, self._label_ids))
+        self.code_id.append(_intern(code, self._codes, self._code_ids))
+        self.log_prob.append(log_prob)
+        return len(self.parent) - 1
+
+    def add_kanji(self, kanji):
+        "Adds a new kanji subtree, initially a leaf of the root."
+        node = self.add_node(0, kanji, 'k')
+        self.kanji_leaves.append((node, [node]))
+        return node
+
+    def get_label(self, node):
+        return self._labels[self.label_id[node]]
+
+    def get_code(self, node):
+        return self._codes[self.code_id[node]]
+
+    def number(self):
+        """
+        Numbers every node with its left and right visits, as required for
+        the nested set abstraction, visiting children in the order they were
+        added.
+        """
+        n_nodes = len(self.parent)
+        parent = self.parent
+
+        # Subtree sizes, from the bottom up.
+        size = array('i', [1]) * n_nodes
+        for i in xrange(n_nodes - 1, 0, -1):
+            size[parent[i]] += size[i]
+
+        # Each node's first child starts just after its left visit.
+        left_visit = array('i', [1]) * n_nodes
+        right_visit = array('i', [2 * n_nodes]) * n_nodes
+        next_visit = array('i', [2]) * n_nodes
+        for i in xrange(1, n_nodes):
+            p = parent[i]
+            left_visit[i] = next_visit[p]
+            next_visit[p] += 2 * size[i]
+            right_visit[i] = left_visit[i] + 2 * size[i] - 1
+            next_visit[i] = left_visit[i] + 1
+
+        self.left_visit = left_visit
+        self.right_visit = right_visit
+
+    def get_path_scores(self):
+        """
+        Returns the log-probability of the path to each node, and the
+        alternation codes used along the way, excluding the root.
+        """
+        n_nodes = len(self.parent)
+        parent = self.parent
+        code_id = self.code_id
+        path_log_probs = array('d', [0.0]) * n_nodes
+        path_masks = array('i', [0]) * n_nodes
+        for i in xrange(1, n_nodes):
+            p = parent[i]
+            path_log_probs[i] = path_log_probs[p] + self.log_prob[i]
+            path_masks[i] = path_masks[p] | (1 << code_id[i])
+
+        mask_codes = {}
+        path_codes = []
+        for mask in path_masks:
+            codes = mask_codes.get(mask)
+            if codes is None:
+                codes = ''.join(sorted(c for (i, c) in enumerate(self._codes)
+                        if mask & (1 << i)))
+                mask_codes[mask] = codes
+            path_codes.append(codes)
+
+        return path_log_probs, path_codes
+
+    def iter_rows(self):
+        "Yields a database row for every node, once numbered."
+        labels = self._labels
+        codes = self._codes
+        for i in xrange(len(self.parent)):
+            yield (labels[self.label_id[i]], codes[self.code_id[i]],
+                    self.log_prob[i], self.left_visit[i],
+                    self.right_visit[i])
+
+def _intern(value, values, value_ids):
+    value_id = value_ids.get(value)
+    if value_id is None:
+        value_id = value_ids[value] = len(values)
+        values.append(value)
+    return value_id
+
+def _unique(items):
+    "The distinct items, in their original order."
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
 
 #----------------------------------------------------------------------------#
 
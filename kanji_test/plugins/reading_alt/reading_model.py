@@ -51,8 +51,17 @@ class VoicingAndGeminationModel(object):
 
         self.reverse_mapping = self.get_reverse_mapping()
 
+        # Maps (k, r) to the alpha-independent parts of its candidates.
+        self._candidate_table = {}
+
         return
 
+    @classmethod
+    def get_cached(cls):
+        if not hasattr(cls, '_cached'):
+            cls._cached = cls()
+        return cls._cached
+
     def prob(self, grapheme, reading, alt_reading):
         """
         Returns the probability of P(r|k), using the formula:
@@ -86,17 +95,36 @@ class VoicingAndGeminationModel(object):
         """
         Returns a list of (alt_reading, log_prob) pairs.
         """
-        results = []
-
-        key = grapheme, reading
+        return self.candidates_many([(grapheme, reading)])[0]
 
-        if key not in self.from_canonical_reading:
-            return [(reading, 0.0)]
-
-        for alt_reading in self.from_canonical_reading[key]:
-            results.append(
-                    (alt_reading, self.log_prob(grapheme, reading, alt_reading))
-                )
+    def candidates_many(self, pairs):
+        """
+        Returns the list of (alt_reading, log_prob) pairs for each
+        (grapheme, reading) pair. The frequencies behind each pair's
+        candidates are kept in a table, so only the mixing with the current
+        alternation alpha is repeated when a pair is seen again.
+        """
+        alpha = settings.ALTERNATION_ALPHA
+        assert 0 <= alpha <= 1
+        table = self._candidate_table
+        results = []
+        for key in pairs:
+            if key not in self.from_canonical_reading:
+                results.append([(key[1], 0.0)])
+                continue
+
+            entries = table.get(key)
+            if entries is None:
+                entries = table[key] = self._candidate_freqs(*key)
+
+            candidates = []
+            for alt_reading, raw_prob, canonical_prob in entries:
+                if raw_prob is None:
+                    candidates.append((alt_reading, 0.0))
+                else:
+                    candidates.append((alt_reading, math.log(alpha * raw_prob
+                            + (1 - alpha) * canonical_prob)))
+            results.append(candidates)
 
         return results
 
@@ -141,6 +169,41 @@ class VoicingAndGeminationModel(object):
 
     #------------------------------------------------------------------------#
 
+    def _candidate_freqs(self, grapheme, reading):
+        """
+        Returns (alt_reading, P_raw(r|k), P(r|r*)P(r*|k)) for each candidate
+        alternation, as combined by prob(). Phonetic segments, which always
+        have probability 1, are given None for both parts.
+        """
+        grapheme_hiragana = scripts.to_hiragana(grapheme)
+        is_kanji = scripts.script_types(grapheme) == set([scripts.Script.Kanji])
+        normalized_prob = None
+
+        entries = []
+        for alt_reading in self.from_canonical_reading[grapheme, reading]:
+            if grapheme_hiragana == scripts.to_hiragana(alt_reading):
+                # Special case: where the segment is phonetic.
+                entries.append((alt_reading, None, None))
+                continue
+
+            # We only handle entire kanji segments.
+            assert is_kanji
+
+            if normalized_prob is None:
+                normalized_prob = self.normalized_freq_dist[grapheme].freq(
+                        reading)
+            try:
+                raw_prob = self.raw_freq_dist[grapheme].freq(alt_reading)
+            except KeyError:
+                raw_prob = 0.0
+
+            alternation_prob = self.alternation_dist[reading].freq(
+                    alt_reading)
+            entries.append((alt_reading, raw_prob,
+                    normalized_prob * alternation_prob))
+
+        return entries
+
     def _load_alternation_dist(self, filename):
         """
         Loads an alternation distribution and returns it. This
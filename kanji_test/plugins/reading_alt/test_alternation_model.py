@@ -48,6 +48,11 @@ class VowelLengthTestCase(unittest.TestCase):
         assert u'き' not in cs
         assert set(cs) == set([u'きょう', u'きょ'])
 
+    def test_candidates_many(self):
+        readings = [u'きょう', u'と', u'きょう', u'ん']
+        assert self.model.candidates_many([(None, r) for r in readings]) == \
+                [self.model.candidates(None, r) for r in readings]
+
     def tearDown(self):
         pass
 
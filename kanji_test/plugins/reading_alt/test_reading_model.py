@@ -52,6 +52,14 @@ class KanjiReadingModelTestCase(unittest.TestCase):
         assert self.model.prob(u'発', u'はつ', u'はっ') > 0.0
         assert u'はっ' in [c[0] for c in self.model.candidates(u'発', u'はつ')]
 
+    def testCandidatesMany(self):
+        pairs = [(u'発', u'はつ'), (u'国', u'こく'), (u'発', u'はつ')]
+        for (g, r), candidates in zip(pairs,
+                self.model.candidates_many(pairs)):
+            for alt_reading, log_prob in candidates:
+                assert abs(log_prob - self.model.log_prob(g, r, alt_reading)) \
+                        < 1e-10
+
     def tearDown(self):
         pass
 
@@ -48,7 +48,7 @@ class ReadingQuestionTest(unittest.TestCase):
         real_readings = set(o.reading for o in \
                 partial_kanji.kanji.reading_set.all())
         for i in xrange(100):
-            question = self.factory.get_kanji_question(partial_kanji,
+            question = self.factory.get_question(partial_kanji,
                     self.user)
             distractor_values = set(o.value for o in \
                     question.options.all() if not o.is_correct)
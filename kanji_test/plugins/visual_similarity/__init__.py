@@ -12,8 +12,6 @@ Plugin for visual similarity.
 """
 
 import consoleLog
-from simplestats.comb import iunique_pairs
-from cjktools.exceptions import DomainError
 from django.core.exceptions import ObjectDoesNotExist
 
 from kanji_test.user_model import plugin_api as user_model_api
@@ -23,12 +21,19 @@ from kanji_test.drill import support
 from kanji_test.lexicon import models as lexicon_models
 from kanji_test import settings
 
-import metrics
-import threshold_graph
+import similarity_index
 
-_default_metric_name = 'stroke edit distance'
 _log = consoleLog.default
 
+def build():
+    """
+    Compiles the stroke file into its memory-mapped signature file, and
+    brings the similarity index up to date.
+    """
+    from metrics import stroke
+    stroke.build_signature_file()
+    similarity_index.update_index()
+
 class VisualSimilarity(user_model_api.SegmentedSeqPlugin):
     dist_name = "kanji' | kanji"
 
@@ -49,39 +54,32 @@ class VisualSimilarity(user_model_api.SegmentedSeqPlugin):
             lexicon_models.Kanji.objects.filter(
             partialkanji__syllabus=syllabus)])
 
-        _log.log('Generating similarity graph ', newLine=False)
+        _log.log('Generating similarity graph')
         graph = self._build_graph(kanji_set)
 
         _log.log('Storing priors')
         self._store_graph(graph, prior_dist)
+        prior_dist.invalidate()
 
         _log.finish()
 
     def _build_graph(self, kanji_set):
-        metric = metrics.metric_library[_default_metric_name]
-        graph = threshold_graph.ThresholdGraph(settings.MAX_GRAPH_DEGREE)
-        ignore_set = set()
-        for kanji_a, kanji_b in consoleLog.withProgress(
-                    iunique_pairs(kanji_set), 100):
-            if kanji_a in ignore_set or kanji_b in ignore_set:
-                continue
-
-            try:
-                weight = metric(kanji_a, kanji_b)
-            except DomainError, e:
-                kanji = e.message
-                ignore_set.add(kanji)
-                continue
-
-            graph.connect(kanji_a, kanji_b, weight)
-
+        """
+        Filters the similarity graph for the kanji set from the global
+        similarity index, first indexing any kanji which are new to it.
+        """
+        similarity_index.update_index()
+        graph = similarity_index.filter_graph(kanji_set,
+                settings.MAX_GRAPH_DEGREE)
         for kanji in kanji_set:
             graph.connect(kanji, kanji, 0.0)
 
         return graph
 
     def _store_graph(self, graph, prior_dist):
-        for label, edge_seq in graph._heaps.iteritems():
+        for label, linkset in graph._heaps.iteritems():
+            # Heap order depends on insertion order, so fix an order.
+            edge_seq = sorted(linkset)
             total_weight = 0.0
             for weight, neighbour_label in edge_seq:
                 total_weight += 1.0 - weight
@@ -163,5 +161,4 @@ class VisualSimilarityDrills(drill_api.MultipleChoiceFactoryI):
         question.add_options(distractors, question.pivot,
                 annotation_map=annotation_map)
         question.annotation = u'|'.join(segments)
-        question.save()
         return
@@ -1,107 +1,330 @@
-# 
+#
 #  stroke.pyx
 #  kanji_test
-#  
+#
 #  Created by Lars Yencken on 2008-09-15.
 #  Copyright 2008 Lars Yencken. All rights reserved.
-# 
+#
 
 """
 Optimised Levenstein distance calculation between stroke signatures for two
 kanji.
+
+Signatures are read from a compiled binary form of the stroke file, which is
+memory mapped on first use so that every process shares the same pages.
 """
 
 #----------------------------------------------------------------------------#
 
 import os
+import mmap
+import array
+import struct
 
+import numpy
 from cjktools.exceptions import DomainError
 from cjktools.common import sopen
 
 from kanji_test import settings
 
+cdef extern from "Python.h":
+    int PyObject_AsReadBuffer(object obj, void **buffer,
+            Py_ssize_t *buffer_len) except -1
+    int PyObject_AsWriteBuffer(object obj, void **buffer,
+            Py_ssize_t *buffer_len) except -1
+
 #----------------------------------------------------------------------------#
 
 _strokes_file = os.path.join(settings.DATA_DIR, 'structure', 'strokes_ulrich')
 
+# Header: magic, version, number of kanji, number of stroke types.
+_header = struct.Struct('=4sIII')
+_magic = 'STRK'
+_version = 1
+
+def build_signature_file(strokes_file=_strokes_file, signature_file=None):
+    """
+    Compiles the stroke file into a compact binary signature file. After the
+    header come the sorted kanji code points, the offset of each kanji's
+    strokes (plus a final end offset), one byte per stroke type, and lastly
+    the stroke type names.
+    """
+    signature_file = signature_file or strokes_file + '.bin'
+    stroke_types = {}
+    type_names = []
+    signatures = {}
+    i_stream = sopen(strokes_file)
+    for line in i_stream:
+        kanji, raw_strokes = line.rstrip().split()
+        strokes = []
+        for raw_stroke in raw_strokes.split(','):
+            if raw_stroke not in stroke_types:
+                stroke_types[raw_stroke] = len(type_names)
+                type_names.append(raw_stroke)
+            strokes.append(stroke_types[raw_stroke])
+        signatures[ord(kanji)] = strokes
+    i_stream.close()
+
+    if len(type_names) > 256:
+        raise ValueError, "too many stroke types"
+
+    code_points = sorted(signatures)
+    offsets = array.array('I', [0])
+    stroke_array = array.array('B')
+    for code_point in code_points:
+        stroke_array.extend(signatures[code_point])
+        offsets.append(len(stroke_array))
+
+    # Write to a temporary file first, so that no process ever maps a
+    # partial file.
+    tmp_file = '%s.%d' % (signature_file, os.getpid())
+    o_stream = open(tmp_file, 'wb')
+    o_stream.write(_header.pack(_magic, _version, len(code_points),
+            len(type_names)))
+    array.array('I', code_points).tofile(o_stream)
+    offsets.tofile(o_stream)
+    stroke_array.tofile(o_stream)
+    o_stream.write(u'\n'.join(type_names).encode('utf8'))
+    o_stream.close()
+    os.rename(tmp_file, signature_file)
+
 cdef class StrokeEditDistance:
     """The edit distance between stroke sequences for both kanji."""
-    cdef readonly signatures
-    cdef readonly object stroke_types
-    cdef readonly int n_stroke_types
-
-    def __init__(self):
-        self.stroke_types = {}
-        self.n_stroke_types = 0
-
-        # Convert stroke sequence to integer sequences by constructing a 
-        # mapping from stroke types to integers.
-        self.signatures = {}
-        i_stream = sopen(_strokes_file)
-        for i, line in enumerate(i_stream):
-            kanji, raw_strokes = line.rstrip().split()
-            raw_strokes = raw_strokes.split(',')
-            strokes = []
-            for raw_stroke in raw_strokes:
-                strokes.append(self._get_stroke_type(raw_stroke))
-            self.signatures[kanji] = strokes
-        i_stream.close()
-
-    cdef _get_stroke_type(self, stroke):
+    cdef readonly object strokes_file
+    cdef readonly object signature_file
+    cdef object _mmap
+    cdef object _signatures
+    cdef object _type_names
+    cdef int _n_kanji
+    cdef unsigned int* _code_points
+    cdef unsigned int* _offsets
+    cdef unsigned char* _strokes
+
+    def __init__(self, strokes_file=_strokes_file):
+        # Loading is deferred until first use, to keep imports cheap.
+        self.strokes_file = strokes_file
+        self.signature_file = strokes_file + '.bin'
+        self._mmap = None
+
+    cdef _load(self):
+        "Maps the signature file, compiling it first if it is out of date."
+        cdef void* buffer
+        cdef Py_ssize_t buffer_len
+        cdef char* base
+        cdef int header_size
+
+        if self._mmap is not None:
+            return
+
+        if os.path.exists(self.strokes_file) and (
+                not os.path.exists(self.signature_file) or
+                os.path.getmtime(self.signature_file) <
+                os.path.getmtime(self.strokes_file)):
+            build_signature_file(self.strokes_file, self.signature_file)
+
+        i_stream = open(self.signature_file, 'rb')
         try:
-            return self.stroke_types[stroke]
-        except KeyError:
-            pass
+            signature_map = mmap.mmap(i_stream.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        finally:
+            i_stream.close()
+
+        magic, version, n_kanji, n_types = _header.unpack(
+                signature_map[:_header.size])
+        if magic != _magic or version != _version:
+            raise ValueError, "bad signature file %s" % self.signature_file
+
+        PyObject_AsReadBuffer(signature_map, &buffer, &buffer_len)
+        base = <char*> buffer
+        header_size = _header.size
+        self._n_kanji = n_kanji
+        self._code_points = <unsigned int*> (base + header_size)
+        self._offsets = self._code_points + self._n_kanji
+        self._strokes = <unsigned char*> (self._offsets + self._n_kanji + 1)
+        self._mmap = signature_map
+
+    cdef int _find(self, kanji) except -2:
+        """
+        Finds the kanji's position by binary search over the code points,
+        returning -1 if it has no signature.
+        """
+        cdef int lo, hi, mid
+        cdef unsigned int code_point
+
+        if len(kanji) != 1:
+            return -1
+        code_point = ord(kanji)
+
+        lo = 0
+        hi = self._n_kanji
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self._code_points[mid] < code_point:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self._n_kanji or self._code_points[lo] != code_point:
+            return -1
 
-        self.stroke_types[stroke] = self.n_stroke_types
-        self.n_stroke_types = self.n_stroke_types + 1
+        return lo
+
+    cdef unsigned char* _get_signature(self, kanji, int* length) except NULL:
+        "Returns a pointer to the kanji's strokes, setting their length."
+        cdef int i
+        self._load()
+        i = self._find(kanji)
+        if i < 0:
+            raise DomainError, kanji
+
+        length[0] = self._offsets[i + 1] - self._offsets[i]
+        return self._strokes + self._offsets[i]
+
+    def known_kanji(self):
+        "Returns a list of every kanji with a known signature."
+        cdef int i
+        self._load()
+        return [unichr(self._code_points[i]) for i in range(self._n_kanji)]
+
+    property signatures:
+        """
+        A dictionary from each kanji to its list of stroke types. This is
+        built on first access, and is best avoided outside of testing.
+        """
+        def __get__(self):
+            cdef int i, k
+            if self._signatures is None:
+                self._load()
+                signatures = {}
+                for i from 0 <= i < self._n_kanji:
+                    signature = []
+                    for k from self._offsets[i] <= k < self._offsets[i + 1]:
+                        signature.append(self._strokes[k])
+                    signatures[unichr(self._code_points[i])] = signature
+                self._signatures = signatures
+            return self._signatures
+
+    property stroke_types:
+        "A dictionary from each stroke type name to its number."
+        def __get__(self):
+            if self._type_names is None:
+                self._load()
+                names_start = _header.size + 4 * (2 * self._n_kanji + 1) + \
+                        self._offsets[self._n_kanji]
+                self._type_names = self._mmap[names_start:].decode(
+                        'utf8').split(u'\n')
+            return dict((name, i) for (i, name) in
+                    enumerate(self._type_names))
+
+    property n_stroke_types:
+        def __get__(self):
+            return len(self.stroke_types)
 
-        return self.n_stroke_types - 1
-    
     def raw_distance(self, kanji_a, kanji_b):
-        try:
-            s_py = self.signatures[kanji_a]
-            t_py = self.signatures[kanji_b]
-        except KeyError, e:
-            raise DomainError, e
+        cdef unsigned char* s
+        cdef unsigned char* t
+        cdef int s_len, t_len
+        s = self._get_signature(kanji_a, &s_len)
+        t = self._get_signature(kanji_b, &t_len)
 
-        return edit_distance(s_py, t_py)
+        return edit_distance(s, s_len, t, t_len)
 
     def __call__(self, kanji_a, kanji_b):
-        try:
-            s_py = self.signatures[kanji_a]
-            t_py = self.signatures[kanji_b]
-        except KeyError, e:
-            raise DomainError, e
+        cdef unsigned char* s
+        cdef unsigned char* t
+        cdef int s_len, t_len, result
+        s = self._get_signature(kanji_a, &s_len)
+        t = self._get_signature(kanji_b, &t_len)
+
+        result = edit_distance(s, s_len, t, t_len)
+        return float(result) / max(s_len, t_len)
+
+    def distances(self, kanji, candidates=None):
+        """
+        Returns a numpy array of the normalised distances from the kanji to
+        each candidate, in a single pass over the packed signatures. The
+        candidates default to every known kanji, in the order given by
+        known_kanji(). Candidates with no signature get a distance of NaN.
+        """
+        cdef unsigned char* s
+        cdef int s_len, t_len, i, j, n
+        cdef double* out
+        cdef double nan
+        cdef void* buffer
+        cdef Py_ssize_t buffer_len
+
+        s = self._get_signature(kanji, &s_len)
+        if candidates is None:
+            n = self._n_kanji
+        else:
+            candidates = list(candidates)
+            n = len(candidates)
+
+        result = numpy.empty(n, dtype=numpy.float64)
+        PyObject_AsWriteBuffer(result, &buffer, &buffer_len)
+        out = <double*> buffer
+        nan = float('nan')
+        for j from 0 <= j < n:
+            if candidates is None:
+                i = j
+            else:
+                i = self._find(candidates[j])
+                if i < 0:
+                    out[j] = nan
+                    continue
+
+            t_len = self._offsets[i + 1] - self._offsets[i]
+            out[j] = (<double> edit_distance(s, s_len,
+                    self._strokes + self._offsets[i], t_len)) / \
+                    max(s_len, t_len)
+
+        return result
+
+    def bounded(self, kanji_a, kanji_b, double max_weight):
+        """
+        As for calling the metric directly, but returns None instead if the
+        distance is certain to exceed max_weight. Distances are normalised,
+        so any max_weight of 1.0 or more forces a full calculation.
+        """
+        cdef unsigned char* s
+        cdef unsigned char* t
+        cdef int s_len, t_len, max_len, max_dist, result
+        s = self._get_signature(kanji_a, &s_len)
+        t = self._get_signature(kanji_b, &t_len)
+
+        max_len = max(s_len, t_len)
+        if max_weight >= 1.0:
+            result = edit_distance(s, s_len, t, t_len)
+            return float(result) / max_len
+
+        # The largest raw distance which is no more than max_weight, with
+        # some slack for rounding error.
+        max_dist = <int> (max_weight * max_len + 1e-9)
+        if abs(s_len - t_len) > max_dist:
+            return None
 
-        result = edit_distance(s_py, t_py)
-        return float(result) / max(len(s_py), len(t_py))
+        result = bounded_edit_distance(s, s_len, t, t_len, max_dist)
+        if result > max_dist:
+            return None
+
+        return float(result) / max_len
 
 #----------------------------------------------------------------------------#
 
-cdef edit_distance(s_py, t_py):
-    cdef int m, n, i, j
+cdef int edit_distance(unsigned char* s, int s_len, unsigned char* t,
+        int t_len) except -1:
+    cdef int i, j
     cdef int table[50][50]
-    cdef int s[50]
-    cdef int t[50]
     cdef int up, left, diag, cost
 
-    s_len = len(s_py)
-    t_len = len(t_py)
     if s_len > 49 or t_len > 49:
         raise ValueError, "stroke sequences too long"
 
-    # Copy s_py to s
-    for i from 0 <= i < s_len:
+    for i from 0 <= i <= s_len:
         table[i][0] = i
-        s[i] = s_py[i]
-    table[s_len][0] = s_len
 
-    # Copy t_py to t
-    for j from 0 <= j < t_len:
+    for j from 0 <= j <= t_len:
         table[0][j] = j
-        t[j] = t_py[j]
-    table[0][t_len] = t_len
 
     # Perform edit distance
     for i from 1 <= i <= s_len:
@@ -129,4 +352,79 @@ cdef edit_distance(s_py, t_py):
 
     return table[s_len][t_len]
 
+cdef int bounded_edit_distance(unsigned char* s, int s_len, unsigned char* t,
+        int t_len, int k) except -1:
+    """
+    The edit distance between the sequences if it is at most k, otherwise
+    k + 1. Only cells within k of the diagonal are filled, and we stop as
+    soon as a whole row exceeds k.
+    """
+    cdef int i, j, j_lo, j_hi, row_min, too_far
+    cdef int table[50][50]
+    cdef int up, left, diag, cost
+
+    if s_len > 49 or t_len > 49:
+        raise ValueError, "stroke sequences too long"
+
+    # Any distance beyond k is as good as any other, so cells outside the
+    # band are given k + 1.
+    too_far = k + 1
+
+    for j from 0 <= j <= t_len:
+        if j <= k:
+            table[0][j] = j
+        else:
+            table[0][j] = too_far
+
+    for i from 1 <= i <= s_len:
+        j_lo = i - k
+        if j_lo < 1:
+            j_lo = 1
+        j_hi = i + k
+        if j_hi > t_len:
+            j_hi = t_len
+
+        # Fence off the cells just outside the band.
+        if j_lo == 1:
+            if i <= k:
+                table[i][0] = i
+            else:
+                table[i][0] = too_far
+        else:
+            table[i][j_lo - 1] = too_far
+        if i + k <= t_len:
+            table[i - 1][i + k] = too_far
+
+        row_min = table[i][j_lo - 1]
+        for j from j_lo <= j <= j_hi:
+            if s[i-1] == t[j-1]:
+                cost = 0
+            else:
+                cost = 1
+
+            up = table[i-1][j] + 1
+            left = table[i][j-1] + 1
+            diag = table[i-1][j-1] + cost
+            if up <= left:
+                if up <= diag:
+                    table[i][j] = up
+                else:
+                    table[i][j] = diag
+            else:
+                if left <= diag:
+                    table[i][j] = left
+                else:
+                    table[i][j] = diag
+
+            if table[i][j] < row_min:
+                row_min = table[i][j]
+
+        if row_min > k:
+            return too_far
+
+    if table[s_len][t_len] > k:
+        return too_far
+
+    return table[s_len][t_len]
+
 #----------------------------------------------------------------------------#
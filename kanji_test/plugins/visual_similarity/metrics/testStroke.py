@@ -38,6 +38,11 @@ class StrokeTestCase(unittest.TestCase):
                 "%s has incorrect signature length %d (expected %d)" % \
                 (kanji, actualCount, expectedCount)
 
+    def testKnownKanji(self):
+        """Every kanji with a signature is known."""
+        self.assertEqual(sorted(self.dist.signatures),
+                sorted(self.dist.known_kanji()))
+
     def testBasics(self):
         hi = u'日' # 4 strokes
         me = u'目' # 5 strokes
@@ -57,6 +62,42 @@ class StrokeTestCase(unittest.TestCase):
         self.assertAlmostEqual(0.2, self.dist(shiro, hi))
         self.assertAlmostEqual(0.4, self.dist(shiro, me))
         self.assertAlmostEqual(0.4, self.dist(me, shiro))
+
+    def testDistances(self):
+        """Batch distances agree with pairwise ones."""
+        hi = u'日'
+        kanji = self.dist.known_kanji()
+        distances = self.dist.distances(hi)
+        self.assertEqual(len(kanji), len(distances))
+        for other_kanji, distance in zip(kanji, distances):
+            self.assertEqual(self.dist(hi, other_kanji), distance)
+
+        distances = self.dist.distances(hi, [u'目', u'x', u'白'])
+        self.assertAlmostEqual(0.2, distances[0])
+        assert distances[1] != distances[1] # NaN
+        self.assertAlmostEqual(0.2, distances[2])
+
+    def testBounded(self):
+        """Bounded distances agree with the full distance, or are None."""
+        hi = u'日'
+        me = u'目'
+        shiro = u'白'
+        self.assertAlmostEqual(0.4, self.dist.bounded(shiro, me, 1.0))
+        self.assertAlmostEqual(0.4, self.dist.bounded(shiro, me, 0.4))
+        self.assertEqual(None, self.dist.bounded(shiro, me, 0.3))
+        self.assertAlmostEqual(0.2, self.dist.bounded(hi, me, 0.2))
+        self.assertEqual(None, self.dist.bounded(hi, me, 0.0))
+
+        kanji = sorted(self.dist.signatures)[:100]
+        for kanji_a in kanji:
+            for kanji_b in kanji:
+                weight = self.dist(kanji_a, kanji_b)
+                for max_weight in (0.0, 0.25, 0.5, weight):
+                    bounded = self.dist.bounded(kanji_a, kanji_b, max_weight)
+                    if weight <= max_weight:
+                        self.assertEqual(weight, bounded)
+                    else:
+                        assert bounded in (None, weight)
     
     def tearDown(self):
         pass
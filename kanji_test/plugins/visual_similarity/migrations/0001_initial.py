@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.plugins.visual_similarity.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        "Adds the global index of visually similar kanji."
+        # Model 'SimilarityLink'
+        db.create_table('visual_similarity_similaritylink', (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            ('kanji', models.CharField(max_length=3, db_index=True)),
+            ('neighbour', models.CharField(max_length=3)),
+            ('weight', models.FloatField()),
+        ))
+        db.create_index('visual_similarity_similaritylink', ['kanji','neighbour'], unique=True, db_tablespace='')
+        
+    def backwards(self, orm):
+        db.delete_table('visual_similarity_similaritylink')
+    
+    complete_apps = ['visual_similarity']
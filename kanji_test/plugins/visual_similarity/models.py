@@ -7,3 +7,22 @@
 #  Copyright 2008 Lars Yencken. All rights reserved.
 # 
 
+from django.db import models
+
+class SimilarityLink(models.Model):
+    """
+    A link from a kanji to one of its nearest neighbours by stroke edit
+    distance, amongst every kanji in the stroke file.
+    """
+    kanji = models.CharField(max_length=3, db_index=True)
+    neighbour = models.CharField(max_length=3)
+    weight = models.FloatField()
+
+    class Meta:
+        unique_together = (('kanji', 'neighbour'),)
+
+    def __unicode__(self):
+        return u'%s -> %s (%.02f)' % (self.kanji, self.neighbour,
+                self.weight)
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
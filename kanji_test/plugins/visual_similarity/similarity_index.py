@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# 
+#  similarity_index.py
+#  kanji_test
+#  
+#  Created by agent on 2026-10-17.
+# 
+
+"""
+A global index of the nearest neighbours of every kanji in the stroke file,
+from which the similarity graph for any syllabus can be filtered without
+recomputing pairwise distances.
+"""
+
+import multiprocessing
+
+import consoleLog
+from cjktools.exceptions import DomainError
+from django.db import connection, transaction
+from simplestats.sequences import groups_of_n
+
+from kanji_test import settings
+from kanji_test.plugins.visual_similarity.models import SimilarityLink
+
+import metrics
+import threshold_graph
+
+default_metric_name = 'stroke edit distance'
+_log = consoleLog.default
+
+def update_index():
+    """
+    Brings the index up to date with the stroke file, computing distances
+    only for kanji which are not yet indexed. Returns the number of kanji
+    added. Delete every SimilarityLink to rebuild from scratch, for example
+    after changing SIMILARITY_INDEX_DEGREE.
+    """
+    metric = metrics.metric_library[default_metric_name]
+    indexed = set(SimilarityLink.objects.values_list('kanji',
+            flat=True).distinct())
+    new_kanji = sorted(set(metric.known_kanji()).difference(indexed))
+    if not new_kanji:
+        return 0
+
+    _log.log('Indexing %d new kanji' % len(new_kanji))
+    degree = settings.SIMILARITY_INDEX_DEGREE
+    graph = threshold_graph.ThresholdGraph(degree)
+    for kanji, neighbour, weight in SimilarityLink.objects.values_list(
+            'kanji', 'neighbour', 'weight'):
+        graph[kanji].add(neighbour, weight)
+
+    # Only pairs involving a new kanji need computing.
+    graph.merge(build_graph(new_kanji + sorted(indexed), degree,
+            n_rows=len(new_kanji)))
+    _store_index(graph)
+    return len(new_kanji)
+
+def filter_graph(kanji_set, max_degree):
+    """
+    Builds the similarity graph over the kanji set from the index, keeping
+    the same links as connecting every pair in the set directly.
+
+    A kanji's indexed neighbours are its nearest overall, so those within
+    the set are its nearest within the set. The exception is when too few
+    of them are in the set to fill its links, in which case that kanji is
+    compared directly against the rest of the set.
+    """
+    metric = metrics.metric_library[default_metric_name]
+    graph = threshold_graph.ThresholdGraph(max_degree)
+    n_indexed_links = {}
+    for kanji_group in groups_of_n(500, sorted(kanji_set)):
+        for kanji, neighbour, weight in SimilarityLink.objects.filter(
+                kanji__in=kanji_group).values_list('kanji', 'neighbour',
+                'weight'):
+            n_indexed_links[kanji] = n_indexed_links.get(kanji, 0) + 1
+            if neighbour in kanji_set:
+                graph[kanji].add(neighbour, weight)
+
+    if not n_indexed_links:
+        return graph
+
+    # Lists shorter than the longest were never truncated, so they are
+    # already complete.
+    index_degree = max(n_indexed_links.itervalues())
+    indexed = set(n_indexed_links)
+    for kanji in indexed:
+        if n_indexed_links[kanji] == index_degree and \
+                len(graph[kanji].get_links()) < max_degree:
+            neighbours = [n for n in indexed if n != kanji]
+            linkset = threshold_graph.ThresholdLinkset(max_degree)
+            for neighbour, weight in zip(neighbours,
+                    metric.distances(kanji, neighbours)):
+                linkset.add(neighbour, float(weight))
+            graph._heaps[kanji] = linkset
+
+    return graph
+
+def build_graph(kanji_list, max_degree, n_rows=None):
+    """
+    Connects each of the first n_rows kanji in the list to every kanji after
+    it, by default giving every unique pair. The rows are split across
+    GRAPH_BUILD_WORKERS processes and their graphs merged. Each node keeps
+    only its lowest weight links, so the merged graph is the same as one
+    built serially.
+    """
+    if n_rows is None:
+        n_rows = len(kanji_list)
+    n_workers = max(1, min(settings.GRAPH_BUILD_WORKERS or
+            multiprocessing.cpu_count(), n_rows))
+    jobs = [(kanji_list, offset, n_workers, n_rows, max_degree)
+            for offset in xrange(n_workers)]
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            partial_graphs = pool.map(_build_partial_graph, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partial_graphs = map(_build_partial_graph, jobs)
+
+    graph = threshold_graph.ThresholdGraph(max_degree)
+    for partial_graph in partial_graphs:
+        graph.merge(partial_graph)
+
+    return graph
+
+#----------------------------------------------------------------------------#
+
+def _build_partial_graph(args):
+    """
+    Builds the similarity graph over the pairs (kanji_list[i], kanji_list[j])
+    with i < j, for every row i = offset, offset + step, ... below n_rows.
+    Interleaving the rows balances work between workers, since later rows
+    are shorter.
+
+    Pairs whose distance must exceed the worst link kept at both ends are
+    abandoned early, since they could never be kept.
+    """
+    kanji_list, offset, step, n_rows, max_degree = args
+    metric = metrics.metric_library[default_metric_name]
+    graph = threshold_graph.ThresholdGraph(max_degree)
+    ignore_set = set()
+    n_kanji = len(kanji_list)
+    for i in xrange(offset, n_rows, step):
+        kanji_a = kanji_list[i]
+        if kanji_a in ignore_set:
+            continue
+
+        for j in xrange(i + 1, n_kanji):
+            kanji_b = kanji_list[j]
+            if kanji_b in ignore_set:
+                continue
+
+            max_weight = max(graph[kanji_a].max_weight(),
+                    graph[kanji_b].max_weight())
+            try:
+                weight = metric.bounded(kanji_a, kanji_b, max_weight)
+            except DomainError, e:
+                kanji = e.message
+                ignore_set.add(kanji)
+                if kanji_a in ignore_set:
+                    break
+                continue
+
+            if weight is not None:
+                graph.connect(kanji_a, kanji_b, weight)
+
+    return graph
+
+@transaction.commit_on_success
+def _store_index(graph):
+    "Replaces the stored index with the links in the graph."
+    SimilarityLink.objects.all().delete()
+    rows = [(kanji, neighbour, weight)
+            for (kanji, linkset) in graph._heaps.iteritems()
+            for (weight, neighbour) in linkset]
+
+    quote_name = connection.ops.quote_name
+    cursor = connection.cursor()
+    for row_set in groups_of_n(settings.N_ROWS_PER_INSERT, rows):
+        cursor.executemany(
+                """
+                INSERT INTO %s (kanji, neighbour, weight)
+                VALUES (%%s, %%s, %%s)
+                """ % quote_name(SimilarityLink._meta.db_table),
+                row_set
+            )
+    return
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
@@ -34,6 +34,21 @@ class ThresholdLinkset(object):
 
     def get_links(self):
         return self._heap
+
+    def max_weight(self):
+        """
+        The weight of the worst link kept, which any new link must not
+        exceed to be kept. Infinite until the linkset is full.
+        """
+        if len(self._heap) < self._max_degree:
+            return float('inf')
+        return -self._heap[0][0]
+
+    def __getstate__(self):
+        return self._max_degree, self._heap
+
+    def __setstate__(self, state):
+        self._max_degree, self._heap = state
     
     def __iter__(self):
         for neg_weight, label in self._heap:
@@ -67,5 +82,18 @@ class ThresholdGraph(object):
                 ThresholdLinkset(self._max_degree)
             )
     
+    def merge(self, other):
+        """
+        Adds the links kept by another graph over a disjoint set of pairs, so
+        that the result is as if both sets of pairs were connected here.
+        """
+        for label, linkset in other._heaps.iteritems():
+            own_linkset = self[label]
+            for weight, neighbour_label in linkset:
+                own_linkset.add(neighbour_label, weight)
+        self._n_links += other._n_links
+        self._sum += other._sum
+        self._sum_squared += other._sum_squared
+
     def labels(self):
         return self.heaps.labels()
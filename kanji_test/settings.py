@@ -156,9 +156,28 @@ N_DISTRACTORS = 5
 QUESTIONS_PER_SET = 10
 QUESTIONS_PER_PAGE = 5
 
+# drill; when True, error model updates from responses are queued and
+# applied by the apply_updates command, instead of during the request
+DEFERRED_UPDATES = True
+UPDATE_BATCH_SIZE = 500
+
+# drill; the number of distractors precomputed per pivot for non-adaptive
+# plugins
+DISTRACTOR_POOL_SIZE = 30
+
+# user_model; the number of seconds before an in-memory syllabus index is
+# rebuilt, in case its syllabus was changed by another process
+SYLLABUS_INDEX_MAX_AGE = 60 * 60
+
+# user_model; the total number of symbols held across all cached
+# per-user error distributions in each process
+ERROR_DIST_CACHE_SIZE = 200000
+
 # visual_similarity
 MIN_TOTAL_DISTRACTORS = 15
 MAX_GRAPH_DEGREE = MIN_TOTAL_DISTRACTORS
+GRAPH_BUILD_WORKERS = None # processes building the graph; None for all cores
+SIMILARITY_INDEX_DEGREE = 10 * MAX_GRAPH_DEGREE # neighbours indexed per kanji
 
 # reading_alt
 ALTERNATION_ALPHA = 0.5
@@ -167,6 +186,11 @@ PALATALIZATION_ALPHA = 0.05
 MAX_READING_LENGTH = 30
 UTF8_BYTES_PER_CHAR = 3 # For cjk chars
 
+# analysis; computed charts are cached on disk, and rebuilt by the
+# refresh_charts command once older than ANALYSIS_CACHE_MAX_AGE seconds
+ANALYSIS_CACHE_DIR = path.join(PROJECT_ROOT, 'cache', 'analysis')
+ANALYSIS_CACHE_MAX_AGE = 24 * 60 * 60
+
 # registration
 ACCOUNT_ACTIVATION_DAYS = 15
 
@@ -2,42 +2,85 @@
 #
 #  build.py
 #  kanji_test
-# 
+#
 #  Created by Lars Yencken on 18-09-2008.
 #  Copyright 2008 Lars Yencken. All rights reserved.
 #
 
 """
-A command to run the build method of all apps.
+A command to run the build method of all apps, running independent stages
+in parallel.
 """
 
-from os import path 
+import time
+from optparse import make_option
 
-from django.core.management.base import NoArgsCommand
-from django.conf import settings 
+from django.core.management.base import NoArgsCommand, CommandError
+from django.conf import settings
+from django.db import connection
 import consoleLog
 
-from kanji_test.lexicon import load_lexicon
-from kanji_test.user_model import plugin_api
-from kanji_test.user_model import add_syllabus
+from kanji_test.util import pipeline
 
 _log = consoleLog.default
 
 class Command(NoArgsCommand):
     help = "Builds all required static database tables."
     requires_model_validation = True
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', dest='workers',
+            type='int', default=None,
+            help='The number of stages to run at once [one per core, or '
+                'one for SQLite].'),
+    )
 
     def handle_noargs(self, **options):
-        apps_with_build = []
-        for app_path in settings.INSTALLED_APPS:
-            base_module = __import__(app_path)
-            app_module = reduce(getattr, app_path.split('.')[1:], base_module)
-            if hasattr(app_module, 'build'):
-                apps_with_build.append((app_path, app_module))
-
-        _log.start('Building kanji_test', nSteps=len(apps_with_build))
-        for app_path, app_module in apps_with_build:
-            app_module.build()
-        _log.finish()
+        workers = options['workers']
+        if workers is None and connection.vendor == 'sqlite':
+            # SQLite only allows one writer at a time.
+            workers = 1
+
+        stages = _find_app_stages(settings.INSTALLED_APPS)
+        _log.start('Building kanji_test', nSteps=len(stages))
+        start_time = time.time()
+        try:
+            pipeline.run_stages(stages, max_workers=workers, log=_log)
+        except pipeline.BuildError, e:
+            raise CommandError(str(e))
+        _log.finish('%.1fs in total' % (time.time() - start_time))
+
+def _find_app_stages(app_paths):
+    """
+    Collects the build stages of every app. An app's build() function
+    becomes a stage named by the app's path, which runs after the apps
+    listed in its build_depends_on. An app may instead split its build
+    into stages of its own by providing build_stages(); depending on such
+    an app means depending on all of its stages. Each stage skips itself
+    when its checksum shows it is already up-to-date.
+    """
+    app_stages = {}
+    for app_path in app_paths:
+        base_module = __import__(app_path)
+        app_module = reduce(getattr, app_path.split('.')[1:], base_module)
+        if hasattr(app_module, 'build_stages'):
+            app_stages[app_path] = app_module.build_stages()
+        elif hasattr(app_module, 'build'):
+            app_stages[app_path] = [pipeline.Stage(app_path, app_module.build,
+                    depends_on=getattr(app_module, 'build_depends_on', []))]
+
+    stages = []
+    for app_path in app_paths:
+        for stage in app_stages.get(app_path, []):
+            depends_on = []
+            for name in stage.depends_on:
+                if name in app_stages:
+                    depends_on.extend(s.name for s in app_stages[name])
+                elif name not in app_paths:
+                    depends_on.append(name)
+                # Otherwise an installed app with nothing to build.
+            stage.depends_on = depends_on
+            stages.append(stage)
+
+    return stages
 
 # vim: ts=4 sw=4 sts=4 et tw=78:
@@ -11,11 +11,27 @@
 All aspects of user proficiency and error modeling.
 """
 
+from django.conf import settings
+
 # Dependencies
 from kanji_test import util as _requires_util
 from kanji_test import lexicon as _requires_lexicon
 import checksum as _requires_checksum
 
+# Syllabi draw on the lexicon and on the priors of each user model plugin.
+build_depends_on = ['kanji_test.lexicon'] + [plugin_path.rsplit('.', 1)[0]
+        for plugin_path in settings.USER_MODEL_PLUGINS]
+
 def build():
     import add_syllabus
     add_syllabus.add_all_syllabi()
+
+def build_stages():
+    "Builds each syllabus in its own stage, so that they may run in parallel."
+    import add_syllabus
+    import bundle
+    from kanji_test.util.pipeline import Stage
+    return [Stage('syllabus %s' % syllabus_name,
+                add_syllabus.add_syllabus_if_needed, args=(syllabus_name,),
+                depends_on=build_depends_on)
+            for syllabus_name in bundle.list_names()]
@@ -42,19 +42,28 @@ def add_all_syllabi(force=False):
     syllabi = bundle.list_names()
     _log.start('Adding all syllabi', nSteps=len(syllabi))
 
-    dependencies = []
-    for syllabus in syllabi:
-        dependencies.extend(bundle.SyllabusBundle.get_dependencies(syllabus))
+    for syllabus_name in syllabi:
+        add_syllabus_if_needed(syllabus_name, force=force)
+    _log.finish()
 
-    if not force and not Checksum.needs_update('syllabi', dependencies,
+def add_syllabus_if_needed(syllabus_name, force=False):
+    """
+    Adds the given syllabus unless it is up-to-date with its bundle and the
+    lexicon. Each syllabus is checksummed separately, so that syllabi can
+    be built independently of one another.
+    """
+    dependencies = bundle.SyllabusBundle.get_dependencies(syllabus_name)
+    tag = syllabus_checksum_tag(syllabus_name)
+    if not force and not Checksum.needs_update(tag, dependencies,
             ['lexicon']):
-        _log.finish('Already up-to-date')
+        _log.log('%s already up-to-date' % syllabus_name)
         return
-        
-    for syllabus_name in syllabi:
-        add_syllabus(syllabus_name, force=force)
-    Checksum.store('syllabi', dependencies)
-    _log.finish()
+
+    add_syllabus(syllabus_name, force=force)
+    Checksum.store(tag, dependencies)
+
+def syllabus_checksum_tag(syllabus_name):
+    return 'syllabus %s' % syllabus_name
 
 #----------------------------------------------------------------------------#
 
@@ -207,10 +216,12 @@ def _store_words(syllabus, syllabus_bundle):
         partial_lexeme = _find_in_lexicon(word, skipped_words, syllabus)
         if partial_lexeme:
             n_ok += 1
-    _log.log('%d ok, %d skipped (see skipped.log)' % (n_ok,
-            len(skipped_words)))
+    # Syllabi may be built in parallel, so each gets its own log.
+    skipped_log = 'skipped_%s.log' % syllabus.tag.replace(' ', '_')
+    _log.log('%d ok, %d skipped (see %s)' % (n_ok, len(skipped_words),
+            skipped_log))
 
-    o_stream = sopen('skipped.log', 'w')
+    o_stream = sopen(skipped_log, 'w')
     vim_header = "# vim: set ts=20 noet sts=20:"
     print >> o_stream, vim_header
     for word, reason in skipped_words:
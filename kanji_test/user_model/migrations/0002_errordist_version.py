@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.user_model.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        "Adds a version counter to error distributions."
+        db.add_column('user_model_errordist', 'version',
+                models.IntegerField(default=0))
+    
+    def backwards(self, orm):
+        db.delete_column('user_model_errordist', 'version')
+    
+    complete_apps = ['user_model']
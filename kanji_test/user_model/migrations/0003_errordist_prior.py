@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from south.db import db
+from django.db import models
+from kanji_test.user_model.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        "Links error distributions to the prior they overlay."
+        # Mock Models
+        PriorDist = db.mock_model(model_name='PriorDist', db_table='user_model_priordist', db_tablespace='', pk_field_name='id', pk_field_type=models.AutoField, pk_field_args=[], pk_field_kwargs={})
+        
+        db.add_column('user_model_errordist', 'prior',
+                models.ForeignKey(PriorDist, null=True, blank=True))
+    
+    def backwards(self, orm):
+        db.delete_column('user_model_errordist', 'prior_id')
+    
+    complete_apps = ['user_model']
@@ -8,8 +8,10 @@
 # 
 
 import random
+import time
 
 from django.db import models, connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
@@ -17,7 +19,9 @@ from cjktools import scripts
 
 from kanji_test.lexicon import models as lexicon_models
 from kanji_test.util import models as util_models
-from kanji_test.util.probability import ProbDist, SeqDist
+from kanji_test.util.probability import ProbDist, ArrayProbDist, SeqDist, \
+        LazySeqDist, update_densities
+from kanji_test.util.cache import SizedLRUCache
 from kanji_test.util import alignment
 
 class Syllabus(models.Model):
@@ -34,19 +38,28 @@ class Syllabus(models.Model):
     def tag_without_spaces(self):
         return self.tag.replace(' ', '_')
 
+    def get_index(self):
+        "Returns the in-memory item index for this syllabus."
+        return SyllabusIndex.get(self.id)
+    index = property(get_index)
+
     def get_random_item(self):
         "Returns a random item from this syllabus, either kanji or lexeme."
-        if random.random() < self._get_word_proportion():
-            return self.partiallexeme_set.order_by('?')[0]
+        index = self.index
+        if random.random() < index.word_proportion:
+            return PartialLexeme.objects.get(id=random.choice(
+                    index.lexeme_ids))
         else:
-            return self.partialkanji_set.order_by('?')[0]
+            return PartialKanji.objects.get(id=random.choice(
+                    index.kanji_ids))
 
     def get_random_items(self, n):
         if n < 1:
             raise ValueError(n)
+        index = self.index
         n_words = 0
         n_kanji = 0
-        word_proportion = self._get_word_proportion()
+        word_proportion = index.word_proportion
         for i in xrange(n):
             if random.random() < word_proportion:
                 n_words += 1
@@ -55,41 +68,34 @@ class Syllabus(models.Model):
 
         items = []
         if n_words > 0:
-            items.extend(self.partiallexeme_set.order_by('?')[:n_words])
+            items.extend(_fetch_sample(PartialLexeme, index.lexeme_ids,
+                    n_words))
 
         if n_kanji > 0:
-            items.extend(self.partialkanji_set.order_by('?')[:n_kanji])
+            items.extend(_fetch_sample(PartialKanji, index.kanji_ids,
+                    n_kanji))
 
         return items
 
     def sample_senses(self, n):
-        return lexicon_models.LexemeSense.objects.filter(
-                lexeme__partiallexeme__syllabus=self).order_by('?')[:n]
+        return _fetch_sample(lexicon_models.LexemeSense,
+                self.index.sense_ids, n)
 
     def get_random_kanji_item(self):
-        if random.random() < self._get_kanji_word_proportion():
-            return self.partiallexeme_set.filter(
-                    surface_set__has_kanji=True).order_by('?')[0]
+        index = self.index
+        if random.random() < index.kanji_word_proportion:
+            return PartialLexeme.objects.get(id=random.choice(
+                    index.kanji_lexeme_ids))
         else:
-            return self.partialkanji_set.order_by('?')[0]
+            return PartialKanji.objects.get(id=random.choice(
+                    index.kanji_ids))
 
     def _get_word_proportion(self):
         "Determine the raw proportion of syllabus items which are words."
-        if not hasattr(self, '_cached_word_prop'):
-            n_words = self.partiallexeme_set.count()
-            n_kanji = self.partialkanji_set.count()
-            self._cached_word_prop = float(n_words) / (n_words + n_kanji)
-        
-        return self._cached_word_prop
+        return self.index.word_proportion
 
     def _get_kanji_word_proportion(self):
-        if not hasattr(self, '_cached_kanji_word_prop'):
-            n_words = self.partiallexeme_set.filter(
-                    surface_set__has_kanji=True).count()
-            n_kanji = self.partialkanji_set.count()
-            self._cached_kanji_word_prop = float(n_words) / (n_words + n_kanji)
-
-        return self._cached_kanji_word_prop
+        return self.index.kanji_word_proportion
 
     @classmethod
     def validate(cls):
@@ -104,6 +110,79 @@ class Syllabus(models.Model):
                             ).issubset(kanji_set):
                         raise Exception('invalid surface')
 
+def _fetch_sample(model, ids, n):
+    "Fetches up to n distinct random rows of the model from the given ids."
+    sample_ids = random.sample(ids, min(n, len(ids)))
+    row_map = model.objects.in_bulk(sample_ids)
+    return [row_map[i] for i in sample_ids if i in row_map]
+
+class SyllabusIndex(object):
+    """
+    Dense arrays of the item ids in a syllabus, held in memory so that
+    random items can be sampled without sorting whole tables. Indexes are
+    built on first use, and rebuilt whenever the syllabus items change or
+    the index becomes older than SYLLABUS_INDEX_MAX_AGE seconds.
+    """
+    _cache = {}
+
+    def __init__(self, syllabus_id):
+        self.syllabus_id = syllabus_id
+        self.created = time.time()
+
+        self.lexeme_ids = list(PartialLexeme.objects.filter(
+                syllabus__id=syllabus_id).values_list('id', flat=True))
+        self.kanji_ids = list(PartialKanji.objects.filter(
+                syllabus__id=syllabus_id).values_list('id', flat=True))
+        self.sense_ids = list(lexicon_models.LexemeSense.objects.filter(
+                lexeme__partiallexeme__syllabus__id=syllabus_id
+            ).values_list('id', flat=True).distinct())
+
+        # Map each partial lexeme to its (surface, has_kanji) pairs.
+        self.surfaces = {}
+        for partial_lexeme_id, surface, has_kanji in \
+                PartialLexeme.surface_set.through.objects.filter(
+                    partiallexeme__syllabus__id=syllabus_id
+                ).values_list('partiallexeme_id', 'lexemesurface__surface',
+                    'lexemesurface__has_kanji'):
+            self.surfaces.setdefault(partial_lexeme_id, []).append(
+                    (surface, has_kanji))
+        self.kanji_lexeme_ids = [i for (i, surfaces) in \
+                self.surfaces.iteritems() if \
+                [s for (s, has_kanji) in surfaces if has_kanji]]
+
+        n_words = len(self.lexeme_ids)
+        n_kanji_words = len(self.kanji_lexeme_ids)
+        n_kanji = len(self.kanji_ids)
+        self.word_proportion = float(n_words) / (n_words + n_kanji)
+        self.kanji_word_proportion = float(n_kanji_words) / (n_kanji_words +
+                n_kanji)
+
+    @classmethod
+    def get(cls, syllabus_id):
+        "Fetches the index for the given syllabus, building it if needed."
+        index = cls._cache.get(syllabus_id)
+        if index is None or time.time() - index.created > \
+                settings.SYLLABUS_INDEX_MAX_AGE:
+            index = cls._cache[syllabus_id] = cls(syllabus_id)
+        return index
+
+    @classmethod
+    def invalidate(cls, syllabus_id=None):
+        "Discards the index for the syllabus, or for all syllabi."
+        if syllabus_id is None:
+            cls._cache.clear()
+        else:
+            cls._cache.pop(syllabus_id, None)
+
+    def random_surface(self, partial_lexeme_id, kanji_only=False):
+        "Picks a random surface for the given partial lexeme."
+        surfaces = [s for (s, has_kanji) in \
+                self.surfaces.get(partial_lexeme_id, []) \
+                if has_kanji or not kanji_only]
+        if not surfaces:
+            raise ObjectDoesNotExist
+        return random.choice(surfaces)
+
 class Alignment(models.Model):
     """A segmentation of a lexeme reading."""
     syllabus = models.ForeignKey(Syllabus)
@@ -155,10 +234,7 @@ class PartialLexeme(models.Model):
         return self.surface_set.filter(has_kanji=True).count() > 0
 
     def random_surface(self):
-        try:
-            return self.surface_set.all().order_by('?')[0].surface
-        except IndexError:
-            raise ObjectDoesNotExist
+        return SyllabusIndex.get(self.syllabus_id).random_surface(self.id)
     random_surface = property(random_surface)
 
     def random_reading(self):
@@ -166,11 +242,8 @@ class PartialLexeme(models.Model):
     random_reading = property(random_reading)
 
     def random_kanji_surface(self):
-        try:
-            return self.surface_set.filter(has_kanji=True).order_by(
-                '?')[0].surface
-        except IndexError:
-            raise ObjectDoesNotExist
+        return SyllabusIndex.get(self.syllabus_id).random_surface(self.id,
+                kanji_only=True)
     random_kanji_surface = property(random_kanji_surface)
 
     class Meta:
@@ -208,12 +281,33 @@ class PartialKanji(models.Model):
         unique_together = (('syllabus', 'kanji'),)
         ordering = ['syllabus', 'kanji']
 
+def _invalidate_syllabus_index(sender, instance, **kwargs):
+    # Reverse m2m changes give us a surface, which may be in any syllabus.
+    SyllabusIndex.invalidate(getattr(instance, 'syllabus_id', None))
+
+for _model in (PartialLexeme, PartialKanji):
+    post_save.connect(_invalidate_syllabus_index, sender=_model)
+    post_delete.connect(_invalidate_syllabus_index, sender=_model)
+m2m_changed.connect(_invalidate_syllabus_index,
+        sender=PartialLexeme.surface_set.through)
+
 #----------------------------------------------------------------------------#
 
+# Conditional distributions keyed by (user_id, tag, condition) for error
+# distributions and ('prior', prior_dist_id, condition) for priors, with
+# values (version, dist). This cache is local to each process, so entries
+# are only used while their version matches the stored version, which is
+# incremented on every write. Error entries which share their prior's
+# distribution also record the prior's version.
+_error_dist_cache = SizedLRUCache(settings.ERROR_DIST_CACHE_SIZE,
+        lambda entry: len(entry[1]))
+
 class PriorDist(models.Model):
     "A syllabus-specific prior distribution."
     syllabus = models.ForeignKey(Syllabus)
     tag = models.CharField(max_length=100)
+    version = models.IntegerField(default=0,
+            help_text="Incremented whenever the stored densities change.")
 
     class Meta:
         unique_together = (('syllabus', 'tag'),)
@@ -239,8 +333,37 @@ class PriorDist(models.Model):
                 VALUES (%s, %s, %s, %s, %s)
         """, rows)
         cursor.execute('COMMIT')
+        self.invalidate()
         return
 
+    def invalidate(self):
+        """
+        Marks our densities as changed, so that every process discards its
+        cached copies of this prior, and of user distributions sharing it.
+        """
+        PriorDist.objects.filter(id=self.id).update(
+                version=models.F('version') + 1)
+        self.version += 1
+        prior_id = self.id
+        _error_dist_cache.discard_matching(
+                lambda k: k[0] == 'prior' and k[1] == prior_id)
+
+    def get_dist(self, condition):
+        """
+        Returns the distribution over symbols for the given condition. The
+        result is cached and shared between every user of this prior, so
+        callers must copy it before modifying it.
+        """
+        key = ('prior', self.id, condition)
+        entry = _error_dist_cache.get(key)
+        if entry is not None and entry[0] == self.version:
+            return entry[1]
+
+        dist = ArrayProbDist.from_query_set(self.density.filter(
+                condition=condition))
+        _error_dist_cache[key] = (self.version, dist)
+        return dist
+
 class PriorPdf(util_models.CondProb):
     "Individual densities for a prior distribution."
     dist = models.ForeignKey(PriorDist, related_name='density')
@@ -252,11 +375,20 @@ class PriorPdf(util_models.CondProb):
 #----------------------------------------------------------------------------#
 
 class ErrorDist(models.Model):
-    "A user-specific prior disribution."
+    """
+    A user-specific prior disribution. Conditions which have never been
+    updated have no rows of their own, and are read from the prior instead.
+    """
     user = models.ForeignKey(User)
     tag = models.CharField(max_length=100)
+    version = models.IntegerField(default=0,
+            help_text="Incremented whenever the stored densities change.")
+    prior = models.ForeignKey(PriorDist, null=True, blank=True,
+            help_text="The prior used for conditions with no rows here.")
 
     def prior_dist(self):
+        if self.prior_id is not None:
+            return self.prior
         return PriorDist.objects.get(tag=self.tag)
     prior_dist = property(prior_dist)
 
@@ -287,43 +419,107 @@ class ErrorDist(models.Model):
 
     @classmethod
     def init_from_priors(cls, user):
-        """Initialise user copies of prior dists."""
+        """
+        Initialise user dists which overlay the prior dists. No densities
+        are copied; each condition is only stored for the user once it is
+        first updated.
+        """
+        cls.invalidate_user(user.id)
         user.errordist_set.all().delete()
         prior_dists = PriorDist.objects.filter(
                 syllabus=user.get_profile().syllabus)
         for prior_dist in prior_dists:
-            user_dist = user.errordist_set.create(tag=prior_dist.tag)
-            for prior_pdf in prior_dist.density.all():
-                user_dist.density.create(
-                        pdf=prior_pdf.pdf,
-                        cdf=prior_pdf.cdf,
-                        condition=prior_pdf.condition,
-                        symbol=prior_pdf.symbol,
-                    )
+            user.errordist_set.create(tag=prior_dist.tag, prior=prior_dist)
 
     def sample(self, condition):
         "Samples a single symbol using the underlying distribution."
-        target_cdf = random.random()
-        return self.density.filter(condition=condition,
-            cdf__gte=target_cdf).order_by('cdf')[0].symbol
+        return self.get_dist(condition).sample()
+
+    def get_dist(self, condition):
+        """
+        Returns the distribution over symbols for the given condition,
+        served from the process-local cache where possible. The result is
+        shared, so callers must copy it before modifying it.
+        """
+        key = (self.user_id, self.tag, condition)
+        version = self._get_cache_version()
+        entry = _error_dist_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        dist = ArrayProbDist.from_query_set(self.density.filter(
+                condition=condition))
+        if not dist and self.prior_id is not None:
+            # Not yet updated, so share the prior's distribution.
+            dist = self.prior.get_dist(condition)
+        _error_dist_cache[key] = (version, dist)
+        return dist
+
+    def _get_cache_version(self):
+        if self.prior_id is None:
+            return self.version
+        return (self.version, self.prior.version)
+
+    def set_dist(self, condition, dist):
+        "Stores a new distribution for the condition."
+        self.set_dists({condition: dist})
+
+    def set_dists(self, dist_map):
+        """
+        Stores new distributions for each condition in the map, and bumps
+        our version so that other processes discard their cached copies.
+        Our own cached copies are discarded rather than replaced, since the
+        write may yet be rolled back; they are reloaded on next use.
+        """
+        for condition, dist in dist_map.iteritems():
+            dist.save_to(self.density, condition=condition)
+
+        ErrorDist.objects.filter(id=self.id).update(
+                version=models.F('version') + 1)
+        self.version += 1
+
+        for condition in dist_map:
+            _error_dist_cache.discard((self.user_id, self.tag, condition))
+
+    def invalidate(self, condition=None):
+        """
+        Discards cached distributions for the given condition, or for every
+        condition in this distribution if none is given.
+        """
+        if condition is not None:
+            _error_dist_cache.discard((self.user_id, self.tag, condition))
+        else:
+            user_id, tag = self.user_id, self.tag
+            _error_dist_cache.discard_matching(
+                    lambda k: k[0] == user_id and k[1] == tag)
+
+    @staticmethod
+    def invalidate_user(user_id):
+        "Discards every cached distribution belonging to the given user."
+        _error_dist_cache.discard_matching(lambda k: k[0] == user_id)
 
     def sample_n(self, condition, n, exclude_set=None):
         "Samples n symbols without replacement from the distribution."
-        dist = ProbDist.from_query_set(self.density.filter(
-                condition=condition))
+        dist = self.get_dist(condition)
         return dist.sample_n(n, exclude_set=exclude_set)
 
-    def sample_seq_n(self, condition_segments, n, exclude_set=None):
+    def sample_seq_n(self, condition_segments, n, exclude_set=None,
+            lazy=True):
+        """
+        Samples n segmented sequences without replacement, where each kanji
+        segment is drawn from its conditional distribution. Unless lazy is
+        False, the full product of segment distributions is never built.
+        """
         dists = []
         kanji_script = scripts.Script.Kanji
         for segment in condition_segments:
             if scripts.script_type(segment) == kanji_script:
-                seg_dist = ProbDist.from_query_set(self.density.filter(
-                    condition=segment))
-                dists.append(seg_dist)
+                dists.append(self.get_dist(segment))
             else:
                 dists.append(segment)
         
+        if lazy:
+            return LazySeqDist(*dists).sample_n(n, exclude_set)
         return SeqDist(*dists).sample_n(n, exclude_set)
 
     def sample_seq_n_uniform(self, condition_segments, n, exclude_set=None):
@@ -337,11 +533,9 @@ class ErrorDist(models.Model):
             result_seg_sets = []
             for segment in condition_segments:
                 if scripts.script_type(segment) == kanji_script:
+                    symbols = self.get_dist(segment).keys()
                     result_seg_sets.append(
-                            [o['symbol'] for o in self.density.filter(
-                                    condition=segment).order_by('?').values(
-                                    'symbol')[:n]]
-                        )
+                            random.sample(symbols, min(n, len(symbols))))
                 else:
                     result_seg_sets.append([segment] * n)
             for result_segs in zip(*result_seg_sets):
@@ -354,30 +548,27 @@ class ErrorDist(models.Model):
 
     def sample_uniform(self, condition, exclude_set=None):
         "Samples a single symbol assuming a uniform distribution."
-        base_query = self.density.filter(condition=condition)
-        if exclude_set:
-            base_query.exclude(symbol__in=exclude_set)
-        return base_query.order_by('?')[0]
+        return self.sample_n_uniform(condition, 1, exclude_set)[0]
 
     def sample_n_uniform(self, condition, n, exclude_set=None):
         """
         Samples n symbols without replacement assuming a uniform distribution.
         """
-        return [o['symbol'] for o in self.density.filter(
-                condition=condition).exclude(
-                symbol__in=exclude_set
-            ).order_by('?').values('symbol')[:n]]
+        exclude_set = exclude_set or set()
+        symbols = [s for s in self.get_dist(condition)
+                if s not in exclude_set]
+        return random.sample(symbols, min(n, len(symbols)))
 
     @classmethod
     def from_dist(cls):
         raise Exception('not supported')
 
     def update(self, condition, symbol, symbol_set):
-        query = self.density.filter(condition=condition)
-        whole_dist = ProbDist.from_query_set(query)
+        whole_dist = self.get_dist(condition).copy()
 
-        sub_dist = ProbDist.from_query_set(query.filter(
-                symbol__in=symbol_set))
+        sub_dist = ProbDist((s, whole_dist[s]) for s in symbol_set
+                if s in whole_dist)
+        sub_dist.normalise()
         assert sub_dist
         m = max(v for (s, v) in sub_dist.iteritems() if s != symbol) + \
                 settings.UPDATE_EPSILON
@@ -395,7 +586,7 @@ class ErrorDist(models.Model):
             whole_dist[s] = sub_dist[s] * sub_dist_mass
 
         assert abs(sum(whole_dist.values()) - 1.0) < 1e-6
-        whole_dist.save_to(self.density, condition=condition)
+        self.set_dist(condition, whole_dist)
         return
 
 class ErrorPdf(util_models.CondProb):
@@ -409,11 +600,13 @@ class ErrorPdf(util_models.CondProb):
     def rescore_cdf(cls, dist, condition):
         """Rescores the cdf values after the pdf values have changed."""
         cdf = 0.0
-        for density in cls.objects.filter(dist=dist,
-                condition=condition).order_by('symbol'):
-            cdf += density.pdf
-            density.cdf = cdf
-            density.save()
+        changed = []
+        for row in cls.objects.filter(dist=dist, condition=condition
+                ).order_by('symbol').values('id', 'pdf', 'cdf'):
+            cdf += row['pdf']
+            if row['cdf'] != cdf:
+                changed.append((row['id'], row['pdf'], cdf))
+        update_densities(cls._meta.db_table, changed)
         return
 
     @classmethod
@@ -32,6 +32,14 @@ class UserModelPlugin(object):
         "Updates this error model from a user's response."
         raise Exception('not implemented')
 
+    def update_many(self, responses):
+        """
+        Updates this error model from a sequence of responses, in order.
+        Plugins may override this to coalesce updates.
+        """
+        for response in responses:
+            self.update(response)
+
 class SegmentedSeqPlugin(UserModelPlugin):
     """
     A plugin which uses annotated segments in its options. Requires its
@@ -44,8 +52,34 @@ class SegmentedSeqPlugin(UserModelPlugin):
     """
     def update(self, response):
         "Update our error model from a user's response."
-        error_dist = models.ErrorDist.objects.get(user=response.user,
-                tag=self.dist_name)
+        self.update_many([response])
+
+    def update_many(self, responses):
+        """
+        Update our error model from a sequence of responses. Each affected
+        distribution is loaded and stored only once per user, however many
+        responses touch it.
+        """
+        user_responses = {}
+        for response in responses:
+            user_responses.setdefault(response.user_id, []).append(response)
+
+        for user_id, user_response_list in user_responses.iteritems():
+            error_dist = models.ErrorDist.objects.get(user__id=user_id,
+                    tag=self.dist_name)
+            dirty_dists = {}
+            for response in user_response_list:
+                self._apply_response(response, error_dist, dirty_dists)
+
+            if dirty_dists:
+                error_dist.set_dists(dirty_dists)
+        return
+
+    def _apply_response(self, response, error_dist, dirty_dists):
+        """
+        Applies a single response to the user's distributions, recording
+        each changed distribution in dirty_dists by its condition.
+        """
         question = response.question
         base_segs = question.annotation.split(u'|')
         response_segs = response.option.annotation.split(u'|')
@@ -61,8 +95,9 @@ class SegmentedSeqPlugin(UserModelPlugin):
                     izip(base_segs, response_segs, distractor_sets):
             if scripts.script_types(base_seg) != scripts.Script.Kanji:
                 continue
-            sub_dist = models.ProbDist.from_query_set(
-                    error_dist.density.filter(condition=base_seg))
+            sub_dist = dirty_dists.get(base_seg)
+            if sub_dist is None:
+                sub_dist = error_dist.get_dist(base_seg).copy()
             e = settings.UPDATE_EPSILON
 
             try:
@@ -81,7 +116,7 @@ class SegmentedSeqPlugin(UserModelPlugin):
             if m > existing_score:
                 sub_dist[response_seg] = m
                 sub_dist.normalise()
-                sub_dist.save_to(error_dist.density, condition=base_seg)
+                dirty_dists[base_seg] = sub_dist
         return
 
 _cached_plugins = None
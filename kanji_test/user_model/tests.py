@@ -21,11 +21,47 @@ class RegistrationTest(TestCase):
         prior_dist = models.PriorDist.objects.get(tag="dummy")
         error_dist = models.ErrorDist.objects.get(user=user, tag="dummy")
 
+        # Densities are shared with the prior until first updated.
+        self.assertEqual(error_dist.density.count(), 0)
         for prior_row in prior_dist.density.all():
-            error_row = error_dist.density.get(condition=prior_row.condition,
-                    symbol=prior_row.symbol)
-            self.assertEqual(prior_row.cdf, error_row.cdf)
-            self.assertEqual(prior_row.pdf, error_row.pdf)
+            error_pdf = error_dist.get_dist(prior_row.condition)[
+                    prior_row.symbol]
+            self.assertAlmostEqual(prior_row.pdf, error_pdf)
+
+    def test_update_materialises(self):
+        user = auth_models.User.objects.get(username="dummy")
+        models.ErrorDist.init_from_priors(user)
+        prior_dist = models.PriorDist.objects.get(tag="dummy")
+        error_dist = models.ErrorDist.objects.get(user=user, tag="dummy")
+        condition = prior_dist.density.all()[0].condition
+        symbols = error_dist.get_dist(condition).keys()
+        error_dist.update(condition, symbols[0], symbols)
+        self.assertEqual(
+                error_dist.density.filter(condition=condition).count(),
+                len(symbols),
+            )
+        self.assertEqual(
+                prior_dist.density.filter(condition=condition).count(),
+                len(symbols),
+            )
+
+    def test_prior_rewrite_invalidates(self):
+        user = auth_models.User.objects.get(username="dummy")
+        models.ErrorDist.init_from_priors(user)
+        prior_dist = models.PriorDist.objects.get(tag="dummy")
+        error_dist = models.ErrorDist.objects.get(user=user, tag="dummy")
+        self.assertAlmostEqual(error_dist.get_dist("sea")["fish"], 1.0)
+
+        prior_dist.density.filter(condition="sea").update(pdf=0.5)
+        prior_dist.density.create(condition="sea", symbol="eel", pdf=0.5,
+                cdf=1.0)
+        prior_dist.invalidate()
+
+        # Both the prior and any user sharing it see the new densities.
+        prior_dist = models.PriorDist.objects.get(tag="dummy")
+        self.assertAlmostEqual(prior_dist.get_dist("sea")["eel"], 0.5)
+        error_dist = models.ErrorDist.objects.get(user=user, tag="dummy")
+        self.assertAlmostEqual(error_dist.get_dist("sea")["fish"], 0.5)
 
 class UpdateTest(TestCase):
     fixtures = ['test_update']
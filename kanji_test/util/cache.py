@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#  kanji_test
+#
+#  Created by agent on 2026-10-17.
+#
+
+"""
+Process-local caches for expensive, frequently re-used objects.
+"""
+
+from collections import OrderedDict
+
+class SizedLRUCache(object):
+    """
+    A least-recently-used cache whose capacity is measured by the total size
+    of the values it holds, rather than by the number of keys.
+    """
+    def __init__(self, max_size, size_func=len):
+        self.max_size = max_size
+        self._size_func = size_func
+        self._items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        value, value_size = self._items.pop(key)
+        self._items[key] = (value, value_size)
+        return value
+
+    def get(self, key, default=None):
+        "Fetches the value for the key, marking it as recently used."
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.discard(key)
+        value_size = self._size_func(value)
+        if value_size > self.max_size:
+            # Would evict everything else and still not fit.
+            return
+
+        self._items[key] = (value, value_size)
+        self.size += value_size
+        while self.size > self.max_size:
+            _old_key, (_old_value, old_size) = self._items.popitem(last=False)
+            self.size -= old_size
+
+    def discard(self, key):
+        "Removes the key from the cache, if present."
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def discard_matching(self, predicate):
+        "Removes every key for which predicate(key) is true."
+        for key in [k for k in self._items if predicate(k)]:
+            self.discard(key)
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
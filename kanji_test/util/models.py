@@ -12,6 +12,7 @@ Abstract models for probability distributions.
 """
 
 import random
+import bisect
 
 from django.db import models, connection
 from simplestats.sequences import groups_of_n
@@ -22,6 +23,10 @@ class ProbI(models.Model):
     """A probabilty distribution."""
     pdf = models.FloatField()
     cdf = models.FloatField()
+
+    # Sample from a copy of the table held in memory, instead of querying
+    # for each sample. Only suitable for tables which are static once built.
+    in_memory = False
         
     class Meta:
         abstract = True
@@ -30,6 +35,9 @@ class ProbI(models.Model):
     def sample(cls):
         """Samples and returns an object from this distribution."""
         target_cdf = random.random()
+        if cls.in_memory:
+            return _get_sampler(cls).sample(target_cdf)
+
         result = cls.objects.filter(cdf__gte=target_cdf).order_by('cdf')[0]
         return result
 
@@ -39,6 +47,9 @@ class ProbI(models.Model):
             raise ValueError(n)
 
         target_cdfs = [random.random() for i in xrange(n)]
+        if cls.in_memory:
+            return _get_sampler(cls).sample_n(target_cdfs)
+
         quote_name = connection.ops.quote_name
         table_name = quote_name(cls._meta.db_table)
         id_field = '%s.%s' % (table_name, quote_name('id'))
@@ -65,6 +76,7 @@ class Prob(ProbI):
     @classmethod
     def from_dist(cls, prob_dist):
         table_name = cls._meta.db_table
+        _samplers.pop(table_name, None)
         cursor = connection.cursor()
         cursor.execute('DELETE FROM %s' % table_name)
 
@@ -105,6 +117,9 @@ class CondProb(ProbI):
         condition.
         """
         target_cdf = random.random()
+        if cls.in_memory:
+            return _get_sampler(cls, condition).sample(target_cdf)
+
         result = cls.objects.filter(condition=condition, cdf__gte=target_cdf
                 ).order_by('cdf')[0]
         return result
@@ -112,6 +127,7 @@ class CondProb(ProbI):
     @classmethod
     def from_dist(cls, cond_prob_dist):
         table_name = cls._meta.db_table
+        _samplers.pop(table_name, None)
         cursor = connection.cursor()
         cursor.execute('DELETE FROM %s' % table_name)
 
@@ -133,3 +149,70 @@ class CondProb(ProbI):
                     row_set
                 )
         cursor.close()
+
+#----------------------------------------------------------------------------#
+
+# In-memory samplers, by table name and then condition.
+_samplers = {}
+
+def _get_sampler(model, condition=None):
+    """
+    Fetches the in-memory sampler for the given table, loading every
+    condition of the table on first use. Raises DoesNotExist for an unknown
+    condition, or an empty table.
+    """
+    table_name = model._meta.db_table
+    samplers = _samplers.get(table_name)
+    if samplers is None:
+        samplers = _samplers[table_name] = _load_samplers(model)
+    try:
+        return samplers[condition]
+    except KeyError:
+        raise model.DoesNotExist(condition)
+
+def _load_samplers(model):
+    fields = [f.attname for f in model._meta.fields]
+    has_condition = 'condition' in fields
+    if has_condition:
+        query_set = model.objects.order_by('condition', 'cdf')
+        condition_index = fields.index('condition')
+    else:
+        query_set = model.objects.order_by('cdf')
+
+    rows_by_condition = {}
+    for row in query_set.values_list(*fields):
+        condition = row[condition_index] if has_condition else None
+        rows_by_condition.setdefault(condition, []).append(row)
+
+    return dict((condition, _CdfSampler(model, fields, rows)) for (condition,
+            rows) in rows_by_condition.iteritems())
+
+class _CdfSampler(object):
+    """
+    Samples rows of a probability table by binary search over their cdf,
+    giving the same row as the query for the first row at or above the
+    target cdf.
+    """
+    def __init__(self, model, fields, rows):
+        self.model = model
+        self.fields = fields
+        self.rows = rows
+        cdf_index = fields.index('cdf')
+        self.cdfs = [row[cdf_index] for row in rows]
+
+    def sample(self, target_cdf):
+        return self._make(self._find(target_cdf))
+
+    def sample_n(self, target_cdfs):
+        "Returns the distinct rows sampled by the target cdfs."
+        indices = set(self._find(cdf) for cdf in target_cdfs)
+        return [self._make(i) for i in sorted(indices)]
+
+    def _find(self, target_cdf):
+        # Rounding can leave the final cdf just short of 1.
+        return min(bisect.bisect_left(self.cdfs, target_cdf),
+                len(self.cdfs) - 1)
+
+    def _make(self, i):
+        return self.model(**dict(zip(self.fields, self.rows[i])))
+
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+#  pipeline.py
+#  kanji_test
+#
+#  Created by agent on 2026-10-17.
+#
+
+"""
+Runs a graph of build stages, each in its own process, starting every stage
+as soon as the stages it depends on have finished.
+"""
+
+import time
+import multiprocessing
+
+from django.db import connection
+
+class BuildError(Exception):
+    pass
+
+class Stage(object):
+    "A named step of a build, which runs after the stages it depends on."
+    def __init__(self, name, func, args=(), depends_on=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.depends_on = list(depends_on)
+
+    def __repr__(self):
+        return 'Stage(%r)' % self.name
+
+def run_stages(stages, max_workers=None, log=None, poll_interval=0.1):
+    """
+    Runs every stage, at most max_workers at once (one per core by
+    default). Each stage gets a fresh process and database connection, so
+    stages may use process pools of their own. Returns a dictionary of the
+    seconds taken by each stage. If any stage fails, no more are started,
+    and BuildError is raised once those already running have finished.
+    """
+    max_workers = max_workers or multiprocessing.cpu_count()
+    names = set(stage.name for stage in stages)
+    for stage in stages:
+        unknown = set(stage.depends_on).difference(names)
+        if unknown:
+            raise ValueError('%s depends on unknown stages %s' % (stage.name,
+                    ', '.join(sorted(unknown))))
+
+    # Children must not share the parent's database connection.
+    connection.close()
+
+    pending = list(stages)
+    running = {}
+    done = set()
+    failed = []
+    timings = {}
+    while pending or running:
+        if not failed:
+            for stage in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if not done.issuperset(stage.depends_on):
+                    continue
+
+                pending.remove(stage)
+                process = multiprocessing.Process(target=_run_stage,
+                        args=(stage,), name=stage.name)
+                process.start()
+                running[stage.name] = (process, time.time())
+
+        if not running:
+            if failed:
+                break
+            raise BuildError('circular dependencies amongst %s' % ', '.join(
+                    stage.name for stage in pending))
+
+        time.sleep(poll_interval)
+        for name, (process, start_time) in running.items():
+            if process.is_alive():
+                continue
+
+            process.join()
+            timings[name] = time.time() - start_time
+            del running[name]
+            if process.exitcode == 0:
+                done.add(name)
+                status = 'done'
+            else:
+                failed.append(name)
+                status = 'FAILED'
+            if log:
+                log.log('%s: %s in %.1fs' % (name, status, timings[name]))
+
+    if failed:
+        raise BuildError('failed stages: %s' % ', '.join(failed))
+
+    return timings
+
+def _run_stage(stage):
+    connection.close()
+    stage.func(*stage.args)
+    connection.close()
+
+# vim: ts=4 sw=4 sts=4 et tw=78:
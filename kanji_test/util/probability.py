@@ -8,9 +8,12 @@
 # 
 
 import random
+import heapq
 
+import numpy
 from nltk import probability as nltk_prob
 from cjktools.common import sopen
+from django.db import connection, transaction
 
 class FreqDist(nltk_prob.FreqDist):
     """
@@ -151,6 +154,69 @@ class UnsupportedMethodError(Exception):
 
 class AbstractMethod(Exception): pass
 
+def _save_dist_to(dist, manager, **kwargs):
+    """
+    Stores the symbols and densities of the given distribution as the rows
+    matching kwargs in the manager. Rows which already exist are updated in
+    place with a single UPDATE, so only symbols which were added or removed
+    cause rows to be inserted or deleted.
+    """
+    existing = dict((row['symbol'], row) for row in
+            manager.filter(**kwargs).values('id', 'symbol', 'pdf', 'cdf'))
+    changed = []
+    cdf = 0.0
+    for symbol in sorted(dist.iterkeys()):
+        pdf = dist[symbol]
+        cdf += pdf
+        row = existing.pop(symbol, None)
+        if row is None:
+            row_kwargs = {}
+            row_kwargs.update(kwargs)
+            row_kwargs['cdf'] = cdf
+            row_kwargs['pdf'] = pdf
+            row_kwargs['symbol'] = symbol
+            manager.create(**row_kwargs)
+        elif row['pdf'] != pdf or row['cdf'] != cdf:
+            changed.append((row['id'], pdf, cdf))
+
+    if existing:
+        manager.filter(id__in=[row['id'] for row in existing.itervalues()]
+                ).delete()
+
+    if changed:
+        update_densities(manager.model._meta.db_table, changed)
+
+    return
+
+def update_densities(table_name, rows, rows_per_update=500):
+    """
+    Sets new pdf and cdf values for existing rows of the given table, where
+    rows is a sequence of (id, pdf, cdf) tuples. Uses one CASE-based UPDATE
+    per rows_per_update rows.
+    """
+    quote_name = connection.ops.quote_name
+    cursor = connection.cursor()
+    for i in xrange(0, len(rows), rows_per_update):
+        row_set = rows[i:i + rows_per_update]
+        cases = ' '.join(['WHEN %s THEN %s'] * len(row_set))
+        sql = 'UPDATE %s SET %s = CASE %s %s END, %s = CASE %s %s END ' \
+                'WHERE %s IN (%s)' % (
+                    quote_name(table_name),
+                    quote_name('pdf'), quote_name('id'), cases,
+                    quote_name('cdf'), quote_name('id'), cases,
+                    quote_name('id'), ', '.join(['%s'] * len(row_set)),
+                )
+        params = []
+        for row_id, pdf, cdf in row_set:
+            params.extend((row_id, pdf))
+        for row_id, pdf, cdf in row_set:
+            params.extend((row_id, cdf))
+        params.extend(row_id for (row_id, pdf, cdf) in row_set)
+        cursor.execute(sql, params)
+
+    transaction.commit_unless_managed()
+    return
+
 # XXX Doesn't match NLTK interface.
 class ProbDistI(object):
     def __init__(self):
@@ -199,18 +265,7 @@ class ProbDist(dict):
         self._refresh_cdf()
 
     def save_to(self, manager, **kwargs):
-        manager.filter(**kwargs).delete()
-        cdf = 0.0
-        for symbol, pdf in self.iteritems():
-            row_kwargs = {}
-            row_kwargs.update(kwargs)
-            cdf += pdf
-            row_kwargs['cdf'] = cdf
-            row_kwargs['pdf'] = pdf
-            row_kwargs['symbol'] = symbol
-            manager.create(**row_kwargs)
-
-        return
+        _save_dist_to(self, manager, **kwargs)
 
     def sample(self):
         target_cdf = random.random()
@@ -257,6 +312,151 @@ class ProbDist(dict):
 
         self._cdf = cdf_seq
 
+class ArrayProbDist(ProbDistI):
+    """
+    A probability distribution whose symbols and densities are stored in
+    contiguous arrays. Sampling is by binary search over the cdf, and
+    sampling without replacement takes a single vectorized pass using the
+    Gumbel top-k trick. Supports the read and update operations of a dict,
+    and the same API as ProbDist.
+
+    >>> x = ArrayProbDist(['a', 'b', 'c'], [1, 1, 2])
+    >>> x.normalise()
+    >>> x['c']
+    0.5
+    >>> x.sample() in x
+    True
+    >>> sorted(x.sample_n(2, exclude_set=set(['a'])))
+    ['b', 'c']
+    """
+    def __init__(self, symbols=(), pdfs=()):
+        self._symbols = list(symbols)
+        self._pdfs = numpy.array(pdfs, dtype=numpy.float64)
+        if len(self._symbols) != len(self._pdfs):
+            raise ValueError('need one pdf value per symbol')
+        self._index = dict((s, i) for (i, s) in enumerate(self._symbols))
+        self._cdf = None
+
+    @classmethod
+    def from_dist(cls, dist):
+        "Builds a new array distribution from any symbol -> pdf mapping."
+        symbols = dist.keys()
+        return cls(symbols, [dist[s] for s in symbols])
+
+    @classmethod
+    def from_query_set(cls, query_set):
+        symbols = []
+        pdfs = []
+        for row in query_set.values('symbol', 'pdf'):
+            symbols.append(row['symbol'])
+            pdfs.append(row['pdf'])
+
+        dist = cls(symbols, pdfs)
+        dist.normalise()
+        return dist
+
+    def copy(self):
+        return self.__class__(self._symbols, self._pdfs)
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self._index
+
+    def __iter__(self):
+        return iter(self._symbols)
+
+    def __getitem__(self, symbol):
+        return float(self._pdfs[self._index[symbol]])
+
+    def __setitem__(self, symbol, pdf):
+        i = self._index.get(symbol)
+        if i is None:
+            self._index[symbol] = len(self._symbols)
+            self._symbols.append(symbol)
+            self._pdfs = numpy.append(self._pdfs, pdf)
+        else:
+            self._pdfs[i] = pdf
+        self._cdf = None
+
+    def __eq__(self, rhs):
+        return set(self.items()) == set(rhs.items())
+
+    def get(self, symbol, default=None):
+        i = self._index.get(symbol)
+        if i is None:
+            return default
+        return float(self._pdfs[i])
+
+    def keys(self):
+        return list(self._symbols)
+
+    def values(self):
+        return self._pdfs.tolist()
+
+    def items(self):
+        return zip(self._symbols, self._pdfs.tolist())
+
+    def iterkeys(self):
+        return iter(self._symbols)
+
+    def itervalues(self):
+        return iter(self._pdfs.tolist())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def normalise(self):
+        total = self._pdfs.sum()
+        if total > 0:
+            self._pdfs /= total
+        self._cdf = None
+
+    def save_to(self, manager, **kwargs):
+        _save_dist_to(self, manager, **kwargs)
+
+    def sample(self):
+        cdf = self._get_cdf()
+        if not len(cdf) or cdf[-1] <= 0:
+            raise RuntimeError("couldn't sample successfully")
+        i = cdf.searchsorted(random.random() * cdf[-1])
+        return self._symbols[min(i, len(cdf) - 1)]
+
+    def sample_n(self, n, exclude_set=None):
+        if exclude_set:
+            included = numpy.ones(len(self._symbols), dtype=bool)
+            for symbol in exclude_set:
+                i = self._index.get(symbol)
+                if i is not None:
+                    included[i] = False
+            indices = numpy.flatnonzero(included)
+        else:
+            indices = numpy.arange(len(self._symbols))
+
+        if n > len(indices):
+            raise ValueError("don't have %d unique values" % n)
+
+        elif n == len(indices):
+            result = [self._symbols[i] for i in indices]
+            random.shuffle(result)
+            return result
+
+        # Perturbing log-probabilities with Gumbel noise and taking the
+        # top n is equivalent to n successive draws without replacement.
+        with numpy.errstate(divide='ignore'):
+            keys = numpy.log(self._pdfs[indices])
+        keys += numpy.random.gumbel(size=len(indices))
+        chosen = indices[numpy.argpartition(-keys, n - 1)[:n]]
+        result = [self._symbols[i] for i in chosen]
+        random.shuffle(result)
+        return result
+
+    def _get_cdf(self):
+        if self._cdf is None:
+            self._cdf = self._pdfs.cumsum()
+        return self._cdf
+
 # XXX Doesn't match NLTK interface.
 class CondProbDist(dict):
     def __init__(self, *args, **kwargs):
@@ -280,7 +480,7 @@ class CondProbDist(dict):
             sub_dist.normalise()
 
     def save_to(self, manager, **kwargs):
-        manager.filter(**kwargs).delete()
+        manager.filter(**kwargs).exclude(condition__in=self.keys()).delete()
         for condition, sub_dist in self.iteritems():
             sub_dist_kwargs = kwargs.copy()
             sub_dist_kwargs['condition'] = condition
@@ -297,16 +497,17 @@ class SeqDist(ProbDist):
             raise ValueError("cannot be constructed empty")
 
         for new_dist in dists:
-            if isinstance(new_dist, ProbDist):
+            if isinstance(new_dist, basestring):
+                fixed_char = new_dist
+                old_dist = dict((k + (fixed_char,), v) for (k,v) in \
+                        old_dist.iteritems())
+            else:
                 current = {} 
+                new_items = new_dist.items()
                 for old_seq, old_pdf in old_dist.iteritems():
-                    for new_symbol, new_pdf in new_dist.iteritems():
+                    for new_symbol, new_pdf in new_items:
                         current[old_seq + (new_symbol,)] = old_pdf * new_pdf
                 old_dist = current
-            else:
-                fixed_char = new_dist
-                old_dist = dict((k + (fixed_char,), v) for (k,v) in \
-                        old_dist.iteritems())
 
         self._segments = {}
         for segments, pdf in old_dist.iteritems():
@@ -327,3 +528,138 @@ class SeqDist(ProbDist):
                 ProbDist.sample_n(self, n, exclude_set),
             )
 
+class LazySeqDist(ProbDistI):
+    """
+    A distribution over sequences of segments, like SeqDist, but which never
+    expands the Cartesian product of its segment distributions. Sequences
+    are sampled segment by segment. Only if rejection sampling fails to find
+    enough new sequences are the most likely sequences enumerated, best
+    first.
+
+    >>> x = ProbDist({u'a': 0.75, u'b': 0.25})
+    >>> dist = LazySeqDist(x, u'-', x)
+    >>> sorted(dist.sample_n(4))
+    [(u'a', u'-', u'a'), (u'a', u'-', u'b'), (u'b', u'-', u'a'), (u'b', u'-', u'b')]
+    >>> dist.sample_n(1, exclude_set=[u'a-a', u'a-b', u'b-a'])
+    [(u'b', u'-', u'b')]
+    """
+    # Rejected draws allowed per sequence needed before enumerating.
+    max_rejections = 20
+
+    # Sequences enumerated before sampling from the enumerated set.
+    max_enumerated = 1000
+
+    def __init__(self, *dists):
+        if not dists:
+            raise ValueError("cannot be constructed empty")
+
+        self._choices = []
+        for dist in dists:
+            if isinstance(dist, basestring):
+                self._choices.append(([dist], [1.0], None))
+                continue
+
+            items = sorted(dist.items(), key=lambda x: x[1], reverse=True)
+            if not items:
+                raise ValueError("cannot include an empty distribution")
+            symbols = [symbol for (symbol, pdf) in items]
+            pdfs = [pdf for (symbol, pdf) in items]
+            self._choices.append((symbols, pdfs, numpy.cumsum(pdfs)))
+
+        self._segments = {}
+
+    def sample(self):
+        "Samples a segmented sequence from this distribution."
+        segments = []
+        for symbols, pdfs, cdf in self._choices:
+            if cdf is None:
+                segments.append(symbols[0])
+            else:
+                i = cdf.searchsorted(random.random() * cdf[-1])
+                segments.append(symbols[min(i, len(symbols) - 1)])
+
+        segments = tuple(segments)
+        self._segments[u''.join(segments)] = segments
+        return segments
+
+    def sample_n(self, n, exclude_set=None):
+        "Samples n segmented sequences without replacement."
+        exclude_set = set(exclude_set or [])
+        result = []
+        n_rejections = 0
+        while len(result) < n and n_rejections < self.max_rejections * n:
+            segments = self.sample()
+            flat = u''.join(segments)
+            if flat in exclude_set:
+                n_rejections += 1
+                continue
+            exclude_set.add(flat)
+            result.append(segments)
+
+        if len(result) < n:
+            result.extend(self._sample_enumerated(n - len(result),
+                    exclude_set))
+
+        return result
+
+    def top_n(self, n, exclude_set=None):
+        """
+        Returns up to n of the most likely segmented sequences which are
+        not excluded, most likely first.
+        """
+        exclude_set = set(exclude_set or [])
+        result = []
+        for pdf, segments in self._iter_best_first():
+            if len(result) >= n:
+                break
+            flat = u''.join(segments)
+            if flat not in exclude_set:
+                exclude_set.add(flat)
+                result.append(segments)
+        return result
+
+    def _sample_enumerated(self, n, exclude_set):
+        """
+        Samples from the most likely sequences which are not excluded,
+        enumerating at least max_enumerated of them where possible.
+        """
+        candidates = ProbDist()
+        n_enumerated = 0
+        for pdf, segments in self._iter_best_first():
+            n_enumerated += 1
+            flat = u''.join(segments)
+            if flat not in exclude_set:
+                candidates[flat] = candidates.get(flat, 0.0) + pdf
+                self._segments[flat] = segments
+            if n_enumerated >= self.max_enumerated and len(candidates) >= n:
+                break
+
+        if len(candidates) < n:
+            raise ValueError("don't have %d unique values" % n)
+
+        candidates.normalise()
+        return map(self._segments.__getitem__, candidates.sample_n(n))
+
+    def _iter_best_first(self):
+        "Yields (pdf, segments) pairs in order of decreasing probability."
+        sizes = [len(symbols) for (symbols, pdfs, cdf) in self._choices]
+        start = (0,) * len(sizes)
+        heap = [(-self._seq_pdf(start), start)]
+        seen = set([start])
+        while heap:
+            neg_pdf, indices = heapq.heappop(heap)
+            yield -neg_pdf, tuple(self._choices[j][0][i] for (j, i) in
+                    enumerate(indices))
+
+            for j in xrange(len(indices)):
+                if indices[j] + 1 < sizes[j]:
+                    succ = indices[:j] + (indices[j] + 1,) + indices[j + 1:]
+                    if succ not in seen:
+                        seen.add(succ)
+                        heapq.heappush(heap, (-self._seq_pdf(succ), succ))
+
+    def _seq_pdf(self, indices):
+        pdf = 1.0
+        for (symbols, pdfs, cdf), i in zip(self._choices, indices):
+            pdf *= pdfs[i]
+        return pdf
@@ -19,6 +19,7 @@ from kanji_test.util import probability
 def suite():
     testSuite = unittest.TestSuite((
             unittest.makeSuite(CondFreqDistTest),
+            unittest.makeSuite(ArrayProbDistTest),
         ))
     return testSuite
 
@@ -58,5 +59,37 @@ class CondFreqDistTest(unittest.TestCase):
                 os.remove(filename)
             raise        
 
+class ArrayProbDistTest(unittest.TestCase):
+    def setUp(self):
+        self.dist = probability.ArrayProbDist(['dog', 'cat', 'fish', 'bird'],
+                [4, 3, 2, 1])
+        self.dist.normalise()
+
+    def test_matches_dict_dist(self):
+        dict_dist = probability.ProbDist(dog=4.0, cat=3.0, fish=2.0,
+                bird=1.0)
+        dict_dist.normalise()
+        for symbol, pdf in dict_dist.iteritems():
+            self.assertAlmostEqual(self.dist[symbol], pdf)
+
+    def test_update(self):
+        self.dist['cat'] = 0.5
+        self.dist['emu'] = 0.3
+        self.dist.normalise()
+        self.assertAlmostEqual(sum(self.dist.values()), 1.0)
+        self.assertAlmostEqual(self.dist['cat'], 1.0 / 3)
+        self.assertAlmostEqual(self.dist['emu'], 0.2)
+        self.assert_(self.dist.sample() in self.dist)
+
+    def test_sample_n(self):
+        for i in xrange(100):
+            result = self.dist.sample_n(2, exclude_set=set(['dog']))
+            self.assertEqual(len(set(result)), 2)
+            self.assert_('dog' not in result)
+
+        self.assertEqual(sorted(self.dist.sample_n(3, set(['fish']))),
+                ['bird', 'cat', 'dog'])
+        self.assertRaises(ValueError, self.dist.sample_n, 5)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -8,17 +8,158 @@
 # 
 
 from os import path
+import random
 import unittest
 
 from cjktools import dyntest
 from django.test import TestCase
 
+from kanji_test.util.cache import SizedLRUCache
+from kanji_test.util import models as util_models
+from kanji_test.util.probability import FreqDist, ConditionalFreqDist
+from kanji_test.lexicon.models import KanjiProb, KanjiReadingCondProb
+
 def suite():
     """Generates a test suite for this package."""
     return unittest.TestSuite((
+            unittest.makeSuite(SizedLRUCacheTest),
+            unittest.makeSuite(InMemorySamplerTest),
             _dynamic_suite(),
         ))
 
+class SizedLRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SizedLRUCache(5)
+
+    def test_evicts_least_recent_by_size(self):
+        self.cache['a'] = [1, 2]
+        self.cache['b'] = [3, 4]
+        self.assertEqual(self.cache['a'], [1, 2])
+        self.cache['c'] = [5, 6]
+        self.assert_('b' not in self.cache)
+        self.assert_('a' in self.cache and 'c' in self.cache)
+        self.assertEqual(self.cache.size, 4)
+
+        # A single large value evicts several small ones.
+        self.cache['d'] = [1, 2, 3, 4, 5]
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.size, 5)
+
+    def test_oversized_value_not_stored(self):
+        self.cache['a'] = [1]
+        self.cache['b'] = range(6)
+        self.assert_('b' not in self.cache)
+        self.assertEqual(self.cache['a'], [1])
+        self.assertEqual(self.cache.size, 1)
+
+    def test_replace_updates_size(self):
+        self.cache['a'] = [1, 2, 3]
+        self.cache['a'] = [1]
+        self.assertEqual(self.cache.size, 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_get_counts_hits_and_misses(self):
+        self.cache['a'] = [1]
+        self.assertEqual(self.cache.get('a'), [1])
+        self.assertEqual(self.cache.get('b', 'x'), 'x')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_discard(self):
+        self.cache['a'] = [1, 2]
+        self.cache.discard('a')
+        self.cache.discard('missing')
+        self.assert_(self.cache.get('a') is None)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_discard_matching(self):
+        self.cache[('dist', 1, 'x')] = [1]
+        self.cache[('dist', 1, 'y')] = [2]
+        self.cache[('dist', 2, 'x')] = [3]
+        self.cache.discard_matching(lambda k: k[1] == 1)
+        self.assertEqual(len(self.cache), 1)
+        self.assert_(('dist', 2, 'x') in self.cache)
+        self.assertEqual(self.cache.size, 1)
+
+class InMemorySamplerTest(TestCase):
+    def setUp(self):
+        util_models._samplers.clear()
+        dist = FreqDist()
+        for symbol, count in [(u'日', 5), (u'本', 3), (u'人', 2)]:
+            dist.inc(symbol, count)
+        KanjiProb.from_dist(dist)
+
+        cond_dist = ConditionalFreqDist()
+        for condition, symbol, count in [(u'日', u'ひ', 6), (u'日', u'にち', 3),
+                (u'日', u'か', 1), (u'本', u'ほん', 1)]:
+            cond_dist[condition].inc(symbol, count)
+        KanjiReadingCondProb.from_dist(cond_dist)
+
+    def tearDown(self):
+        KanjiProb.in_memory = True
+        KanjiReadingCondProb.in_memory = True
+        util_models._samplers.clear()
+
+    def test_prob_matches_query(self):
+        sampler = util_models._get_sampler(KanjiProb)
+        targets = [0.0, 0.25, 0.7, 0.95, 1.0] + [r.cdf for r in
+                KanjiProb.objects.all()]
+        for target in targets:
+            expected = KanjiProb.objects.filter(cdf__gte=target
+                    ).order_by('cdf')[0]
+            self.assertEqual(sampler.sample(target).symbol, expected.symbol)
+
+        results = []
+        for in_memory in (True, False):
+            KanjiProb.in_memory = in_memory
+            random.seed(1)
+            results.append((KanjiProb.sample().symbol,
+                    sorted(r.symbol for r in KanjiProb.sample_n(4))))
+        self.assertEqual(results[0], results[1])
+
+    def test_cond_prob_matches_query(self):
+        for condition in (u'日', u'本'):
+            sampler = util_models._get_sampler(KanjiReadingCondProb,
+                    condition)
+            targets = [0.0, 0.3, 0.65, 1.0] + [r.cdf for r in
+                    KanjiReadingCondProb.objects.filter(condition=condition)]
+            for target in targets:
+                expected = KanjiReadingCondProb.objects.filter(
+                        condition=condition, cdf__gte=target
+                        ).order_by('cdf')[0]
+                self.assertEqual(sampler.sample(target).symbol,
+                        expected.symbol)
+
+            results = []
+            for in_memory in (True, False):
+                KanjiReadingCondProb.in_memory = in_memory
+                random.seed(2)
+                results.append(KanjiReadingCondProb.sample(condition).symbol)
+            self.assertEqual(results[0], results[1])
+
+    def test_from_dist_clears_sampler(self):
+        util_models._get_sampler(KanjiProb)
+        self.assert_(KanjiProb._meta.db_table in util_models._samplers)
+        dist = FreqDist()
+        dist.inc(u'犬')
+        KanjiProb.from_dist(dist)
+        self.assertEqual(KanjiProb.sample().symbol, u'犬')
+
+    def test_missing_rows_raise(self):
+        self.assertRaises(KanjiReadingCondProb.DoesNotExist,
+                KanjiReadingCondProb.sample, u'犬')
+        KanjiProb.from_dist(FreqDist())
+        self.assertRaises(KanjiProb.DoesNotExist, KanjiProb.sample)
+        self.assertRaises(KanjiProb.DoesNotExist, KanjiProb.sample_n, 2)
+
+    def test_last_cdf_clamped(self):
+        # Rounding can leave the final cdf just short of 1.
+        KanjiProb.objects.filter(symbol=u'人').update(cdf=0.99)
+        util_models._samplers.clear()
+        sampler = util_models._get_sampler(KanjiProb)
+        self.assertEqual(sampler.sample(0.995).symbol, u'人')
+        self.assertEqual([r.symbol for r in sampler.sample_n([0.995, 1.0])],
+                [u'人'])
+
 def _dynamic_suite():
     current_dir = path.dirname(__file__)
     return dyntest.dynamicSuite(